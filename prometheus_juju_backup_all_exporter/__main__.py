@@ -2,19 +2,37 @@
 
 import argparse
 import logging
+import signal
+import sys
+import tempfile
+from typing import List, Optional
+
+from prometheus_client.core import REGISTRY
 
 from .collector import BackupEventCollector, BackupStatsCollector
 from .config import DEFAULT_CONFIG, Config
-from .exporter import Exporter
+from .core import ConcurrentCollectorRegistry
+from .exporter import EventStream, Exporter
+from .history import HistoryStore, make_history_app
+from .oneshot import render, run_bench
+from .prefork import PreforkExporter
+from .replay import generate_timeline, load_timeline, record_timeline, replay, save_timeline
+from .storage import make_storage
+from .tls import ServerTLS
 
 root_logger = logging.getLogger()
 
+SECONDS_PER_DAY = 24 * 60 * 60
+
 
-def parse_command_line() -> argparse.Namespace:
+def parse_command_line(argv: Optional[List[str]] = None) -> argparse.Namespace:
     """Command line parser.
 
     Parse command line arguments and return the arguments.
 
+    Args:
+        argv: the arguments to parse, the ones of the process by default.
+
     Returns:
         args: Command line arguments.
     """
@@ -23,21 +41,164 @@ def parse_command_line() -> argparse.Namespace:
         description=__doc__,
     )
     parser.add_argument("-c", "--config", help="Set configuration file.", default="", type=str)
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.add_parser("serve", help="Start the exporter (default).")
+    render_parser = subparsers.add_parser(
+        "render", help="Run the collectors once and print the metrics to stdout."
+    )
+    render_parser.add_argument(
+        "--consume-events",
+        action="store_true",
+        help="Remove the backup event file once read, as a scrape does.",
+    )
+    bench_parser = subparsers.add_parser(
+        "bench", help="Time collection and render cycles against a backup directory."
+    )
+    bench_parser.add_argument("backup_path", help="The backup directory, left untouched.")
+    bench_parser.add_argument("-n", "--cycles", help="Number of cycles.", default=100, type=int)
+    record_parser = subparsers.add_parser(
+        "record", help="Record a timeline of the state files of a backup directory."
+    )
+    record_parser.add_argument("backup_path", help="The backup directory, left untouched.")
+    record_parser.add_argument("output", help="The timeline file to write.")
+    record_parser.add_argument(
+        "-d", "--duration", help="Seconds to record.", default=3600.0, type=float
+    )
+    record_parser.add_argument(
+        "-i", "--interval", help="Seconds between the polls.", default=1.0, type=float
+    )
+    replay_parser = subparsers.add_parser(
+        "replay", help="Replay a timeline against the exporter and check the metrics."
+    )
+    replay_parser.add_argument(
+        "timeline", nargs="?", help="The timeline file; a synthetic timeline if not set."
+    )
+    replay_parser.add_argument(
+        "--runs", help="Backup runs of the synthetic timeline.", default=24, type=int
+    )
+    replay_parser.add_argument(
+        "--targets", help="Per-target entries of the synthetic timeline.", default=0, type=int
+    )
+    replay_parser.add_argument(
+        "--seed", help="Seed of the synthetic timeline.", default=0, type=int
+    )
+    replay_parser.add_argument(
+        "--speed", help="Acceleration of the timeline.", default=3600.0, type=float
+    )
+    replay_parser.add_argument(
+        "--scrape-interval", help="Seconds between the scrapes.", default=15.0, type=float
+    )
+    args = parser.parse_args(argv)
 
     return args
 
 
 def main() -> None:
-    """Start the prometheus-juju-backup-all exporter."""
+    """Start the prometheus-juju-backup-all exporter, or run one of the commands."""
     args = parse_command_line()
+    if args.command == "bench":
+        root_logger.setLevel(logging.ERROR)
+        print(run_bench(Config(backup_path=args.backup_path), args.cycles).report())
+        return
+
+    if args.command == "record":
+        root_logger.setLevel(logging.ERROR)
+        storage = make_storage(Config(backup_path=args.backup_path))
+        save_timeline(record_timeline(storage, args.duration, args.interval), args.output)
+        return
+    if args.command == "replay":
+        # the half-written backup files of the timeline are expected
+        root_logger.setLevel(logging.CRITICAL)
+        run_replay(args)
+        return
+
     config = Config.load_config(config_file=args.config or DEFAULT_CONFIG)
     root_logger.setLevel(logging.getLevelName(config.level))
+    if args.command == "render":
+        sys.stdout.write(render(config, remove_events=args.consume_events).decode())
+        return
+    serve(config)
+
+
+def run_replay(args: argparse.Namespace) -> None:
+    """Replay a timeline into a temporary directory and print the report.
+
+    Raises:
+        SystemExit: an invariant did not hold.
+    """
+    if args.timeline:
+        timeline = load_timeline(args.timeline)
+    else:
+        timeline = generate_timeline(args.runs, targets=args.targets, seed=args.seed)
+    with tempfile.TemporaryDirectory() as backup_path:
+        report = replay(
+            timeline, backup_path, speed=args.speed, scrape_interval=args.scrape_interval
+        )
+    print(report.report())
+    if not report.ok:
+        sys.exit(1)
+
+
+def serve(config: Config) -> None:
+    """Start the exporter."""
+    registry = ConcurrentCollectorRegistry(
+        max_workers=config.collect_workers, timeout=config.collect_timeout
+    )
+    tls = None
+    if config.tls_cert_file and config.tls_key_file:
+        tls = ServerTLS(config.tls_cert_file, config.tls_key_file, ca_file=config.tls_ca_file)
+    storage = make_storage(config)
+    collectors = [
+        BackupStatsCollector(config, storage=storage),
+        BackupEventCollector(config, storage=storage),
+    ]
+    history = None
+    if config.history_file:
+        history = HistoryStore(
+            config.history_file, retention=config.history_retention_days * SECONDS_PER_DAY
+        )
+        for collector in collectors:
+            collector.add_listener(history.record)
 
-    exporter = Exporter(config.port)
-    exporter.register(BackupStatsCollector(config))
-    exporter.register(BackupEventCollector(config))
-    exporter.run()
+    if config.workers:
+        registry.register(REGISTRY)
+        for collector in collectors:
+            registry.register(collector)
+        PreforkExporter(
+            config.port,
+            registry,
+            config.workers,
+            interval=config.refresh_interval,
+            tls=tls,
+            debug_port=config.debug_port,
+            on_exit=history.close if history else None,
+        ).run()
+        return
+
+    exporter = Exporter(
+        config.port,
+        registry=registry,
+        unix_socket=config.unix_socket,
+        tls=tls,
+        debug_port=config.debug_port,
+    )
+    for collector in collectors:
+        exporter.register(collector)
+    if history:
+        exporter.add_route("/api/history", make_history_app(history))
+    events = EventStream(
+        poll=lambda: registry.poll(collectors), poll_interval=config.events_poll_interval
+    )
+    for collector in collectors:
+        collector.add_listener(events.publish)
+    exporter.add_route("/events", events.app)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: exporter.shutdown())
+    try:
+        exporter.run()
+    finally:
+        if history:
+            history.close()
 
 
 if __name__ == "__main__":  # pragma: no cover
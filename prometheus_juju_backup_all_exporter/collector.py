@@ -1,19 +1,63 @@
 """Module for j-b-a collecter."""
 
-from logging import getLogger
-from typing import Dict, List
+import time
+from logging import DEBUG, ERROR, WARNING, getLogger
+from typing import Dict, List, Optional
 
 from prometheus_client.metrics_core import CounterMetricFamily, GaugeMetricFamily
 
-from .core import BlockingCollector, Payload, Specification
-from .utils import BackupEvent, BackupStats, get_result_code_name
+from .config import Config
+from .core import BlockingCollector, Payload, Specification, current_cycle
+from .snapshot import STATS_FILE, get_snapshot
+from .storage import Storage, make_storage
+from .utils import (
+    INVALID_RESULT_CODE_NAME,
+    RESULT_CODE_NAMES,
+    BackupEvent,
+    BackupEventDelta,
+    BackupRun,
+    BackupStats,
+    get_result_code_name,
+)
 
 logger = getLogger(__name__)
 
+# The maximum number of per-target timeseries kept in the datastore.
+MAX_TARGET_SERIES = 10000
+# Seconds a target missing from the backup stats file stays in the datastore.
+TARGET_SERIES_TTL = 3600.0
+# The maximum number of distinct values of the per-target labels in one backup
+# stats file; the values beyond are collected as __overflow__.
+TARGET_LABEL_BUDGETS = {"controller": 100, "model": 1000, "unit": MAX_TARGET_SERIES}
+
+RESULT_CODE_VALUES = frozenset([*RESULT_CODE_NAMES.values(), INVALID_RESULT_CODE_NAME])
+STATUS_OK_VALUES = frozenset(["0", "1"])
+
+
+def _polling() -> bool:
+    """Return if the collector runs in a polling cycle, between scrapes."""
+    cycle = current_cycle()
+    return cycle is not None and cycle.poll
+
 
 class BackupEventCollector(BlockingCollector):
     """Collector for backup event."""
 
+    def __init__(
+        self, config: Config, remove_events: bool = True, storage: Optional[Storage] = None
+    ) -> None:
+        """Initialize the class.
+
+        Args:
+            config: the exporter configuration.
+            remove_events: remove the event file once read, so that each event
+                is counted once; disable it to leave the backup directory untouched.
+            storage: the storage of the backup directory, the configured one by default.
+        """
+        super().__init__(config)
+        self.remove_events = remove_events
+        self.storage = storage or make_storage(config)
+
     @property
     def specifications(self) -> List[Specification]:
         """Backup event metrics specs."""
@@ -39,8 +83,25 @@ class BackupEventCollector(BlockingCollector):
         ]
 
     def fetch(self) -> List[Payload]:
-        """Load the backup event data."""
-        backup_event = BackupEvent(self.config)
+        """Load the backup event data.
+
+        The event file is missing between backups, which is only logged at the
+        DEBUG level while polling.
+        """
+        backup_event = BackupEvent(
+            get_snapshot(self.storage),
+            remove=self.remove_events,
+            missing_level=DEBUG if _polling() else WARNING,
+        )
+        if backup_event.failed or backup_event.purged or backup_event.completed:
+            self.notify(
+                BackupEventDelta(
+                    time=time.time(),
+                    failed=backup_event.failed,
+                    purged=backup_event.purged,
+                    completed=backup_event.completed,
+                )
+            )
         return [
             Payload(
                 name="juju_backup_all_backup_failed_total",
@@ -70,6 +131,19 @@ class BackupEventCollector(BlockingCollector):
 class BackupStatsCollector(BlockingCollector):
     """Collector for backup stats."""
 
+    def __init__(self, config: Config, storage: Optional[Storage] = None) -> None:
+        """Initialize the class.
+
+        Args:
+            config: the exporter configuration.
+            storage: the storage of the backup directory, the configured one by default.
+        """
+        super().__init__(config)
+        self.storage = storage or make_storage(config)
+        # version of the last backup stats file loaded, and the payloads built from it
+        self._generation: Optional[str] = None
+        self._payloads: List[Payload] = []
+
     @property
     def specifications(self) -> List[Specification]:
         """Backup stats metrics specs."""
@@ -79,6 +153,9 @@ class BackupStatsCollector(BlockingCollector):
                 documentation="Length of time the charm-juju-backup-all backup command took.",
                 labels=["status_ok", "result_code"],
                 metric_class=GaugeMetricFamily,
+                # The stats are "set" as they are, only the latest timeseries is kept.
+                max_series=1,
+                allowed_values={"status_ok": STATUS_OK_VALUES, "result_code": RESULT_CODE_VALUES},
             ),
             Specification(
                 name="juju_backup_all_command_ok_info",
@@ -88,13 +165,61 @@ class BackupStatsCollector(BlockingCollector):
                 ),
                 labels=["result_code"],
                 metric_class=GaugeMetricFamily,
+                # The stats are "set" as they are, only the latest timeseries is kept.
+                max_series=1,
+                allowed_values={"result_code": RESULT_CODE_VALUES},
+            ),
+            Specification(
+                name="juju_backup_all_target_duration_seconds",
+                documentation="Length of time the backup of the target took.",
+                labels=["controller", "model", "unit"],
+                metric_class=GaugeMetricFamily,
+                ttl=TARGET_SERIES_TTL,
+                max_series=MAX_TARGET_SERIES,
+                label_budgets=TARGET_LABEL_BUDGETS,
+            ),
+            Specification(
+                name="juju_backup_all_target_ok_info",
+                documentation="Indicates whether or not the backup of the target was a success.",
+                labels=["controller", "model", "unit", "result_code"],
+                metric_class=GaugeMetricFamily,
+                ttl=TARGET_SERIES_TTL,
+                max_series=MAX_TARGET_SERIES,
+                allowed_values={"result_code": RESULT_CODE_VALUES},
+                label_budgets=TARGET_LABEL_BUDGETS,
             ),
         ]
 
     def fetch(self) -> List[Payload]:
-        """Load the backup stats data."""
-        backup_stats = BackupStats(self.config)
-        return [
+        """Load the backup stats data.
+
+        The payloads are built once per generation of the backup stats file,
+        and reused as long as the file does not change.
+        """
+        snapshot = get_snapshot(self.storage)
+        entry = snapshot.entry(STATS_FILE)
+        if entry is not None and entry.version == self._generation:
+            return self._payloads
+
+        backup_stats = BackupStats(snapshot, missing_level=DEBUG if _polling() else ERROR)
+        payloads = self._make_payloads(backup_stats)
+        if backup_stats.loaded and entry is not None:
+            self._generation = entry.version
+            self._payloads = payloads
+            self.notify(
+                BackupRun(
+                    time=entry.mtime,
+                    duration=backup_stats.duration,
+                    status_ok=backup_stats.status_ok,
+                    result_code=backup_stats.result_code,
+                )
+            )
+        return payloads
+
+    @staticmethod
+    def _make_payloads(backup_stats: BackupStats) -> List[Payload]:
+        """Build the payloads of the backup stats."""
+        payloads = [
             Payload(
                 name="juju_backup_all_command_duration_seconds",
                 labels=[
@@ -109,6 +234,27 @@ class BackupStatsCollector(BlockingCollector):
                 value=backup_stats.status_ok,
             ),
         ]
+        # a target listed twice is exported once, with its last entry
+        targets = {
+            (target.controller, target.model, target.unit): target
+            for target in backup_stats.targets
+        }
+        for labels, target in targets.items():
+            payloads.append(
+                Payload(
+                    name="juju_backup_all_target_duration_seconds",
+                    labels=list(labels),
+                    value=target.duration,
+                )
+            )
+            payloads.append(
+                Payload(
+                    name="juju_backup_all_target_ok_info",
+                    labels=[*labels, get_result_code_name(target.result_code)],
+                    value=target.status_ok,
+                )
+            )
+        return payloads
 
     def process(self, payloads: List[Payload], datastore: Dict[str, Payload]) -> List[Payload]:
         """Process the backup stats data."""
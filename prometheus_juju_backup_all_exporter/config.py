@@ -2,6 +2,8 @@
 
 import os
 from logging import getLogger
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
 
 from pydantic import BaseModel, validator
 from yaml import safe_load
@@ -9,24 +11,100 @@ from yaml import safe_load
 logger = getLogger(__name__)
 
 DEFAULT_CONFIG = os.path.join(os.environ.get("SNAP_DATA", "./"), "config.yaml")
+DEFAULT_HISTORY_FILE = os.path.join(os.environ.get("SNAP_DATA", "./"), "history.db")
 
 
 class Config(BaseModel):
     """Juju backup all configuration."""
 
     port: int = 10000
+    debug_port: Optional[int] = None
     level: str = "DEBUG"
     backup_path: str
+    collect_workers: int = 4
+    collect_timeout: float = 10.0
+    unix_socket: Optional[str] = None
+    workers: int = 0
+    refresh_interval: float = 15.0
+    history_file: Optional[str] = DEFAULT_HISTORY_FILE
+    history_retention_days: float = 90.0
+    events_poll_interval: float = 1.0
+    tls_cert_file: Optional[str] = None
+    tls_key_file: Optional[str] = None
+    tls_ca_file: Optional[str] = None
+    s3_endpoint: Optional[str] = None
+    s3_region: str = "us-east-1"
+    s3_access_key: Optional[str] = None
+    s3_secret_key: Optional[str] = None
 
-    @validator("port")
-    def validate_port_range(cls, port: int) -> int:  # noqa: N805 pylint: disable=E0213
+    @validator("port", "debug_port")
+    def validate_port_range(
+        cls, port: Optional[int]  # noqa: N805 pylint: disable=E0213
+    ) -> Optional[int]:
         """Validate port range."""
-        if not 1 <= port <= 65535:
+        if port is not None and not 1 <= port <= 65535:
             msg = "Port must be in [1, 65535]."
             logger.error(msg)
             raise ValueError(msg)
         return port
 
+    @validator("workers")
+    def validate_workers(
+        cls, workers: int, values: Dict[str, Any]  # noqa: N805 pylint: disable=E0213
+    ) -> int:
+        """Validate the number of worker processes, which do not serve the Unix socket."""
+        if workers < 0:
+            msg = "Workers must not be negative."
+            logger.error(msg)
+            raise ValueError(msg)
+        if workers and values.get("unix_socket"):
+            msg = "Workers cannot be set with a Unix socket."
+            logger.error(msg)
+            raise ValueError(msg)
+        return workers
+
+    @validator(
+        "collect_workers",
+        "collect_timeout",
+        "refresh_interval",
+        "history_retention_days",
+        "events_poll_interval",
+    )
+    def validate_positive(cls, value: float) -> float:  # noqa: N805 pylint: disable=E0213
+        """Validate collector pool size and timeout are positive."""
+        if value <= 0:
+            msg = (
+                "Collector workers, timeout, refresh interval, history retention and events"
+                " poll interval must be positive."
+            )
+            logger.error(msg)
+            raise ValueError(msg)
+        return value
+
+    @validator("tls_ca_file", always=True)
+    def validate_tls(
+        cls, ca_file: Optional[str], values: Dict[str, Any]  # noqa: N805 pylint: disable=E0213
+    ) -> Optional[str]:
+        """Validate the TLS certificate and key are set together, and before the CA."""
+        if bool(values.get("tls_cert_file")) != bool(values.get("tls_key_file")) or (
+            ca_file and not values.get("tls_cert_file")
+        ):
+            msg = "TLS cert and key files must be set together, and to set the CA file."
+            logger.error(msg)
+            raise ValueError(msg)
+        return ca_file
+
+    @validator("s3_secret_key", always=True)
+    def validate_s3_credentials(
+        cls, secret_key: Optional[str], values: Dict[str, Any]  # noqa: N805 pylint: disable=E0213
+    ) -> Optional[str]:
+        """Validate the S3 access key and secret key are set together."""
+        if bool(values.get("s3_access_key")) != bool(secret_key):
+            msg = "S3 access key and secret key must be set together."
+            logger.error(msg)
+            raise ValueError(msg)
+        return secret_key
+
     @validator("level")
     def validate_level_choice(cls, level: str) -> str:  # noqa: N805 pylint: disable=E0213
         """Validate logging level choice."""
@@ -40,8 +118,13 @@ class Config(BaseModel):
 
     @validator("backup_path")
     def validate_backup_path(cls, backup_path: str) -> str:  # noqa: N805 pylint: disable=E0213
-        """Validate backup path."""
-        if not os.path.isdir(backup_path):
+        """Validate backup path, a directory or the s3://bucket/prefix of an object store."""
+        if backup_path.startswith("s3://"):
+            if not urlsplit(backup_path).netloc:
+                msg = "Backup path in an object store must name its bucket."
+                logger.error(msg)
+                raise ValueError(msg)
+        elif not os.path.isdir(backup_path):
             msg = "Backup path must exists and is a directory."
             logger.error(msg)
             raise ValueError(msg)
@@ -1,17 +1,55 @@
 """Module for collecter core codes."""
 
+import copy
+import threading
+import time
 from abc import abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextvars import ContextVar
 from dataclasses import dataclass
 from logging import getLogger
-from typing import Dict, Iterable, List, Type
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Type,
+    TypeVar,
+)
 
-from prometheus_client.metrics_core import Metric
-from prometheus_client.registry import Collector
+from prometheus_client import Counter
+from prometheus_client.metrics_core import CounterMetricFamily, Metric
+from prometheus_client.registry import Collector, CollectorRegistry, RestrictedRegistry
 
 from .config import Config
 
 logger = getLogger(__name__)
 
+# The label value of the timeseries whose value is not allowed or over budget.
+OVERFLOW_VALUE = "__overflow__"
+
+DATASTORE_EVICTED = Counter(
+    "juju_backup_all_exporter_datastore_evicted",
+    "The number of timeseries evicted from the collectors' datastore.",
+    ["metric"],
+)
+COLLAPSED_SERIES = Counter(
+    "juju_backup_all_exporter_collapsed_series",
+    "The number of timeseries collected with a label value collapsed into __overflow__.",
+    ["metric", "label"],
+)
+COALESCED_COLLECTIONS = Counter(
+    "juju_backup_all_exporter_coalesced_collections",
+    "The number of collections that shared the result of one already in flight.",
+    ["collector"],
+)
+
 
 @dataclass
 class Payload:
@@ -29,12 +67,74 @@ class Payload:
 
 @dataclass
 class Specification:
-    """Specification for metrics."""
+    """Specification for metrics.
+
+    The datastore keeps the last payload of every timeseries. `ttl` drops the
+    timeseries not seen for that many seconds, and `max_series` keeps only
+    that many most recently seen timeseries. None means no limit.
+
+    `allowed_values` maps labels to the values they may take, and
+    `label_budgets` maps labels to the number of distinct values they may
+    take in each collection: the values admitted by the previous collection
+    keep their place, and the new ones are admitted in order while the budget
+    lasts. Any other value is collected as `OVERFLOW_VALUE`.
+    """
 
     name: str
     labels: List[str]
     documentation: str
     metric_class: Type[Metric]
+    ttl: Optional[float] = None
+    max_series: Optional[int] = None
+    allowed_values: Optional[Dict[str, FrozenSet[str]]] = None
+    label_budgets: Optional[Dict[str, int]] = None
+
+
+class LabelGuard:
+    """Bound on the values of a label of a metric."""
+
+    __slots__ = ("index", "allowed", "budget", "admitted", "collapsed")
+
+    def __init__(self, spec: Specification, label: str) -> None:
+        """Initialize the guard of the label from the specification.
+
+        Raises:
+            ValueError: the label is not a label of the specification.
+        """
+        if label not in spec.labels:
+            raise ValueError(f"Metric {spec.name} has no label {label}.")
+        self.index = spec.labels.index(label)
+        self.allowed = (spec.allowed_values or {}).get(label)
+        self.budget = (spec.label_budgets or {}).get(label)
+        self.admitted: Set[str] = set()
+        self.collapsed = COLLAPSED_SERIES.labels(metric=spec.name, label=label)
+
+    def admit(self, values: Iterable[str]) -> None:
+        """Admit the values of a collection within the budget.
+
+        The values admitted by the previous collection and still collected keep
+        their place, so a value does not flip to `OVERFLOW_VALUE` when a new one
+        shows up; the budget then goes to the new values in order.
+        """
+        if self.budget is None:
+            return
+        collected = [
+            value
+            for value in dict.fromkeys(values)
+            if self.allowed is None or value in self.allowed
+        ]
+        admitted = self.admitted.intersection(collected)
+        for value in collected:
+            if len(admitted) >= self.budget:
+                break
+            admitted.add(value)
+        self.admitted = admitted
+
+    def check(self, value: str) -> bool:
+        """Return if the value is collected as is."""
+        if self.allowed is not None and value not in self.allowed:
+            return False
+        return self.budget is None or value in self.admitted
 
 
 class BlockingCollector(Collector):
@@ -50,6 +150,36 @@ class BlockingCollector(Collector):
         self.config = config
         self._datastore: Dict[str, Payload] = {}
         self._specs = {spec.name: spec for spec in self.specifications}
+        # timeseries uuid -> last seen time, from least to most recently seen
+        self._last_seen: Dict[str, "OrderedDict[str, float]"] = {
+            name: OrderedDict() for name in self._specs
+        }
+        self._evicted = {name: DATASTORE_EVICTED.labels(metric=name) for name in self._specs}
+        self._guards = {
+            spec.name: [
+                LabelGuard(spec, label)
+                for label in {**(spec.allowed_values or {}), **(spec.label_budgets or {})}
+            ]
+            for spec in self._specs.values()
+            if spec.allowed_values or spec.label_budgets
+        }
+        self._listeners: List[Callable[[Any], None]] = []
+
+    def add_listener(self, listener: Callable[[Any], None]) -> None:
+        """Add a listener notified of the changes detected by the collector.
+
+        Args:
+            listener: called with a record describing each change.
+        """
+        self._listeners.append(listener)
+
+    def notify(self, record: Any) -> None:
+        """Notify the listeners of a change; a failing listener does not affect the others."""
+        for listener in self._listeners:
+            try:
+                listener(record)
+            except Exception as err:  # pylint: disable=W0703
+                logger.error("Listener of %s failed: %s.", type(self).__name__, str(err))
 
     @abstractmethod
     def fetch(self) -> List[Payload]:
@@ -89,17 +219,94 @@ class BlockingCollector(Collector):
             A list of specification.
         """
 
+    def guard_labels(self, payloads: List[Payload]) -> List[Payload]:
+        """Collapse the label values not allowed or over budget into `OVERFLOW_VALUE`.
+
+        The payloads collapsed into the same timeseries are merged: the values
+        of counters are summed, and the last payload of other metrics wins.
+
+        Args:
+            payloads: the fetched data.
+
+        Returns:
+            The payloads with the guarded labels.
+        """
+        if not self._guards:
+            return payloads
+        for name, guards in self._guards.items():
+            for guard in guards:
+                guard.admit(
+                    payload.labels[guard.index] for payload in payloads if payload.name == name
+                )
+        guarded: Dict[str, Payload] = {}
+        for payload in payloads:
+            labels = None
+            for guard in self._guards.get(payload.name, ()):
+                if not guard.check(payload.labels[guard.index]):
+                    labels = labels or list(payload.labels)
+                    labels[guard.index] = OVERFLOW_VALUE
+                    guard.collapsed.inc()
+            if labels is not None:
+                payload = Payload(name=payload.name, labels=labels, value=payload.value)
+            previous = guarded.get(payload.uuid)
+            if previous is not None and issubclass(
+                self._specs[payload.name].metric_class, CounterMetricFamily
+            ):
+                payload = Payload(
+                    name=payload.name, labels=payload.labels, value=previous.value + payload.value
+                )
+            guarded[payload.uuid] = payload
+        return list(guarded.values())
+
     def init_default_datastore(self, payloads: List[Payload]) -> None:
         """Initialize or fill data the store with default values.
 
         Args:
             payloads: the fetched data to be processed.
         """
+        now = time.monotonic()
         for payload in payloads:
             if payload.uuid not in self._datastore:
                 self._datastore[payload.uuid] = Payload(
                     name=payload.name, labels=payload.labels, value=0.0
                 )
+            last_seen = self._last_seen[payload.name]
+            last_seen[payload.uuid] = now
+            last_seen.move_to_end(payload.uuid)
+
+    def evict_datastore(self) -> None:
+        """Evict the expired and least recently seen timeseries from the datastore."""
+        now = time.monotonic()
+        for name, last_seen in self._last_seen.items():
+            spec = self._specs[name]
+            evicted = 0
+            if spec.ttl is not None:
+                while last_seen and now - next(iter(last_seen.values())) > spec.ttl:
+                    uuid, _ = last_seen.popitem(last=False)
+                    del self._datastore[uuid]
+                    evicted += 1
+            if spec.max_series is not None:
+                while len(last_seen) > spec.max_series:
+                    uuid, _ = last_seen.popitem(last=False)
+                    del self._datastore[uuid]
+                    evicted += 1
+            if evicted:
+                self._evicted[name].inc(evicted)
+
+    def describe(self) -> Iterable[Metric]:
+        """Describe the metrics from the specifications, without fetching any data.
+
+        This is used by the `prometheus_client` registry to know the metrics
+        owned by the collector. Without it, the registry would call `collect`
+        at registration time.
+
+        Yields:
+            metrics: the empty metrics
+        """
+        for spec in self._specs.values():
+            yield spec.metric_class(  # type: ignore[call-arg]
+                name=spec.name, labels=spec.labels, documentation=spec.documentation
+            )
 
     def collect(self) -> Iterable[Metric]:
         """Fetch data and update the internal metrics.
@@ -111,21 +318,223 @@ class BlockingCollector(Collector):
         Yields:
             metrics: the internal metrics
         """
-        payloads = self.fetch()
+        payloads = self.guard_labels(self.fetch())
         self.init_default_datastore(payloads)
         processed_payloads = self.process(payloads, self._datastore)
 
-        # unpacked and create metrics
+        # unpacked and create metrics, one metric family per specification
+        metrics: Dict[str, Metric] = {}
         for payload in processed_payloads:
-            spec = self._specs[payload.name]
-            # We have to ignore the type checking here, since the subclass of
-            # any metric family from prometheus client adds new attributes and
-            # methods.
-            metric = spec.metric_class(  # type: ignore[call-arg]
-                name=spec.name, labels=spec.labels, documentation=spec.documentation
-            )
+            metric = metrics.get(payload.name)
+            if metric is None:
+                spec = self._specs[payload.name]
+                # We have to ignore the type checking here, since the subclass of
+                # any metric family from prometheus client adds new attributes and
+                # methods.
+                metric = metrics[payload.name] = spec.metric_class(  # type: ignore[call-arg]
+                    name=spec.name, labels=spec.labels, documentation=spec.documentation
+                )
             metric.add_metric(  # type: ignore[attr-defined]
                 labels=payload.labels, value=payload.value
             )
-            yield metric
             self._datastore[payload.uuid] = payload
+        self.evict_datastore()
+        yield from metrics.values()
+
+
+T = TypeVar("T")
+
+
+class CollectionCycle:
+    """State shared by the collectors running within one collection cycle.
+
+    The collectors use it to share the work they all need, like listing the
+    backup directory, so it is done once per cycle instead of once per
+    collector. `poll` tells the collectors the cycle runs in the background,
+    between scrapes, so they can log at the DEBUG level what the scrapes
+    already report.
+    """
+
+    def __init__(self, poll: bool = False) -> None:
+        """Initialize the cycle."""
+        self.poll = poll
+        self._values: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], T]) -> T:
+        """Return the value of the key, creating it with the factory on first use.
+
+        The factory runs once per cycle, and the collectors asking for the key
+        in the meantime wait for its result.
+        """
+        with self._lock:
+            future = self._values.get(key)
+            owner = future is None
+            if future is None:
+                future = self._values[key] = Future()
+        if owner:
+            try:
+                future.set_result(factory())
+            except Exception as err:  # pylint: disable=W0703
+                future.set_exception(err)
+        return future.result()
+
+
+_current_cycle: ContextVar[Optional[CollectionCycle]] = ContextVar("cycle", default=None)
+
+
+def current_cycle() -> Optional[CollectionCycle]:
+    """Return the collection cycle the collector is running in, if any."""
+    return _current_cycle.get()
+
+
+def _run_collector(collector: Collector, cycle: CollectionCycle) -> List[Metric]:
+    """Run the collector to completion and return all the metrics it yields."""
+    token = _current_cycle.set(cycle)
+    try:
+        return list(collector.collect())
+    finally:
+        _current_cycle.reset(token)
+
+
+class ConcurrentCollectorRegistry(CollectorRegistry):
+    """Registry that runs all its collectors concurrently.
+
+    `prometheus_client` calls every registered collector one after another, so
+    a scrape takes as long as all the collectors combined. This registry starts
+    all the collectors at once on a shared, bounded thread pool and yields their
+    metrics in registration order. A collector that raises, or that does not
+    finish within `timeout` seconds, is logged and skipped without affecting
+    the others.
+
+    Concurrent scrapes are coalesced: while a collector is running, the other
+    scrapes wait for it and share its result instead of running it again.
+    """
+
+    def __init__(
+        self, max_workers: int = 4, timeout: Optional[float] = None, **kwargs: Any
+    ) -> None:
+        """Initialize the registry.
+
+        Args:
+            max_workers: the maximum number of collectors running at the same time.
+            timeout: seconds to wait for the collectors; None means no limit.
+            kwargs: extra arguments passed to `CollectorRegistry`.
+        """
+        super().__init__(**kwargs)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="collector"
+        )
+        self._in_flight: Dict[Collector, Future] = {}
+        self._in_flight_lock = threading.Lock()
+
+    def collect(self) -> Iterable[Metric]:
+        """Yield metrics from all the collectors in the registry."""
+        target_info = None
+        with self._lock:
+            collectors = list(self._collector_to_names)
+            if self._target_info:
+                target_info = self._target_info_metric()
+        if target_info:
+            yield target_info
+        yield from self._collect_concurrently(collectors)
+
+    def restricted_registry(self, names: Iterable[str]) -> "RestrictedConcurrentRegistry":
+        """Return a registry that only collects the given timeseries.
+
+        This is used by `prometheus_client` to serve the `name[]` query parameters.
+        """
+        return RestrictedConcurrentRegistry(names, self)
+
+    def collect_restricted(self, names: Set[str]) -> Iterable[Metric]:
+        """Yield the given timeseries, only running the collectors owning them.
+
+        The collectors without a `describe` method may own any timeseries, so
+        they always run.
+        """
+        target_info = None
+        with self._lock:
+            owners = {
+                self._names_to_collectors[name]
+                for name in names
+                if name != "target_info" and name in self._names_to_collectors
+            }
+            collectors = [
+                collector
+                for collector, collector_names in self._collector_to_names.items()
+                if collector in owners or not collector_names
+            ]
+            if "target_info" in names and self._target_info:
+                target_info = self._target_info_metric()
+        if target_info:
+            yield target_info
+        for metric in self._collect_concurrently(collectors):
+            samples = [sample for sample in metric.samples if sample.name in names]
+            if samples:
+                restricted_metric = copy.copy(metric)
+                restricted_metric.samples = samples
+                yield restricted_metric
+
+    def poll(self, collectors: Iterable[Collector]) -> List[Metric]:
+        """Run only the given collectors, in a polling cycle, and return their metrics.
+
+        This is used to detect the changes between scrapes without running the
+        whole registry. The runs in flight are shared with the scrapes.
+        """
+        return list(self._collect_concurrently(list(collectors), CollectionCycle(poll=True)))
+
+    def _submit(self, collector: Collector, cycle: CollectionCycle) -> Future:
+        """Run the collector, or join its run if it is already in flight."""
+        with self._in_flight_lock:
+            future = self._in_flight.get(collector)
+            # a finished run stays here until its done callback runs, after
+            # its waiters are woken up, so it must not be joined
+            if future is not None and not future.done():
+                COALESCED_COLLECTIONS.labels(collector=type(collector).__name__).inc()
+                return future
+            future = self._executor.submit(_run_collector, collector, cycle)
+            self._in_flight[collector] = future
+        future.add_done_callback(lambda _: self._done(collector, future))
+        return future
+
+    def _done(self, collector: Collector, future: Future) -> None:
+        """Let the next scrape start a new run of the collector."""
+        with self._in_flight_lock:
+            if self._in_flight.get(collector) is future:
+                del self._in_flight[collector]
+
+    def _collect_concurrently(
+        self, collectors: List[Collector], cycle: Optional[CollectionCycle] = None
+    ) -> Iterable[Metric]:
+        """Run the collectors on the thread pool and yield their metrics in order."""
+        cycle = cycle or CollectionCycle()
+        futures = [self._submit(collector, cycle) for collector in collectors]
+        wait(futures, timeout=self.timeout)
+        for collector, future in zip(collectors, futures):
+            if not future.done():
+                logger.error(
+                    "Collector %s did not finish within %s seconds, skipping.",
+                    type(collector).__name__,
+                    self.timeout,
+                )
+                continue
+            try:
+                yield from future.result()
+            except Exception as err:  # pylint: disable=W0703
+                logger.error("Collector %s failed: %s.", type(collector).__name__, str(err))
+
+
+class RestrictedConcurrentRegistry(RestrictedRegistry):
+    """Registry view that only collects some timeseries of a ConcurrentCollectorRegistry."""
+
+    def __init__(self, names: Iterable[str], registry: ConcurrentCollectorRegistry) -> None:
+        """Initialize the registry view."""
+        names = set(names)
+        super().__init__(names, registry)
+        self._names = names
+        self._concurrent_registry = registry
+
+    def collect(self) -> Iterable[Metric]:
+        """Yield the restricted timeseries."""
+        return self._concurrent_registry.collect_restricted(self._names)
@@ -0,0 +1,227 @@
+"""Module for the health and debug endpoints of the exporter."""
+
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from types import FrameType
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+# Seconds a profile or an allocation trace lasts by default, and at most.
+DEFAULT_DEBUG_SECONDS = 10.0
+MAX_DEBUG_SECONDS = 60.0
+# Seconds between the samples of the profiler.
+SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation trace, and allocations reported by default.
+TRACEMALLOC_FRAMES = 16
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_KEYS = ("lineno", "filename", "traceback")
+PROFILE_FORMATS = ("collapsed", "top")
+
+# One profile or allocation trace at a time: the tracing of allocations is
+# global to the process, and concurrent profiles would sample each other.
+_session_lock = threading.Lock()
+
+
+def _respond(start_response: Callable, status: str, body: str) -> List[bytes]:
+    """Start a plain text response and return its body."""
+    start_response(status, [("Content-Type", "text/plain; charset=utf-8")])
+    return [body.encode()]
+
+
+def _get_query(environ: dict, name: str, default: str, choices: Iterable[str]) -> str:
+    """Return a query parameter among the choices.
+
+    Raises:
+        ValueError: the parameter is not one of the choices.
+    """
+    value = parse_qs(environ.get("QUERY_STRING", "")).get(name, [default])[0]
+    if value not in choices:
+        raise ValueError(f"Parameter {name} must be in {tuple(choices)}.")
+    return value
+
+
+def _get_seconds(environ: dict) -> float:
+    """Return the `seconds` query parameter.
+
+    Raises:
+        ValueError: the parameter is not a number in (0, `MAX_DEBUG_SECONDS`].
+    """
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    seconds = float(query.get("seconds", [str(DEFAULT_DEBUG_SECONDS)])[0])
+    if not 0 < seconds <= MAX_DEBUG_SECONDS:
+        raise ValueError(f"Parameter seconds must be in (0, {MAX_DEBUG_SECONDS}].")
+    return seconds
+
+
+def _frame_name(frame: FrameType) -> str:
+    """Return the function of the frame, with its file and first line."""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Statistical wall-clock profiler of all the threads of the process.
+
+    The stacks of the threads are sampled every `interval` seconds with
+    `sys._current_frames`, so the profiled code runs unmodified, and costs
+    nothing outside of a profile. Waiting threads are sampled too, in the
+    function they wait in.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        """Initialize the profiler."""
+        self.interval = interval
+        self.stacks: "collections.Counter[Tuple[str, ...]]" = collections.Counter()
+        self.samples = 0
+
+    def sample(self, ignore: Optional[int] = None) -> None:
+        """Sample the stacks of the threads, except the `ignore` one."""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=W0212
+            if ident == ignore:
+                continue
+            stack = []
+            current: Optional[FrameType] = frame
+            while current is not None:
+                stack.append(_frame_name(current))
+                current = current.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds: float) -> None:
+        """Sample the other threads for `seconds`, in the calling thread."""
+        ident = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while True:
+            self.sample(ignore=ident)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(self.interval, remaining))
+
+    def collapsed(self) -> str:
+        """Return the stacks in the collapsed format of flame graph tools."""
+        return "".join(
+            f"{';'.join(stack)} {count}\n" for stack, count in sorted(self.stacks.items())
+        )
+
+    def top(self) -> str:
+        """Return the flat profile: the samples in and under each function."""
+        own: "collections.Counter[str]" = collections.Counter()
+        cumulative: "collections.Counter[str]" = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack[1:]):
+                cumulative[name] += count
+        total = sum(self.stacks.values()) or 1
+        lines = [
+            f"{self.samples} samples every {self.interval * 1e3:.1f} ms, {total} stacks",
+            f"{'own':>8} {'own%':>7} {'cum':>8} {'cum%':>7}  function",
+        ]
+        for name in sorted(cumulative, key=lambda name: (-own[name], -cumulative[name], name)):
+            lines.append(
+                f"{own[name]:>8} {own[name] / total:>7.1%}"
+                f" {cumulative[name]:>8} {cumulative[name] / total:>7.1%}  {name}"
+            )
+        return "\n".join(lines) + "\n"
+
+
+def health_app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    """Report the exporter is up, without running the collectors."""
+    return _respond(start_response, "200 OK", "ok\n")
+
+
+def profile_app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    """Profile the threads for `seconds` and return the collapsed stacks or the flat profile."""
+    try:
+        seconds = _get_seconds(environ)
+        output = _get_query(environ, "format", "collapsed", PROFILE_FORMATS)
+    except ValueError as err:
+        return _respond(start_response, "400 Bad Request", f"{err}\n")
+    if not _session_lock.acquire(blocking=False):
+        return _respond(start_response, "409 Conflict", "Another debug session is running.\n")
+    try:
+        profiler = SamplingProfiler()
+        profiler.run(seconds)
+    finally:
+        _session_lock.release()
+    return _respond(
+        start_response, "200 OK", profiler.collapsed() if output == "collapsed" else profiler.top()
+    )
+
+
+def threads_app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    """Return the stacks of all the threads."""
+    frames = sys._current_frames()  # pylint: disable=W0212
+    lines = []
+    for thread in threading.enumerate():
+        lines.append(f"Thread {thread.name} (ident {thread.ident}, daemon {thread.daemon}):\n")
+        frame = frames.get(thread.ident)  # type: ignore[arg-type]
+        if frame is not None:
+            lines.extend(traceback.format_stack(frame))
+        lines.append("\n")
+    return _respond(start_response, "200 OK", "".join(lines))
+
+
+def tracemalloc_app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    """Trace the allocations for `seconds` and return the top ones still allocated.
+
+    The allocations are only traced during the request, unless tracing was
+    already started, e.g. with PYTHONTRACEMALLOC, in which case the snapshot
+    holds all the traced allocations.
+    """
+    try:
+        seconds = _get_seconds(environ)
+        key = _get_query(environ, "key", "lineno", TRACEMALLOC_KEYS)
+        limit = int(
+            parse_qs(environ.get("QUERY_STRING", "")).get("limit", [str(TOP_ALLOCATIONS)])[0]
+        )
+        if limit < 1:
+            raise ValueError("Parameter limit must be positive.")
+    except ValueError as err:
+        return _respond(start_response, "400 Bad Request", f"{err}\n")
+    if not _session_lock.acquire(blocking=False):
+        return _respond(start_response, "409 Conflict", "Another debug session is running.\n")
+    try:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            time.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+    finally:
+        _session_lock.release()
+    statistics = snapshot.filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    ).statistics(key)
+    lines = [f"Top {min(limit, len(statistics))} of {len(statistics)} allocations by {key}:"]
+    for statistic in statistics[:limit]:
+        lines.append(str(statistic))
+        if key == "traceback":
+            lines.extend(statistic.traceback.format())
+    return _respond(start_response, "200 OK", "\n".join(lines) + "\n")
+
+
+DEBUG_ROUTES: Dict[str, Callable] = {
+    "/healthz": health_app,
+    "/debug/profile": profile_app,
+    "/debug/threads": threads_app,
+    "/debug/tracemalloc": tracemalloc_app,
+}
+
+
+def debug_app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+    """Dispatch the request to the debug endpoint of its path."""
+    app = DEBUG_ROUTES.get(environ.get("PATH_INFO", ""))
+    if app is None:
+        return _respond(start_response, "404 Not Found", "Not found.\n")
+    return app(environ, start_response)
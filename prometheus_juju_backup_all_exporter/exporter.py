@@ -1,22 +1,149 @@
 """Module for j-b-a exporter."""
 
+import json
+import os
+import queue
+import socket
+import ssl
+import stat
 import threading
+import time
 from logging import getLogger
-from socketserver import ThreadingMixIn
-from typing import Any
+from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type
 from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 
-from prometheus_client import make_wsgi_app
+from prometheus_client import Counter, make_wsgi_app
 from prometheus_client.core import REGISTRY
-from prometheus_client.registry import Collector
+from prometheus_client.registry import Collector, CollectorRegistry
+
+from .core import ConcurrentCollectorRegistry
+from .debug import debug_app, health_app
+from .tls import ServerTLS
 
 logger = getLogger(__name__)
 
+# The first file descriptor passed by the service manager, see sd_listen_fds(3).
+SD_LISTEN_FDS_START = 3
+# The debug endpoints are only served on the loopback.
+DEBUG_ADDRESS = "127.0.0.1"
+
+DROPPED_SUBSCRIBERS = Counter(
+    "juju_backup_all_exporter_events_dropped_subscribers",
+    "The number of event stream clients dropped for not keeping up with the events.",
+)
+
+
+def inherited_sockets() -> List[socket.socket]:
+    """Return the listening sockets passed by the service manager.
+
+    Implements the LISTEN_FDS protocol of socket activation: the sockets are
+    passed as file descriptors starting at `SD_LISTEN_FDS_START`, and the
+    environment variables are unset so that child processes don't use them.
+
+    Returns:
+        The inherited sockets, or an empty list if the process was not socket activated.
+    """
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return []
+    count = int(os.environ.get("LISTEN_FDS", "0"))
+    for var in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(var, None)
+    return [
+        socket.socket(fileno=fd) for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count)
+    ]
+
 
 class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
     """A WSGI server that handle requests in a separate thread."""
 
     daemon_threads = True
+    tls: Optional[ServerTLS] = None
+
+    @classmethod
+    def from_socket(
+        cls, sock: socket.socket, handler_class: Type[BaseRequestHandler]
+    ) -> "ThreadingWSGIServer":
+        """Create a server on an already bound and listening socket."""
+        server = cls(sock.getsockname(), handler_class, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.setup_server_name()
+        return server
+
+    def server_bind(self) -> None:
+        """Bind the socket and set up the server name."""
+        TCPServer.server_bind(self)
+        self.setup_server_name()
+
+    def setup_server_name(self) -> None:
+        """Set up the server name and port used in the WSGI environ."""
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(str(host))
+        self.server_port = port
+        self.setup_environ()
+
+    def enable_tls(self, tls: ServerTLS) -> None:
+        """Serve over TLS."""
+        self.tls = tls
+        self.base_environ["HTTPS"] = "on"
+
+    def get_request(self) -> Tuple[socket.socket, Any]:
+        """Accept a connection, wrapping it with TLS if enabled."""
+        request, client_address = super().get_request()
+        if self.tls is not None:
+            request = self.tls.wrap(request)
+        return request, client_address
+
+    def finish_request(self, request: Any, client_address: Any) -> None:
+        """Do the TLS handshake, in the request thread, then handle the request."""
+        if isinstance(request, ssl.SSLSocket) and self.tls is not None:
+            try:
+                self.tls.handshake(request)
+            except OSError as err:
+                logger.debug("TLS handshake with %s failed: %s.", client_address, str(err))
+                return
+        super().finish_request(request, client_address)
+
+
+class UnixWSGIServer(ThreadingWSGIServer):
+    """A threading WSGI server listening on a Unix domain socket.
+
+    The socket file is removed when the server is closed, unless the socket
+    was passed by the service manager, which owns its file.
+    """
+
+    address_family = socket.AF_UNIX
+    bound_path: Optional[str] = None
+
+    def server_bind(self) -> None:
+        """Remove the stale socket file left by a previous run and bind the socket."""
+        path = str(self.server_address)
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        super().server_bind()
+        self.bound_path = path
+
+    def server_close(self) -> None:
+        """Close the socket and remove its file."""
+        super().server_close()
+        if self.bound_path is not None:
+            try:
+                os.unlink(self.bound_path)
+            except FileNotFoundError:
+                pass
+            self.bound_path = None
+
+    def setup_server_name(self) -> None:
+        """Set up the server name and port used in the WSGI environ."""
+        self.server_name = "localhost"
+        self.server_port = 0
+        self.setup_environ()
+
+    def get_request(self) -> Tuple[socket.socket, Any]:
+        """Accept a connection, with an empty client address as Unix peers have none."""
+        request, _ = self.socket.accept()
+        return request, ("", 0)
 
 
 class SlientRequestHandler(WSGIRequestHandler):
@@ -26,34 +153,240 @@ class SlientRequestHandler(WSGIRequestHandler):
         """Log nothing."""
 
 
+def make_debug_server(port: int) -> WSGIServer:
+    """Create the server of the debug endpoints, listening on the loopback only."""
+    return make_server(
+        DEBUG_ADDRESS,
+        port,
+        debug_app,
+        server_class=ThreadingWSGIServer,
+        handler_class=SlientRequestHandler,
+    )
+
+
+class _Subscriber:
+    """A client of the event stream, with its bounded queue of pending events."""
+
+    def __init__(self, size: int) -> None:
+        """Initialize the subscriber."""
+        self.queue: "queue.Queue[bytes]" = queue.Queue(size)
+        self.dropped = False
+
+
+class EventStream:
+    """Stream of the changes detected by the collectors, as server-sent events.
+
+    Every published record is encoded once and put in the bounded queue of
+    each client. A client whose queue is full is dropped, so a slow consumer
+    never delays the collectors or the other clients; it can reconnect.
+
+    The changes are only detected when the collectors run, so while clients
+    are connected, `poll` is called every `poll_interval` seconds to run them.
+    """
+
+    def __init__(
+        self,
+        poll: Optional[Callable[[], Any]] = None,
+        poll_interval: float = 1.0,
+        queue_size: int = 64,
+        keepalive: float = 15.0,
+    ) -> None:
+        """Initialize the stream.
+
+        Args:
+            poll: run the collectors while clients are connected.
+            poll_interval: seconds between the polls.
+            queue_size: the maximum number of events pending for a client.
+            keepalive: seconds without event before sending a comment, so that
+                the disconnected clients are detected.
+        """
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self._subscribers: Set[_Subscriber] = set()
+        self._lock = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
+        self._sequence = 0
+
+    def publish(self, record: Any) -> None:
+        """Send the record to all the clients, dropping the ones that fall behind."""
+        with self._lock:
+            self._sequence += 1
+            data = json.dumps(record._asdict(), separators=(",", ":"))
+            event = f"id: {self._sequence}\nevent: {record.kind}\ndata: {data}\n\n".encode()
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    subscriber.dropped = True
+                    self._subscribers.discard(subscriber)
+                    DROPPED_SUBSCRIBERS.inc()
+                    logger.warning("Dropped a slow event stream client.")
+
+    def subscribe(self) -> _Subscriber:
+        """Add a client, starting the poller if needed."""
+        subscriber = _Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self.poll is not None and self._poller is None:
+                self._poller = threading.Thread(target=self._run_poller, daemon=True)
+                self._poller.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber) -> None:
+        """Remove a client."""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run_poller(self) -> None:
+        """Poll the collectors until no client is connected."""
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None
+                    return
+            start = time.monotonic()
+            try:
+                self.poll()  # type: ignore[misc]
+            except Exception as err:  # pylint: disable=W0703
+                logger.error("Failed to poll the collectors: %s.", str(err))
+            time.sleep(max(0.0, self.poll_interval - (time.monotonic() - start)))
+
+    def _stream(self) -> Iterator[bytes]:
+        """Yield the events of a new client until it is dropped or disconnects."""
+        subscriber = self.subscribe()
+        try:
+            # sends the headers right away
+            yield b": connected\n\n"
+            while not subscriber.dropped:
+                try:
+                    yield subscriber.queue.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def app(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        """Serve the event stream."""
+        start_response(
+            "200 OK", [("Content-Type", "text/event-stream"), ("Cache-Control", "no-cache")]
+        )
+        return self._stream()
+
+
 class Exporter:
     """The exporter class."""
 
-    def __init__(self, port: int, addr: str = "0.0.0.0") -> None:
+    def __init__(
+        self,
+        port: int,
+        addr: str = "0.0.0.0",
+        registry: Optional[CollectorRegistry] = None,
+        unix_socket: Optional[str] = None,
+        tls: Optional[ServerTLS] = None,
+        debug_port: Optional[int] = None,
+    ) -> None:
         """Initialize the exporter class.
 
         Args:
             port: Start the exporter at this port.
             addr: Start the exporter at this address.
+            registry: Serve the metrics of this registry; the default process
+                and platform metrics are always included.
+            unix_socket: Also start the exporter at this Unix domain socket path.
+            tls: Serve over TLS on the TCP sockets; the Unix domain sockets,
+                which are local only, stay plain.
+            debug_port: Also serve the debug endpoints at this port of the
+                loopback, in plain HTTP; not served if not set.
         """
         self.addr = addr
         self.port = int(port)
-        self.app = make_wsgi_app()
+        self.unix_socket = unix_socket
+        self.tls = tls
+        self.debug_port = debug_port
+        self.servers: List[WSGIServer] = []
+        self.registry = registry if registry is not None else ConcurrentCollectorRegistry()
+        self.registry.register(REGISTRY)
+        self.metrics_app = make_wsgi_app(self.registry)
+        self.routes: Dict[str, Callable] = {"/healthz": health_app}
+
+    def add_route(self, path: str, app: Callable) -> None:
+        """Serve the WSGI app at the path; the other paths serve the metrics."""
+        self.routes[path] = app
+
+    def app(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+        """Dispatch the request to the app of its path."""
+        app = self.routes.get(environ.get("PATH_INFO", ""), self.metrics_app)
+        return app(environ, start_response)
 
     def register(self, collector: Collector) -> None:
         """Register collector to the exporter."""
-        REGISTRY.register(collector)
+        self.registry.register(collector)
+
+    def make_servers(self) -> List[WSGIServer]:
+        """Create the servers of the exporter.
+
+        If the service manager passed listening sockets (socket activation),
+        the exporter serves on them only. Otherwise, it listens on the TCP port
+        and, if configured, on the Unix domain socket.
+        """
+        sockets = inherited_sockets()
+        if sockets:
+            logger.info("Using %d socket(s) passed by the service manager.", len(sockets))
+            return [
+                (
+                    UnixWSGIServer if sock.family == socket.AF_UNIX else ThreadingWSGIServer
+                ).from_socket(sock, SlientRequestHandler)
+                for sock in sockets
+            ]
+
+        servers: List[WSGIServer] = [
+            make_server(
+                self.addr,
+                self.port,
+                self.app,
+                server_class=ThreadingWSGIServer,
+                handler_class=SlientRequestHandler,
+            )
+        ]
+        if self.unix_socket:
+            servers.append(
+                UnixWSGIServer(self.unix_socket, SlientRequestHandler)  # type: ignore[arg-type]
+            )
+        return servers
+
+    def shutdown(self) -> None:
+        """Stop the exporter servers, letting `run` return."""
+        for httpd in self.servers:
+            httpd.shutdown()
+            httpd.server_close()
 
     def run(self, daemon: bool = False) -> None:
-        """Start the exporter server."""
-        httpd = make_server(
-            self.addr,
-            self.port,
-            self.app,
-            server_class=ThreadingWSGIServer,
-            handler_class=SlientRequestHandler,
-        )
-        logger.info("Started promethesus juju-backup-all exporter at %s:%s.", self.addr, self.port)
-        thread = threading.Thread(target=httpd.serve_forever)
-        thread.daemon = daemon
-        thread.start()
+        """Start the exporter servers.
+
+        Args:
+            daemon: serve in daemon threads and return; otherwise, block until
+                the servers are shut down. The main thread must not return
+                while serving: the interpreter would shut down, and the thread
+                pool of the collectors would refuse to run them.
+        """
+        self.servers = self.make_servers()
+        for httpd in self.servers:
+            httpd.set_app(self.app)
+            if self.tls is not None and not isinstance(httpd, UnixWSGIServer):
+                httpd.enable_tls(self.tls)  # type: ignore[attr-defined]
+        if self.debug_port is not None:
+            self.servers.append(make_debug_server(self.debug_port))
+        threads = []
+        for httpd in self.servers:
+            logger.info(
+                "Started promethesus juju-backup-all exporter at %s.", httpd.server_address
+            )
+            thread = threading.Thread(target=httpd.serve_forever)
+            thread.daemon = daemon
+            thread.start()
+            threads.append(thread)
+        if not daemon:
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,228 @@
+"""Module for the history of the backup runs and events."""
+
+import json
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import parse_qs
+
+from .utils import BackupEventDelta, BackupRun
+
+logger = getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+INVALID_QUERY = (
+    f"limit must be in [1, {MAX_PAGE_SIZE}], cursor must be an integer and kind must be"
+    " either run or event."
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    time REAL NOT NULL,
+    duration REAL,
+    status_ok INTEGER,
+    result_code INTEGER,
+    failed INTEGER,
+    purged INTEGER,
+    completed INTEGER
+);
+-- a backup run seen again after a restart is not recorded twice
+CREATE UNIQUE INDEX IF NOT EXISTS history_kind_time ON history (kind, time);
+-- the pages of one kind are read by id, without sorting the whole kind
+CREATE INDEX IF NOT EXISTS history_kind_id ON history (kind, id);
+CREATE INDEX IF NOT EXISTS history_time ON history (time);
+"""
+
+INSERT = """
+INSERT OR IGNORE INTO history
+    (kind, time, duration, status_ok, result_code, failed, purged, completed)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+HistoryRecord = Union[BackupRun, BackupEventDelta]
+
+
+def _to_row(record: HistoryRecord) -> Tuple:
+    """Convert the record to a row of the history table."""
+    if isinstance(record, BackupRun):
+        return (
+            record.kind,
+            record.time,
+            record.duration,
+            record.status_ok,
+            record.result_code,
+            None,
+            None,
+            None,
+        )
+    return (
+        record.kind,
+        record.time,
+        None,
+        None,
+        None,
+        record.failed,
+        record.purged,
+        record.completed,
+    )
+
+
+class HistoryStore:
+    """Persistent history of the backup runs and events, in a SQLite database.
+
+    The records are buffered and inserted in batches, once `batch_size` of them
+    are pending or `flush_interval` seconds passed since the last insert. As
+    backups are rare, a timer inserts the pending records `flush_interval`
+    seconds after they were added, without waiting for the next record. The
+    records older than `retention` seconds are pruned on every insert.
+
+    The database is opened on first use, so the store can be created before
+    forking the process using it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retention: float,
+        batch_size: int = 100,
+        flush_interval: float = 5.0,
+    ) -> None:
+        """Initialize the store.
+
+        Args:
+            path: the database file.
+            retention: seconds the records are kept.
+            batch_size: the number of pending records triggering an insert.
+            flush_interval: the maximum seconds a record stays pending.
+        """
+        self.retention = retention
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[Tuple] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._timer: Optional[threading.Timer] = None
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """Return the database connection, opening the database and creating it if needed."""
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+            logger.info("Opened backup history database: %s.", self._path)
+        return self._db
+
+    def record(self, record: HistoryRecord) -> None:
+        """Add the record to the history."""
+        with self._lock:
+            self._pending.append(_to_row(record))
+            if (
+                len(self._pending) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Insert the pending records."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Insert the pending records and prune the expired ones; the lock must be held."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(INSERT, self._pending)
+            self._connection.execute(
+                "DELETE FROM history WHERE time < ?", (time.time() - self.retention,)
+            )
+        self._pending.clear()
+
+    def query(
+        self,
+        limit: int = DEFAULT_PAGE_SIZE,
+        before: Optional[int] = None,
+        kind: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Return a page of the history, most recent first.
+
+        Args:
+            limit: the maximum number of records returned.
+            before: only return the records with an id lower than this cursor.
+            kind: only return the records of this kind, "run" or "event".
+
+        Returns:
+            The records, and the cursor of the next page or None if it is the last one.
+        """
+        conditions = []
+        params: List[Any] = []
+        if before is not None:
+            conditions.append("id < ?")
+            params.append(before)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            self._flush()
+            rows = self._connection.execute(
+                f"SELECT * FROM history {where} ORDER BY id DESC LIMIT ?",  # nosec
+                (*params, limit + 1),
+            ).fetchall()
+        items = [{key: row[key] for key in row.keys() if row[key] is not None} for row in rows]
+        if len(items) > limit:
+            return items[:limit], items[limit - 1]["id"]
+        return items, None
+
+    def close(self) -> None:
+        """Insert the pending records and close the database."""
+        with self._lock:
+            self._flush()
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def make_history_app(store: HistoryStore) -> Callable:
+    """Create a WSGI app serving the history as JSON.
+
+    The query parameters are `limit`, the page size, `cursor`, the
+    `next_cursor` of the previous page, and `kind`, "run" or "event".
+    """
+
+    def app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+        try:
+            limit = int(params.get("limit", [DEFAULT_PAGE_SIZE])[0])
+            cursor = params.get("cursor", [None])[0]
+            before = int(cursor) if cursor is not None else None
+            kind = params.get("kind", [None])[0]
+            if not 1 <= limit <= MAX_PAGE_SIZE or kind not in (None, "run", "event"):
+                raise ValueError
+        except ValueError:
+            start_response("400 Bad Request", [("Content-Type", "application/json")])
+            return [json.dumps({"error": INVALID_QUERY}).encode()]
+        items, next_cursor = store.query(limit=limit, before=before, kind=kind)
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps({"items": items, "next_cursor": next_cursor}).encode()]
+
+    return app
@@ -0,0 +1,148 @@
+"""Module for running the collectors once, outside of the exporter server."""
+
+import logging
+import statistics
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, DefaultDict, Iterable, List, Tuple
+
+from prometheus_client import generate_latest
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from .collector import BackupEventCollector, BackupStatsCollector
+from .config import Config
+from .core import BlockingCollector, ConcurrentCollectorRegistry
+from .storage import make_storage
+
+
+def make_registry(config: Config, remove_events: bool = True) -> ConcurrentCollectorRegistry:
+    """Create a registry of the backup collectors, without the process metrics."""
+    registry = ConcurrentCollectorRegistry(
+        max_workers=config.collect_workers, timeout=config.collect_timeout
+    )
+    storage = make_storage(config)
+    registry.register(BackupStatsCollector(config, storage=storage))
+    registry.register(BackupEventCollector(config, remove_events=remove_events, storage=storage))
+    return registry
+
+
+def render(config: Config, remove_events: bool = False) -> bytes:
+    """Run the collectors once and return the exposition.
+
+    Args:
+        config: the exporter configuration.
+        remove_events: remove the event file once read, as a scrape does; the
+            events are then no longer counted by a running exporter.
+    """
+    return generate_latest(make_registry(config, remove_events=remove_events))
+
+
+class Timings:
+    """Durations of the phases of the collection cycles, recorded from any thread."""
+
+    def __init__(self) -> None:
+        """Initialize the timings."""
+        self.cycles = 0
+        self.durations: DefaultDict[Tuple[str, str], List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, scope: str, phase: str, duration: float) -> None:
+        """Record the duration, in seconds, of a phase."""
+        with self._lock:
+            self.durations[(scope, phase)].append(duration)
+
+    def timed(self, scope: str, phase: str, func: Callable) -> Callable:
+        """Wrap the function to record the duration of its calls."""
+
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(scope, phase, time.perf_counter() - start)
+
+        return wrapper
+
+    def report(self) -> str:
+        """Return the breakdown of the timings, in milliseconds."""
+        lines = [
+            f"{self.cycles} cycles",
+            f"{'scope':<24} {'phase':<10} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}",
+        ]
+        for (scope, phase), durations in self.durations.items():
+            durations = sorted(durations)
+            p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))]
+            lines.append(
+                f"{scope:<24} {phase:<10} {statistics.mean(durations) * 1e3:>10.3f}"
+                f" {statistics.median(durations) * 1e3:>10.3f} {p99 * 1e3:>10.3f}"
+                f" {durations[-1] * 1e3:>10.3f}"
+            )
+        return "\n".join(lines)
+
+
+def instrument(collector: BlockingCollector, timings: Timings) -> None:
+    """Record the duration of the fetch, process and collect phases of the collector."""
+    scope = type(collector).__name__
+    collector.fetch = timings.timed(scope, "fetch", collector.fetch)  # type: ignore
+    collector.process = timings.timed(scope, "process", collector.process)  # type: ignore
+    collect = collector.collect
+    # collect is a generator, time it until exhausted
+    collector.collect = timings.timed(scope, "collect", lambda: list(collect()))  # type: ignore
+
+
+class _CollectedMetrics(Collector):
+    """Collector yielding already collected metrics, to time their rendering alone."""
+
+    def __init__(self, metrics: List[Metric]) -> None:
+        """Initialize the collector."""
+        self.metrics = metrics
+
+    def collect(self) -> Iterable[Metric]:
+        """Return the collected metrics."""
+        return self.metrics
+
+
+def run_bench(config: Config, cycles: int) -> Timings:
+    """Run the collection and render cycles and time their phases.
+
+    The backup directory is left untouched: the event file is not removed. The
+    problems with the backup files are only logged during the first cycle.
+
+    Args:
+        config: the configuration of the collectors.
+        cycles: the number of collection and render cycles.
+
+    Returns:
+        The timings per collector and per phase.
+    """
+    timings = Timings()
+    registry = ConcurrentCollectorRegistry(max_workers=config.collect_workers)
+    storage = make_storage(config)
+    for collector in (
+        BackupStatsCollector(config, storage=storage),
+        BackupEventCollector(config, remove_events=False, storage=storage),
+    ):
+        instrument(collector, timings)
+        registry.register(collector)
+    try:
+        for _ in range(cycles):
+            _run_cycle(registry, timings)
+            logging.disable(logging.CRITICAL)
+    finally:
+        logging.disable(logging.NOTSET)
+    return timings
+
+
+def _run_cycle(registry: ConcurrentCollectorRegistry, timings: Timings) -> None:
+    """Run a collection and render cycle and time its phases."""
+    start = time.perf_counter()
+    metrics = list(registry.collect())
+    collected = time.perf_counter()
+    generate_latest(_CollectedMetrics(metrics))
+    rendered = time.perf_counter()
+    timings.add("cycle", "collect", collected - start)
+    timings.add("cycle", "render", rendered - collected)
+    timings.add("cycle", "total", rendered - start)
+    timings.cycles += 1
@@ -0,0 +1,409 @@
+"""Module for the pre-fork multi-worker exporter."""
+
+import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from logging import getLogger
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from urllib.parse import parse_qs
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, generate_latest
+from prometheus_client.registry import CollectorRegistry
+
+from .debug import health_app
+from .exporter import SlientRequestHandler, ThreadingWSGIServer, make_debug_server
+from .tls import TLS_HANDSHAKE_ERRORS, TLS_HANDSHAKES, TLS_RELOADS, ServerTLS
+
+logger = getLogger(__name__)
+
+# Seconds between the checks that the parent process is still alive, which is
+# also how often the workers publish their counters.
+PARENT_CHECK_INTERVAL = 1.0
+# The counters incremented in the worker processes.
+WORKER_COUNTERS = (TLS_HANDSHAKES, TLS_HANDSHAKE_ERRORS, TLS_RELOADS)
+# The maximum size in bytes of the counters published by a worker.
+WORKER_COUNTERS_SIZE = 64 * 1024
+# The routes of the single-process exporter that are not served in this mode.
+UNSUPPORTED_ROUTES = frozenset(["/api/history", "/events"])
+
+# (counter index, sorted label pairs) of a counter sample
+CounterKey = Tuple[int, Tuple[Tuple[str, str], ...]]
+
+
+class SharedExposition:
+    """Rendered exposition shared between processes through a memory mapping.
+
+    A single writer publishes the exposition, and any number of readers in
+    other processes read it without locking, using a seqlock: the writer makes
+    the sequence number odd while it writes and even once done, and a reader
+    retries when the sequence number is odd or changed during its read.
+
+    The mapping is anonymous and shared, so it must be created before forking
+    the processes using it.
+    """
+
+    # sequence number, exposition length, time the exposition was rendered
+    HEADER = struct.Struct("=QQd")
+
+    def __init__(self, size: int) -> None:
+        """Initialize the shared memory.
+
+        Args:
+            size: the maximum size of the exposition in bytes.
+        """
+        self.size = size
+        self._mmap = mmap.mmap(-1, self.HEADER.size + size)
+
+    def write(self, data: bytes) -> None:
+        """Publish the exposition.
+
+        Raises:
+            ValueError: the exposition is larger than the shared memory.
+        """
+        if len(data) > self.size:
+            raise ValueError(f"Exposition of {len(data)} bytes exceeds {self.size} bytes.")
+        sequence, length, rendered_at = self.HEADER.unpack_from(self._mmap)
+        self.HEADER.pack_into(self._mmap, 0, sequence + 1, length, rendered_at)
+        end = self.HEADER.size + len(data)
+        self._mmap[self.HEADER.size : end] = data  # noqa: E203
+        self.HEADER.pack_into(self._mmap, 0, sequence + 2, len(data), time.time())
+
+    def read(self) -> Optional[bytes]:
+        """Return the published exposition, or None if nothing was published yet.
+
+        The exposition is copied out of the mapping once per read: the copy is
+        what the seqlock validates, and the writer may overwrite the mapping
+        as soon as the read is done.
+        """
+        while True:
+            sequence, length, _ = self.HEADER.unpack_from(self._mmap)
+            if sequence == 0:
+                return None
+            if sequence % 2 == 0:
+                data = self._mmap[self.HEADER.size : self.HEADER.size + length]  # noqa: E203
+                if self.HEADER.unpack_from(self._mmap)[0] == sequence:
+                    return data
+            time.sleep(0)
+
+    @property
+    def rendered_at(self) -> float:
+        """Return the time the exposition was rendered."""
+        return self.HEADER.unpack_from(self._mmap)[2]
+
+
+class WorkerCounters:
+    """Counters incremented by the worker processes, added up by the collector process.
+
+    The exposition is rendered by the collector process, so its copies of the
+    counters incremented in the workers, e.g. of the TLS handshakes, would
+    stay at their value at fork time. Each worker publishes the increments of
+    its counters since it was forked to its own `SharedExposition`, and the
+    collector process adds them to its copies before rendering.
+
+    The mappings are anonymous and shared, so they must be created before
+    forking the processes using them.
+    """
+
+    def __init__(
+        self, counters: Sequence[Counter], workers: int, size: int = WORKER_COUNTERS_SIZE
+    ) -> None:
+        """Initialize the shared memory of the workers.
+
+        Args:
+            counters: the counters incremented by the workers.
+            workers: the number of worker processes.
+            size: the maximum size in bytes of the counters published by a worker.
+        """
+        self.counters = list(counters)
+        self._slots = [SharedExposition(size) for _ in range(workers)]
+        # the values at fork time in a worker, and the increments added in the collector
+        self._baseline: Dict[CounterKey, float] = {}
+        self._added: Dict[CounterKey, float] = {}
+
+    def _values(self) -> Dict[CounterKey, float]:
+        """Return the values of the counters in this process."""
+        return {
+            (index, tuple(sorted(sample.labels.items()))): sample.value
+            for index, counter in enumerate(self.counters)
+            for metric in counter.collect()
+            for sample in metric.samples
+            if sample.name.endswith("_total")
+        }
+
+    def start_worker(self) -> None:
+        """Take the values of the counters in a new worker as the baseline of its increments."""
+        self._baseline = self._values()
+
+    def publish(self, worker: int) -> None:
+        """Publish the increments of the counters of the worker since it started."""
+        increments = [
+            [index, labels, value - self._baseline.get((index, labels), 0.0)]
+            for (index, labels), value in self._values().items()
+        ]
+        self._slots[worker].write(json.dumps(increments).encode())
+
+    def aggregate(self) -> None:
+        """Add the increments published by the workers since the last call to the counters."""
+        totals: Dict[CounterKey, float] = {}
+        for slot in self._slots:
+            data = slot.read()
+            for index, labels, value in json.loads(data) if data else []:
+                key = (index, tuple((name, label) for name, label in labels))
+                totals[key] = totals.get(key, 0.0) + value
+        for key, total in totals.items():
+            increment = total - self._added.get(key, 0.0)
+            if increment > 0:
+                index, labels = key
+                counter = self.counters[index]
+                (counter.labels(**dict(labels)) if labels else counter).inc(increment)
+                self._added[key] = total
+
+
+class ReusePortWSGIServer(ThreadingWSGIServer):
+    """A threading WSGI server sharing its port with the other workers.
+
+    With SO_REUSEPORT, every worker binds its own listening socket to the same
+    port and the kernel balances the connections between them.
+    """
+
+    def server_bind(self) -> None:
+        """Enable SO_REUSEPORT and bind the socket."""
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def restrict_exposition(data: bytes, names: Set[str]) -> bytes:
+    """Return the exposition with only the named samples, as for the `name[]` parameters.
+
+    As with `prometheus_client`, a metric family is kept, with its metadata,
+    if any of its samples is.
+    """
+    wanted = {name.encode() for name in names}
+    lines: List[bytes] = []
+    metadata: List[bytes] = []
+    for line in data.splitlines(keepends=True):
+        if line.startswith(b"#"):
+            if line.startswith(b"# HELP "):
+                metadata = []
+            metadata.append(line)
+        elif line.split(b"{", 1)[0].split(b" ", 1)[0] in wanted:
+            lines.extend(metadata)
+            metadata = []
+            lines.append(line)
+    return b"".join(lines)
+
+
+def make_shared_app(shared: SharedExposition) -> Callable:
+    """Create a WSGI app serving the shared exposition."""
+
+    def app(environ: dict, start_response: Callable) -> Iterable[bytes]:
+        path = environ.get("PATH_INFO")
+        if path == "/healthz":
+            return health_app(environ, start_response)
+        if path in UNSUPPORTED_ROUTES:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not served in pre-fork mode.\n"]
+        data = shared.read()
+        if data is None:
+            start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
+            return [b"No metrics collected yet.\n"]
+        names = parse_qs(environ.get("QUERY_STRING", "")).get("name[]")
+        if names:
+            data = restrict_exposition(data, set(names))
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE_LATEST)])
+        return [data]
+
+    return app
+
+
+def _reset_signals() -> None:
+    """Let SIGTERM terminate the child process, instead of the parent's handler."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _exit_on_signal(signum: int, _: Any) -> None:
+    """Exit the process, running the cleanups."""
+    sys.exit(128 + signum)
+
+
+def _run_collector(
+    registry: CollectorRegistry,
+    shared: SharedExposition,
+    interval: float,
+    parent_pid: int,
+    debug_port: Optional[int] = None,
+    on_exit: Optional[Callable[[], None]] = None,
+    counters: Optional[WorkerCounters] = None,
+) -> None:
+    """Collect and publish the metrics every interval until the parent process is gone.
+
+    The debug endpoints, if enabled, are served by this process, which runs
+    the collectors. `on_exit` is called when the process exits or is
+    terminated, as the collectors' listeners run in this process. The
+    `counters` of the workers are added up before each rendering.
+    """
+    _reset_signals()
+    if on_exit is not None:
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+    if debug_port is not None:
+        httpd = make_debug_server(debug_port)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        while os.getppid() == parent_pid:
+            start = time.monotonic()
+            try:
+                if counters is not None:
+                    counters.aggregate()
+                shared.write(generate_latest(registry))
+            except Exception as err:  # pylint: disable=W0703
+                logger.error("Failed to publish the metrics: %s.", str(err))
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+    finally:
+        if on_exit is not None:
+            on_exit()
+
+
+def _run_worker(
+    addr: str,
+    port: int,
+    shared: SharedExposition,
+    parent_pid: int,
+    tls: Optional[ServerTLS] = None,
+    counters: Optional[WorkerCounters] = None,
+    worker: int = 0,
+) -> None:
+    """Serve the shared exposition until the parent process is gone.
+
+    The increments of the `counters` are published as the `worker`-th worker
+    every `PARENT_CHECK_INTERVAL` seconds.
+    """
+    _reset_signals()
+    if counters is not None:
+        counters.start_worker()
+    httpd = ReusePortWSGIServer((addr, port), SlientRequestHandler)
+    httpd.set_app(make_shared_app(shared))
+    if tls is not None:
+        httpd.enable_tls(tls)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    while os.getppid() == parent_pid:
+        if counters is not None:
+            counters.publish(worker)
+        time.sleep(PARENT_CHECK_INTERVAL)
+
+
+class PreforkExporter:
+    """The pre-fork multi-worker exporter.
+
+    A single collector process renders the exposition every `interval` seconds
+    into shared memory, and `workers` worker processes serve it on the same port.
+    The workers do no collection work, so the throughput scales with the cores.
+
+    The `WORKER_COUNTERS`, incremented by the workers, are added up by the
+    collector process, so the exposition counts the TLS handshakes of all
+    the workers.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        registry: CollectorRegistry,
+        workers: int,
+        addr: str = "0.0.0.0",
+        interval: float = 15.0,
+        buffer_size: int = 16 * 1024 * 1024,
+        tls: Optional[ServerTLS] = None,
+        debug_port: Optional[int] = None,
+        on_exit: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Initialize the exporter.
+
+        Args:
+            port: Start the workers at this port.
+            registry: Serve the metrics of this registry.
+            workers: the number of worker processes.
+            addr: Start the workers at this address.
+            interval: seconds between the collections.
+            buffer_size: the maximum size of the exposition in bytes.
+            tls: Serve over TLS. The SSL context is created before forking, so
+                all the workers share its session ticket keys and resume the
+                sessions started with the other workers.
+            debug_port: Serve the debug endpoints of the collector process at
+                this port of the loopback; not served if not set.
+            on_exit: called by the collector process when it exits, e.g. to
+                close the stores of the collectors' listeners.
+        """
+        self.addr = addr
+        self.port = int(port)
+        self.registry = registry
+        self.workers = workers
+        self.interval = interval
+        self.shared = SharedExposition(buffer_size)
+        self.tls = tls
+        self.debug_port = debug_port
+        self.on_exit = on_exit
+        self.counters = WorkerCounters(WORKER_COUNTERS, workers)
+        self.processes: List[BaseProcess] = []
+        self._stopping = False
+
+    def start(self) -> None:
+        """Fork the collector and the worker processes."""
+        context = multiprocessing.get_context("fork")
+        parent_pid = os.getpid()
+        self.processes = [
+            context.Process(
+                target=_run_collector,
+                args=(
+                    self.registry,
+                    self.shared,
+                    self.interval,
+                    parent_pid,
+                    self.debug_port,
+                    self.on_exit,
+                    self.counters,
+                ),
+                name="collector",
+            )
+        ]
+        self.processes.extend(
+            context.Process(
+                target=_run_worker,
+                args=(self.addr, self.port, self.shared, parent_pid, self.tls, self.counters, i),
+                name=f"worker-{i}",
+            )
+            for i in range(self.workers)
+        )
+        for process in self.processes:
+            process.start()
+        logger.info(
+            "Started promethesus juju-backup-all exporter at %s:%s with %d workers.",
+            self.addr,
+            self.port,
+            self.workers,
+        )
+
+    def stop(self, *_: Any) -> None:
+        """Terminate the collector and the worker processes."""
+        self._stopping = True
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def run(self) -> None:
+        """Start the exporter and wait until it is stopped or a process dies."""
+        signal.signal(signal.SIGTERM, self.stop)
+        self.start()
+        multiprocessing.connection.wait([process.sentinel for process in self.processes])
+        if not self._stopping:
+            logger.error("A child process exited, stopping the exporter.")
+            self.stop()
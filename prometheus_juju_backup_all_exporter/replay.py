@@ -0,0 +1,379 @@
+"""Module for recording and replaying timelines of the backup directory."""
+
+import http.client
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Union
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from .config import Config
+from .exporter import Exporter
+from .oneshot import make_registry
+from .snapshot import EVENT_FILE, STATS_FILE
+from .storage import Storage
+from .utils import DecodeError, EventRecord, StatsRecord, decode_record
+
+EVENT_COUNTERS = ("failed", "purged", "completed")
+STATS_GAUGE = "juju_backup_all_command_duration_seconds"
+
+
+class FileWrite(NamedTuple):
+    """Write of a state file, in place, `time` seconds after the start of the timeline.
+
+    The file is truncated then written, so a reader may see it empty or
+    half-written, as with the backup command.
+    """
+
+    time: float
+    name: str
+    data: str
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of the operation."""
+        return "write"
+
+
+class EventBatch(NamedTuple):
+    """Backup events produced `time` seconds after the start of the timeline."""
+
+    time: float
+    failed: int
+    purged: int
+    completed: int
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of the operation."""
+        return "events"
+
+
+TimelineOp = Union[FileWrite, EventBatch]
+
+
+def save_timeline(timeline: Iterable[TimelineOp], path: str) -> None:
+    """Save the timeline as JSON lines."""
+    with open(path, "w", encoding="utf-8") as file:
+        for op in timeline:
+            file.write(json.dumps({"kind": op.kind, **op._asdict()}) + "\n")
+
+
+def load_timeline(path: str) -> List[TimelineOp]:
+    """Load a timeline saved as JSON lines, sorted by time.
+
+    Raises:
+        ValueError: the timeline is invalid.
+    """
+    timeline: List[TimelineOp] = []
+    with open(path, "r", encoding="utf-8") as file:
+        for number, line in enumerate(file, 1):
+            try:
+                fields = json.loads(line)
+                kind = fields.pop("kind")
+                timeline.append(FileWrite(**fields) if kind == "write" else EventBatch(**fields))
+            except (ValueError, KeyError, TypeError) as err:
+                raise ValueError(f"Invalid timeline operation at line {number}: {err}.") from err
+    return sorted(timeline, key=lambda op: op.time)
+
+
+def record_timeline(storage: Storage, duration: float, interval: float = 1.0) -> List[TimelineOp]:
+    """Record the changes of the state files of the backup directory.
+
+    The directory is polled every `interval` seconds, and left untouched. A
+    new version of the backup stats file is recorded as it is, half-written or
+    not. A new version of the backup event file is recorded as a batch of
+    events once it can be decoded.
+
+    Args:
+        storage: the storage of the backup directory.
+        duration: seconds to record.
+        interval: seconds between the polls.
+
+    Returns:
+        The timeline.
+    """
+    timeline: List[TimelineOp] = []
+    versions: Dict[str, Optional[str]] = {}
+    start = time.monotonic()
+    while True:
+        now = time.monotonic() - start
+        snapshot = storage.take_snapshot()
+        for name in (STATS_FILE, EVENT_FILE):
+            entry = snapshot.entry(name)
+            version = entry.version if entry is not None else None
+            if name not in snapshot.contents or version == versions.get(name):
+                continue
+            data = snapshot.contents[name]
+            if name == STATS_FILE:
+                timeline.append(FileWrite(now, name, data.decode("utf-8", "surrogateescape")))
+            else:
+                try:
+                    record = decode_record(data, EventRecord)
+                except DecodeError:
+                    continue
+                timeline.append(EventBatch(now, record.failed, record.purged, record.completed))
+            versions[name] = version
+        if now >= duration:
+            return timeline
+        time.sleep(min(interval, max(0.0, duration - now)))
+
+
+def generate_timeline(
+    runs: int, run_interval: float = 3600.0, targets: int = 0, seed: int = 0
+) -> List[TimelineOp]:
+    """Generate a synthetic timeline of backup runs.
+
+    Every run rewrites the backup stats file, a third of them leaving it
+    half-written for a while, and produces batches of events spread over up to
+    two run intervals, so the runs overlap.
+
+    Args:
+        runs: the number of backup runs.
+        run_interval: seconds between the backup runs.
+        targets: the number of per-target entries of the backup stats file.
+        seed: the seed of the random generator, so the timeline is reproducible.
+
+    Returns:
+        The timeline, sorted by time.
+    """
+    rng = random.Random(seed)
+    timeline: List[TimelineOp] = []
+    for run in range(runs):
+        start = run * run_interval
+        duration = round(rng.uniform(10.0, 600.0), 3)
+        stats: Dict[str, Any] = {
+            "duration": duration,
+            "status_ok": int(rng.random() < 0.9),
+            "result_code": rng.choice([0, 0, 0, 1, 2]),
+        }
+        if targets:
+            stats["targets"] = [
+                {
+                    "controller": f"controller-{i % 10}",
+                    "model": f"model-{i}",
+                    "duration": round(rng.uniform(1.0, 60.0), 3),
+                    "status_ok": 1,
+                    "result_code": 0,
+                }
+                for i in range(targets)
+            ]
+        data = json.dumps(stats)
+        # the backup command takes a fraction of the run interval
+        end = start + duration * run_interval / 1000
+        if rng.random() < 1 / 3:
+            timeline.append(FileWrite(start, STATS_FILE, data[: len(data) // 2]))
+        timeline.append(FileWrite(end, STATS_FILE, data))
+        for _ in range(rng.randint(1, 3)):
+            timeline.append(
+                EventBatch(
+                    start + rng.uniform(0.0, 2 * run_interval),
+                    failed=rng.randint(0, 2),
+                    purged=rng.randint(0, 5),
+                    completed=rng.randint(0, 10),
+                )
+            )
+    return sorted(timeline, key=lambda op: op.time)
+
+
+class _Producer:
+    """Writer of the backup directory, applying the operations of a timeline.
+
+    The batches of events are added to the pending events, and the pending
+    events are written to the event file only when it is absent: the exporter
+    removes the file it read unless it was replaced, so every event is counted
+    exactly once. The file is created atomically, with a hard link.
+    """
+
+    def __init__(self, backup_path: str) -> None:
+        """Initialize the producer."""
+        self.backup_path = backup_path
+        self.pending = [0, 0, 0]
+        self._lock = threading.Lock()
+
+    def apply(self, op: TimelineOp) -> None:
+        """Apply the operation to the backup directory."""
+        if isinstance(op, FileWrite):
+            with open(os.path.join(self.backup_path, op.name), "wb") as file:
+                file.write(op.data.encode("utf-8", "surrogateescape"))
+            return
+        with self._lock:
+            self.pending = [
+                total + getattr(op, name) for total, name in zip(self.pending, EVENT_COUNTERS)
+            ]
+        self.flush()
+
+    def flush(self) -> bool:
+        """Write the pending events if the event file is absent.
+
+        Returns:
+            True if no events are pending and the event file was consumed.
+        """
+        event_file = os.path.join(self.backup_path, EVENT_FILE)
+        with self._lock:
+            if not any(self.pending):
+                return not os.path.exists(event_file)
+            tmp_file = f"{event_file}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as file:
+                json.dump(dict(zip(EVENT_COUNTERS, self.pending)), file)
+            try:
+                os.link(tmp_file, event_file)
+                self.pending = [0, 0, 0]
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp_file)
+        return False
+
+    def run(self, timeline: List[TimelineOp], start: float, speed: float) -> None:
+        """Apply the operations at their time, divided by speed."""
+        for op in timeline:
+            while time.monotonic() < start + op.time / speed:
+                self.flush()
+                time.sleep(min(0.01, max(0.0, start + op.time / speed - time.monotonic())))
+            self.apply(op)
+
+
+class ReplayReport:
+    """Results of the replay of a timeline."""
+
+    def __init__(self, operations: int) -> None:
+        """Initialize the report."""
+        self.operations = operations
+        self.latencies: List[float] = []
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.failures: List[str] = []
+
+    @property
+    def ok(self) -> bool:
+        """Return if all the invariants held."""
+        return not self.failures
+
+    def report(self) -> str:
+        """Return the summary of the replay, with the latencies in milliseconds."""
+        latencies = sorted(self.latencies) or [0.0]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        lines = [
+            f"{len(self.latencies)} scrapes, {self.operations} operations",
+            f"wall {self.wall_seconds:.3f} s, cpu {self.cpu_seconds:.3f} s",
+            f"{'scrape':<24} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}",
+            f"{'latency':<24} {statistics.mean(latencies) * 1e3:>10.3f}"
+            f" {statistics.median(latencies) * 1e3:>10.3f} {p99 * 1e3:>10.3f}"
+            f" {latencies[-1] * 1e3:>10.3f}",
+        ]
+        lines.extend(f"FAILED: {failure}" for failure in self.failures)
+        lines.append("invariants: ok" if self.ok else "invariants: failed")
+        return "\n".join(lines)
+
+
+def _scrape(address: tuple) -> Dict[str, float]:
+    """Scrape the exporter and return the values of the samples without labels.
+
+    Raises:
+        OSError: the scrape failed.
+    """
+    connection = http.client.HTTPConnection(address[0], address[1], timeout=30)
+    try:
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        body = response.read().decode()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise OSError(f"Scrape returned HTTP {response.status}.")
+    return {
+        sample.name: sample.value
+        for family in text_string_to_metric_families(body)
+        for sample in family.samples
+    }
+
+
+def _expected_stats_duration(timeline: List[TimelineOp]) -> Optional[float]:
+    """Return the duration of the last write of the backup stats file, if it is valid."""
+    writes = [op for op in timeline if isinstance(op, FileWrite) and op.name == STATS_FILE]
+    if not writes:
+        return None
+    try:
+        return decode_record(
+            writes[-1].data.encode("utf-8", "surrogateescape"), StatsRecord
+        ).duration
+    except DecodeError:
+        return None
+
+
+def replay(
+    timeline: List[TimelineOp],
+    backup_path: str,
+    speed: float = 1.0,
+    scrape_interval: float = 15.0,
+    settle_timeout: float = 10.0,
+) -> ReplayReport:
+    """Replay the timeline against the collectors served over HTTP.
+
+    The operations are applied to the backup directory at their time divided
+    by `speed`, while the exporter is scraped every `scrape_interval` divided
+    by `speed`. Once the timeline is over, the exporter is scraped until all
+    the events are consumed, then the invariants are checked: the event
+    counters equal the totals of the timeline exactly, and the duration of the
+    command is the one of the last backup stats file.
+
+    The CPU time is the one of the process, so it includes the producer and
+    the scraper.
+
+    Args:
+        timeline: the operations, sorted by time.
+        backup_path: an empty directory to replay the timeline into.
+        speed: the acceleration of the timeline.
+        scrape_interval: seconds between the scrapes, in timeline time.
+        settle_timeout: seconds to wait for the events to be consumed.
+
+    Returns:
+        The report of the replay.
+    """
+    report = ReplayReport(len(timeline))
+    config = Config(backup_path=backup_path, history_file=None)
+    exporter = Exporter(0, addr="127.0.0.1", registry=make_registry(config))
+    exporter.run(daemon=True)
+    address = exporter.servers[0].server_address
+    producer = _Producer(backup_path)
+    start, cpu_start = time.monotonic(), time.process_time()
+    thread = threading.Thread(target=producer.run, args=(timeline, start, speed), daemon=True)
+    thread.start()
+    deadline = None
+    samples: Dict[str, float] = {}
+    try:
+        while True:
+            scrape_start = time.monotonic()
+            samples = _scrape(address)
+            report.latencies.append(time.monotonic() - scrape_start)
+            if not thread.is_alive():
+                if producer.flush():
+                    break
+                deadline = deadline or time.monotonic() + settle_timeout
+                if time.monotonic() > deadline:
+                    report.failures.append("events still pending after the timeline")
+                    break
+            time.sleep(max(0.0, scrape_start + scrape_interval / speed - time.monotonic()))
+        samples = _scrape(address)
+    finally:
+        report.wall_seconds = time.monotonic() - start
+        report.cpu_seconds = time.process_time() - cpu_start
+        for server in exporter.servers:
+            server.shutdown()
+            server.server_close()
+
+    for name in EVENT_COUNTERS:
+        expected = sum(getattr(op, name) for op in timeline if isinstance(op, EventBatch))
+        observed = samples.get(f"juju_backup_all_backup_{name}_total")
+        if observed != expected:
+            report.failures.append(f"{name} total is {observed}, expected {expected}")
+    duration = _expected_stats_duration(timeline)
+    observed = samples.get(STATS_GAUGE)
+    if duration is not None and observed != duration:
+        report.failures.append(f"command duration is {observed}, expected {duration}")
+    return report
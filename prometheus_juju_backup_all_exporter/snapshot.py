@@ -0,0 +1,81 @@
+"""Module for the snapshot of the backup directory."""
+
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Mapping, NamedTuple, Optional
+
+from .core import current_cycle
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .storage import Storage
+
+STATS_FILE = "backup_stats.json"
+EVENT_FILE = "backup_state.json"
+
+# The state files read into the snapshot, and the maximum size read from each.
+STATE_FILES = (STATS_FILE, EVENT_FILE)
+MAX_STATE_FILE_SIZE = 16 * 1024 * 1024
+
+
+class Entry(NamedTuple):
+    """Metadata of an entry of the backup directory."""
+
+    size: int
+    mtime: float
+    # changes whenever the entry is replaced: the (inode, modification time,
+    # size) of a file, the ETag of an object
+    version: str
+
+
+class FileTooLargeError(OSError):
+    """State file is larger than the snapshot reads."""
+
+
+class DirectorySnapshot:
+    """Immutable view of the backup directory.
+
+    The snapshot is taken by the storage of the directory with a single
+    listing. It holds the metadata of all the entries and the contents of the
+    state files, so the collectors don't need to access the storage themselves.
+    """
+
+    __slots__ = ("storage", "entries", "contents", "errors")
+
+    def __init__(
+        self,
+        storage: "Storage",
+        entries: Mapping[str, Entry],
+        contents: Mapping[str, bytes],
+        errors: Mapping[str, OSError],
+    ) -> None:
+        """Initialize the snapshot.
+
+        Args:
+            storage: the storage of the backup directory.
+            entries: the metadata of each directory entry.
+            contents: the contents of the state files.
+            errors: the errors raised while reading the state files.
+        """
+        self.storage = storage
+        self.entries = MappingProxyType(dict(entries))
+        self.contents = MappingProxyType(dict(contents))
+        self.errors = MappingProxyType(dict(errors))
+
+    def join(self, name: str) -> str:
+        """Return the location of the entry."""
+        return self.storage.join(name)
+
+    def entry(self, name: str) -> Optional[Entry]:
+        """Return the metadata of the entry, or None if it does not exist."""
+        return self.entries.get(name)
+
+
+def get_snapshot(storage: "Storage") -> DirectorySnapshot:
+    """Return the snapshot of the directory for the current collection cycle.
+
+    All the collectors running in the same cycle share one snapshot. Outside
+    a cycle, a new snapshot is taken.
+    """
+    cycle = current_cycle()
+    if cycle is None:
+        return storage.take_snapshot()
+    return cycle.get_or_create(("snapshot", storage.location), storage.take_snapshot)
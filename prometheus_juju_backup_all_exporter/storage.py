@@ -0,0 +1,545 @@
+"""Module for the storage backends of the backup directory."""
+
+import hashlib
+import hmac
+import http.client
+import os
+import queue
+import ssl
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+from prometheus_client import Counter
+
+from .config import Config
+from .snapshot import MAX_STATE_FILE_SIZE, STATE_FILES, DirectorySnapshot, Entry, FileTooLargeError
+
+logger = getLogger(__name__)
+
+READ_BUFFER_SIZE = 64 * 1024
+
+S3_SCHEME = "s3://"
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+# The maximum number of objects listed per request.
+LIST_PAGE_SIZE = 1000
+# The SHA-256 of the empty payload of the requests.
+EMPTY_PAYLOAD_HASH = hashlib.sha256(b"").hexdigest()
+
+S3_REQUESTS = Counter(
+    "juju_backup_all_exporter_s3_requests",
+    "The number of requests to the object store, by operation and status.",
+    ["operation", "status"],
+)
+
+Query = Sequence[Tuple[str, str]]
+
+
+class StorageError(OSError):
+    """Request to the object store failed."""
+
+
+class Storage(ABC):
+    """Backend storing the backup directory."""
+
+    @property
+    @abstractmethod
+    def location(self) -> str:
+        """Return the location of the backup directory."""
+
+    @abstractmethod
+    def join(self, name: str) -> str:
+        """Return the location of the entry."""
+
+    @abstractmethod
+    def take_snapshot(
+        self, files: Iterable[str] = STATE_FILES, max_size: int = MAX_STATE_FILE_SIZE
+    ) -> DirectorySnapshot:
+        """Take a snapshot of the directory.
+
+        Args:
+            files: the state files to read.
+            max_size: the maximum number of bytes read from each state file.
+
+        Returns:
+            The snapshot, empty if the directory cannot be listed.
+        """
+
+    @abstractmethod
+    def remove(self, name: str, version: Optional[str] = None) -> bool:
+        """Remove the entry, unless it was replaced since this version was seen.
+
+        Returns:
+            True if the entry was removed, False if it was replaced and kept.
+
+        Raises:
+            OSError: the entry cannot be removed.
+        """
+
+
+def _file_version(stat: os.stat_result) -> str:
+    """Return the version of the file, from its inode, modification time and size."""
+    return f"{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _file_entry(stat: os.stat_result) -> Entry:
+    """Return the entry of the file with this status."""
+    return Entry(size=stat.st_size, mtime=stat.st_mtime, version=_file_version(stat))
+
+
+def _read_file(path: str, max_size: int) -> Tuple[bytes, os.stat_result]:
+    """Read the whole file, raising FileTooLargeError if it exceeds max_size bytes.
+
+    Returns:
+        The contents, and the status of the file they were read from.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        stat = os.fstat(fd)
+        chunks = []
+        size = 0
+        while size <= max_size:
+            chunk = os.read(fd, min(READ_BUFFER_SIZE, max_size + 1 - size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+    finally:
+        os.close(fd)
+    if size > max_size:
+        raise FileTooLargeError(f"File is larger than {max_size} bytes.")
+    return b"".join(chunks), stat
+
+
+class LocalStorage(Storage):
+    """Backup directory on the local filesystem."""
+
+    def __init__(self, path: str) -> None:
+        """Initialize the storage.
+
+        Args:
+            path: the backup directory.
+        """
+        self.path = path
+
+    @property
+    def location(self) -> str:
+        """Return the backup directory."""
+        return self.path
+
+    def join(self, name: str) -> str:
+        """Return the path of the entry."""
+        return os.path.join(self.path, name)
+
+    def take_snapshot(
+        self, files: Iterable[str] = STATE_FILES, max_size: int = MAX_STATE_FILE_SIZE
+    ) -> DirectorySnapshot:
+        """Take a snapshot of the directory with a single `os.scandir`."""
+        files = set(files)
+        entries: Dict[str, Entry] = {}
+        contents: Dict[str, bytes] = {}
+        errors: Dict[str, OSError] = {}
+        try:
+            with os.scandir(self.path) as directory:
+                for entry in directory:
+                    try:
+                        entries[entry.name] = _file_entry(entry.stat())
+                        if entry.name in files:
+                            # the file may be replaced after the scan: its version
+                            # is the one of the file that was read
+                            contents[entry.name], stat = _read_file(entry.path, max_size)
+                            entries[entry.name] = _file_entry(stat)
+                    except OSError as err:
+                        errors[entry.name] = err
+        except OSError as err:
+            logger.error("Cannot list backup directory: %s. %s.", self.path, str(err))
+        return DirectorySnapshot(self, entries, contents, errors)
+
+    def remove(self, name: str, version: Optional[str] = None) -> bool:
+        """Remove the file, unless it was replaced since this version was seen."""
+        path = self.join(name)
+        if version is not None and _file_version(os.stat(path)) != version:
+            return False
+        os.unlink(path)
+        return True
+
+
+def sign_v4(
+    method: str,
+    path: str,
+    query: Query,
+    headers: Dict[str, str],
+    region: str,
+    access_key: str,
+    secret_key: str,
+    now: Optional[datetime] = None,
+) -> Dict[str, str]:
+    """Return the headers signing the S3 request with AWS Signature Version 4.
+
+    Args:
+        method: the HTTP method.
+        path: the URI-encoded path of the request.
+        query: the query parameters, not encoded.
+        headers: the headers to sign, with lowercase names.
+        region: the region of the bucket.
+        access_key: the access key id.
+        secret_key: the secret access key.
+        now: the time of the request, the current time by default.
+
+    Returns:
+        The headers to add to the request. The payload of the request must be empty.
+    """
+    amz_date = (now or datetime.now(timezone.utc)).strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    signed = {**headers, "x-amz-content-sha256": EMPTY_PAYLOAD_HASH, "x-amz-date": amz_date}
+    names = sorted(signed)
+    canonical_request = "\n".join(
+        [
+            method,
+            path,
+            "&".join(
+                f"{quote(key, safe='')}={quote(value, safe='')}" for key, value in sorted(query)
+            ),
+            "".join(f"{name}:{signed[name].strip()}\n" for name in names),
+            ";".join(names),
+            EMPTY_PAYLOAD_HASH,
+        ]
+    )
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_key}".encode()
+    for part in (amz_date[:8], region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return {
+        "x-amz-content-sha256": EMPTY_PAYLOAD_HASH,
+        "x-amz-date": amz_date,
+        "authorization": (
+            f"AWS4-HMAC-SHA256 Credential={access_key}/{scope},"
+            f" SignedHeaders={';'.join(names)}, Signature={signature}"
+        ),
+    }
+
+
+class ConnectionPool:
+    """Pool of keep-alive HTTP connections to a server.
+
+    A connection is taken from the pool for a request and returned once its
+    response is read, so the connections are reused across the snapshots
+    instead of being opened for every request.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        size: int = 4,
+        timeout: float = 10.0,
+        context: Optional[ssl.SSLContext] = None,
+    ) -> None:
+        """Initialize the pool; the connections are opened on demand.
+
+        Args:
+            url: the URL of the server, http or https.
+            size: the maximum number of idle connections kept.
+            timeout: seconds to wait for the server.
+            context: the SSL context of the https connections.
+        """
+        parts = urlsplit(url)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname or ""
+        self.port = parts.port
+        self.timeout = timeout
+        self.context = context
+        self._idle: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        """Create a new connection."""
+        if self.secure:
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout, context=self.context
+            )
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(
+        self, method: str, url: str, headers: Dict[str, str], max_size: int
+    ) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Send the request and read its response.
+
+        A request failing on an idle connection is retried on another one, as
+        the server may have closed it in the meantime.
+
+        Args:
+            method: the HTTP method.
+            url: the path and query of the request.
+            headers: the headers of the request.
+            max_size: the maximum number of bytes read from the response body.
+
+        Returns:
+            The status, headers and body of the response.
+
+        Raises:
+            OSError: the request failed, FileTooLargeError if the body exceeds max_size.
+        """
+        try:
+            connection, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connect(), False
+        try:
+            connection.request(method, url, headers=headers)
+            response = connection.getresponse()
+            body = response.read(max_size + 1)
+        except (http.client.HTTPException, OSError) as err:
+            connection.close()
+            if reused:
+                return self.request(method, url, headers, max_size)
+            if isinstance(err, OSError):
+                raise
+            raise StorageError(f"Invalid response: {err!r}.") from err
+        if len(body) > max_size:
+            connection.close()
+            raise FileTooLargeError(f"Object is larger than {max_size} bytes.")
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, response.headers, body
+
+    def close(self) -> None:
+        """Close the idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _parse_iso_time(value: str) -> float:
+    """Return the timestamp of an ISO 8601 UTC time, as listed by the object store."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class S3Storage(Storage):
+    """Backup directory under a prefix of a bucket of an S3-compatible object store.
+
+    The requests use path-style addressing, so they work with the stores
+    without virtual-hosted buckets, and are signed with AWS Signature Version 4
+    when credentials are set. They share a pool of keep-alive connections.
+
+    The objects are listed a page at a time, and the state files are fetched
+    with conditional GETs: a state file whose ETag did not change since the
+    previous snapshot is not downloaded again.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        bucket: str,
+        prefix: str = "",
+        region: str = "us-east-1",
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        pool: Optional[ConnectionPool] = None,
+        page_size: int = LIST_PAGE_SIZE,
+    ) -> None:
+        """Initialize the storage.
+
+        Args:
+            endpoint: the URL of the object store.
+            bucket: the bucket holding the backup directory.
+            prefix: the key prefix of the backup directory in the bucket.
+            region: the region of the bucket, to sign the requests.
+            access_key: the access key id; the requests are not signed without it.
+            secret_key: the secret access key.
+            pool: the connections to the object store, a new pool by default.
+            page_size: the maximum number of objects listed per request.
+        """
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.page_size = page_size
+        self.pool = pool or ConnectionPool(endpoint)
+        self._host = urlsplit(endpoint).netloc
+        # the ETag and contents of the state files last downloaded
+        self._cache: Dict[str, Tuple[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def location(self) -> str:
+        """Return the URL of the backup directory."""
+        return self.join("")
+
+    def join(self, name: str) -> str:
+        """Return the URL of the object."""
+        return f"{S3_SCHEME}{self.bucket}/{self.prefix}{name}"
+
+    def _request(
+        self,
+        operation: str,
+        method: str,
+        key: Optional[str] = None,
+        query: Query = (),
+        headers: Optional[Dict[str, str]] = None,
+        expected: Iterable[int] = (200,),
+        max_size: int = MAX_STATE_FILE_SIZE,
+    ) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Send the request about the object, or the bucket if key is None.
+
+        Raises:
+            OSError: the request failed, StorageError if its status is not expected.
+        """
+        path = quote(f"/{self.bucket}" if key is None else f"/{self.bucket}/{key}", safe="/")
+        query = sorted(query)
+        headers = {"host": self._host, **(headers or {})}
+        if self.access_key and self.secret_key:
+            headers.update(
+                sign_v4(
+                    method, path, query, headers, self.region, self.access_key, self.secret_key
+                )
+            )
+        url = path
+        if query:
+            url += "?" + "&".join(f"{quote(k, safe='')}={quote(v, safe='')}" for k, v in query)
+        try:
+            status, response_headers, body = self.pool.request(method, url, headers, max_size)
+        except OSError:
+            S3_REQUESTS.labels(operation=operation, status="error").inc()
+            raise
+        S3_REQUESTS.labels(operation=operation, status=str(status)).inc()
+        if status not in expected:
+            target = f"{S3_SCHEME}{self.bucket}/{key or ''}"
+            raise StorageError(f"{method} {target} returned HTTP {status}")
+        return status, response_headers, body
+
+    def _list(self) -> Iterator[Tuple[str, Entry]]:
+        """List the objects directly under the prefix, a page at a time.
+
+        Raises:
+            OSError: the objects cannot be listed.
+        """
+        query: List[Tuple[str, str]] = [
+            ("list-type", "2"),
+            ("delimiter", "/"),
+            ("max-keys", str(self.page_size)),
+            ("prefix", self.prefix),
+        ]
+        token = None
+        while True:
+            page = query + [("continuation-token", token)] if token else query
+            _, _, body = self._request("list", "GET", query=page)
+            try:
+                root = ElementTree.fromstring(body)
+                for item in root.iter(f"{S3_NAMESPACE}Contents"):
+                    key = item.findtext(f"{S3_NAMESPACE}Key", "")
+                    name = key[len(self.prefix) :]  # noqa: E203
+                    if name:
+                        yield name, Entry(
+                            size=int(item.findtext(f"{S3_NAMESPACE}Size", "0")),
+                            mtime=_parse_iso_time(
+                                item.findtext(f"{S3_NAMESPACE}LastModified", "")
+                            ),
+                            version=item.findtext(f"{S3_NAMESPACE}ETag", ""),
+                        )
+            except (ElementTree.ParseError, ValueError) as err:
+                raise StorageError(f"Invalid listing: {err}") from err
+            token = root.findtext(f"{S3_NAMESPACE}NextContinuationToken")
+            if root.findtext(f"{S3_NAMESPACE}IsTruncated") != "true" or not token:
+                return
+
+    def _get(self, name: str, listed: Entry, max_size: int) -> Tuple[Entry, bytes]:
+        """Download the state file, unless the cached contents are still current.
+
+        Raises:
+            OSError: the state file cannot be downloaded.
+        """
+        if listed.size > max_size:
+            raise FileTooLargeError(f"Object is larger than {max_size} bytes.")
+        with self._lock:
+            cached = self._cache.get(name)
+        headers = {"if-none-match": cached[0]} if cached is not None else {}
+        status, response_headers, body = self._request(
+            "get",
+            "GET",
+            self.prefix + name,
+            headers=headers,
+            expected=(200, 304),
+            max_size=max_size,
+        )
+        if status == 304 and cached is not None:
+            etag, body = cached
+        else:
+            etag = response_headers.get("ETag", "")
+            with self._lock:
+                self._cache[name] = (etag, body)
+        last_modified = response_headers.get("Last-Modified")
+        mtime = parsedate_to_datetime(last_modified).timestamp() if last_modified else listed.mtime
+        return Entry(size=len(body), mtime=mtime, version=etag), body
+
+    def take_snapshot(
+        self, files: Iterable[str] = STATE_FILES, max_size: int = MAX_STATE_FILE_SIZE
+    ) -> DirectorySnapshot:
+        """Take a snapshot of the directory with a listing of the prefix."""
+        contents: Dict[str, bytes] = {}
+        errors: Dict[str, OSError] = {}
+        try:
+            entries = dict(self._list())
+        except OSError as err:
+            logger.error("Cannot list backup directory: %s. %s.", self.location, str(err))
+            return DirectorySnapshot(self, {}, contents, errors)
+        for name in sorted(set(files) & entries.keys()):
+            try:
+                entries[name], contents[name] = self._get(name, entries[name], max_size)
+            except OSError as err:
+                errors[name] = err
+        with self._lock:
+            for name in self._cache.keys() - entries.keys():
+                del self._cache[name]
+        return DirectorySnapshot(self, entries, contents, errors)
+
+    def remove(self, name: str, version: Optional[str] = None) -> bool:
+        """Delete the object, unless its ETag changed since this version was seen."""
+        headers = {"if-match": version} if version is not None else {}
+        status, _, _ = self._request(
+            "delete", "DELETE", self.prefix + name, headers=headers, expected=(200, 204, 412)
+        )
+        if status == 412:
+            return False
+        with self._lock:
+            self._cache.pop(name, None)
+        return True
+
+
+def make_storage(config: Config) -> Storage:
+    """Create the storage of the backup directory of the configuration.
+
+    A backup path of the form s3://bucket/prefix is stored in an object store,
+    any other backup path is a local directory.
+    """
+    if not config.backup_path.startswith(S3_SCHEME):
+        return LocalStorage(config.backup_path)
+    url = urlsplit(config.backup_path)
+    endpoint = config.s3_endpoint or f"https://s3.{config.s3_region}.amazonaws.com"
+    return S3Storage(
+        endpoint,
+        url.netloc,
+        url.path,
+        region=config.s3_region,
+        access_key=config.s3_access_key,
+        secret_key=config.s3_secret_key,
+        pool=ConnectionPool(endpoint, size=config.collect_workers, timeout=config.collect_timeout),
+    )
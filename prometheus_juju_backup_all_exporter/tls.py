@@ -0,0 +1,156 @@
+"""Module for the TLS termination of the exporter."""
+
+import os
+import socket
+import ssl
+import threading
+import time
+from logging import getLogger
+from typing import List, Optional, Tuple
+
+from prometheus_client import Counter
+
+logger = getLogger(__name__)
+
+# Seconds between the checks that the certificate files changed.
+RELOAD_CHECK_INTERVAL = 5.0
+# Seconds a client has to complete the handshake.
+HANDSHAKE_TIMEOUT = 10.0
+
+TLS_HANDSHAKES = Counter(
+    "juju_backup_all_exporter_tls_handshakes",
+    "The number of TLS handshakes, by whether the session was resumed.",
+    ["resumed"],
+)
+TLS_HANDSHAKE_ERRORS = Counter(
+    "juju_backup_all_exporter_tls_handshake_errors",
+    "The number of TLS handshakes that failed.",
+)
+TLS_RELOADS = Counter(
+    "juju_backup_all_exporter_tls_reloads",
+    "The number of reloads of the TLS certificates, by result.",
+    ["result"],
+)
+
+FileGeneration = Optional[Tuple[int, int, int]]
+
+
+def _file_generation(path: str) -> FileGeneration:
+    """Return the (inode, modification time, size) of the file, or None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class ServerTLS:
+    """TLS configuration of the exporter's servers.
+
+    The certificate, key and CA files are checked for changes at most every
+    `check_interval` seconds, and reloaded without restarting the exporter.
+    If the new files cannot be loaded, the previous certificates are kept.
+
+    The sessions are resumed with session tickets (and session ids for TLS
+    1.2), so a scraper reconnecting periodically does an abbreviated handshake.
+    The sessions are kept by the SSL context, so they do not survive a reload.
+    """
+
+    def __init__(
+        self,
+        cert_file: str,
+        key_file: str,
+        ca_file: Optional[str] = None,
+        check_interval: float = RELOAD_CHECK_INTERVAL,
+    ) -> None:
+        """Load the certificates.
+
+        Args:
+            cert_file: the server certificate chain, in PEM format.
+            key_file: the private key of the certificate, in PEM format.
+            ca_file: if set, require client certificates signed by these CAs.
+            check_interval: seconds between the checks for changed files.
+
+        Raises:
+            OSError: the certificates cannot be loaded, ssl.SSLError included.
+        """
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.ca_file = ca_file
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generations = self._get_generations()
+        self._context = self._load()
+        self._next_check = time.monotonic() + check_interval
+        self._handshakes = {
+            resumed: TLS_HANDSHAKES.labels(resumed=str(resumed).lower())
+            for resumed in (True, False)
+        }
+
+    def _get_generations(self) -> List[FileGeneration]:
+        """Return the generations of the certificate files."""
+        return [
+            _file_generation(path)
+            for path in (self.cert_file, self.key_file, self.ca_file)
+            if path is not None
+        ]
+
+    def _load(self) -> ssl.SSLContext:
+        """Create a server SSL context with the certificates."""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.cert_file, self.key_file)
+        if self.ca_file is not None:
+            context.load_verify_locations(cafile=self.ca_file)
+            context.verify_mode = ssl.CERT_REQUIRED
+        return context
+
+    @property
+    def context(self) -> ssl.SSLContext:
+        """Return the SSL context, reloading the certificates if they changed."""
+        if time.monotonic() < self._next_check:
+            return self._context
+        with self._lock:
+            if time.monotonic() >= self._next_check:
+                self._next_check = time.monotonic() + self.check_interval
+                self._reload()
+        return self._context
+
+    def _reload(self) -> None:
+        """Reload the certificates if the files changed; the lock must be held."""
+        generations = self._get_generations()
+        if generations == self._generations:
+            return
+        try:
+            self._context = self._load()
+        except OSError as err:
+            # the files may be in the middle of an update, retry at the next check
+            TLS_RELOADS.labels(result="failure").inc()
+            logger.error(
+                "Cannot reload the TLS certificates, keeping the previous ones: %s.", str(err)
+            )
+            return
+        self._generations = generations
+        TLS_RELOADS.labels(result="success").inc()
+        logger.info("Reloaded the TLS certificates: %s.", self.cert_file)
+
+    def wrap(self, sock: socket.socket) -> ssl.SSLSocket:
+        """Wrap the accepted connection; the handshake is left to `handshake`."""
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+    def handshake(self, sock: ssl.SSLSocket) -> None:
+        """Do the handshake of the wrapped connection, within `HANDSHAKE_TIMEOUT`.
+
+        Raises:
+            OSError: the handshake failed, ssl.SSLError included.
+        """
+        timeout = sock.gettimeout()
+        sock.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            sock.do_handshake()
+        except OSError:
+            TLS_HANDSHAKE_ERRORS.inc()
+            raise
+        finally:
+            sock.settimeout(timeout)
+        self._handshakes[bool(sock.session_reused)].inc()
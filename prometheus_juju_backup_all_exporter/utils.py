@@ -1,13 +1,30 @@
 """Module for loading j-b-a related metrics."""
 
 import json
-from logging import getLogger
-from pathlib import Path
+import math
+from logging import ERROR, WARNING, getLogger
+from typing import Any, Callable, Dict, List, NamedTuple, Type, TypeVar
 
-from .config import Config
+from prometheus_client import Counter
+
+from .snapshot import EVENT_FILE, STATS_FILE, DirectorySnapshot, FileTooLargeError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
 
 logger = getLogger(__name__)
 
+# Use the faster orjson decoder when it is installed.
+json_loads: Callable[[bytes], Any] = orjson.loads if orjson is not None else json.loads
+
+DECODE_ERRORS = Counter(
+    "juju_backup_all_exporter_decode_errors",
+    "The number of backup files that failed to be read or decoded.",
+    ["file", "reason"],
+)
+
 DEFAULT_DURATION = 0
 DEFAULT_STATUS_OK = 0
 DEFAULT_RESULT_CODE = 3  # unknown
@@ -17,48 +34,251 @@ DEFAULT_FAILED = 0
 DEFAULT_COMPLETED = 0
 
 
+RESULT_CODE_NAMES = {
+    0: "StatusOK",
+    1: "StatusWarning",
+    2: "StatusCritical",
+    3: "StatusUnknown",
+}
+INVALID_RESULT_CODE_NAME = "InvalidResultCode"
+
+
 def get_result_code_name(result_code: int) -> str:
     """Map result_code to Nagios-like string."""
-    result_code = int(result_code)
-    status_name = {
-        0: "StatusOK",
-        1: "StatusWarning",
-        2: "StatusCritical",
-        3: "StatusUnknown",
-    }
-    return status_name.get(result_code, "InvalidResultCode")
+    return RESULT_CODE_NAMES.get(int(result_code), INVALID_RESULT_CODE_NAME)
+
+
+class DecodeError(ValueError):
+    """Backup file could not be decoded.
+
+    The `reason` is one of "invalid_json", "not_an_object", "missing_field" or
+    "invalid_type".
+    """
+
+    def __init__(self, reason: str, msg: str) -> None:
+        """Initialize the error with its reason."""
+        super().__init__(msg)
+        self.reason = reason
+
+
+class StatsRecord(NamedTuple):
+    """Decoded backup stats file."""
+
+    duration: float
+    status_ok: int
+    result_code: int
+
+
+class EventRecord(NamedTuple):
+    """Decoded backup event file."""
+
+    failed: int
+    purged: int
+    completed: int
+
+
+class TargetRecord(NamedTuple):
+    """Decoded per-target entry of the extended backup stats file.
+
+    A target is a controller, or a model or charm unit of the controller.
+    """
+
+    controller: str
+    duration: float
+    status_ok: int
+    result_code: int
+    model: str = ""
+    unit: str = ""
+
+
+Record = TypeVar("Record", StatsRecord, EventRecord, TargetRecord)
+
+
+class BackupRun(NamedTuple):
+    """A backup run, observed as a new generation of the backup stats file."""
+
+    time: float  # when the backup stats file was written
+    duration: float
+    status_ok: int
+    result_code: int
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of the record."""
+        return "run"
+
+
+class BackupEventDelta(NamedTuple):
+    """The backup events read from one backup event file."""
+
+    time: float  # when the backup event file was read
+    failed: int
+    purged: int
+    completed: int
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of the record."""
+        return "event"
+
+
+def _coerce(field: str, value: Any, field_type: Type) -> Any:
+    """Coerce a JSON number (or boolean) to the field type, or check a string field."""
+    if field_type is str:
+        if not isinstance(value, str):
+            raise DecodeError(
+                "invalid_type", f"Field {field} must be a string, not {type(value).__name__}."
+            )
+        return value
+    if not isinstance(value, (int, float)):
+        raise DecodeError(
+            "invalid_type", f"Field {field} must be a number, not {type(value).__name__}."
+        )
+    # the standard library decodes NaN, Infinity, 1e400 and huge integers,
+    # which the metrics cannot hold
+    try:
+        finite = math.isfinite(value)
+    except OverflowError:
+        finite = False
+    if not finite:
+        raise DecodeError("invalid_type", f"Field {field} must be a finite number.")
+    if field_type is int and value != int(value):
+        raise DecodeError("invalid_type", f"Field {field} must be an integer, not {value}.")
+    return field_type(value)
+
+
+def decode_record(data: bytes, record_class: Type[Record]) -> Record:
+    """Decode the JSON document into the record, validating the field types.
+
+    Args:
+        data: the raw JSON document.
+        record_class: the record to decode into.
+
+    Returns:
+        The decoded record.
+
+    Raises:
+        DecodeError: the document is not valid.
+    """
+    return _decode_fields(decode_document(data), record_class)
+
+
+def decode_document(data: bytes) -> Dict[str, Any]:
+    """Decode the JSON document, which must be an object.
+
+    Raises:
+        DecodeError: the document is not valid.
+    """
+    try:
+        document = json_loads(data)
+    except ValueError as err:
+        raise DecodeError("invalid_json", str(err)) from err
+    if not isinstance(document, dict):
+        raise DecodeError("not_an_object", "Document must be a JSON object.")
+    return document
+
+
+def _decode_fields(
+    document: Dict[str, Any], record_class: Type[Record], prefix: str = ""
+) -> Record:
+    """Build the record from the fields of the object; the fields with a default are optional."""
+    values: Dict[str, Any] = {}
+    for field, field_type in record_class.__annotations__.items():
+        if field not in document:
+            if field in record_class._field_defaults:
+                continue
+            raise DecodeError("missing_field", f"Field {prefix}{field} is missing.")
+        values[field] = _coerce(prefix + field, document[field], field_type)
+    return record_class(**values)
+
+
+def decode_targets(targets: Any) -> List[TargetRecord]:
+    """Decode the per-target entries of the extended backup stats file.
+
+    Raises:
+        DecodeError: an entry is not valid.
+    """
+    if not isinstance(targets, list):
+        raise DecodeError(
+            "invalid_type", f"Field targets must be a list, not {type(targets).__name__}."
+        )
+    records = []
+    for i, target in enumerate(targets):
+        if not isinstance(target, dict):
+            raise DecodeError("not_an_object", f"Field targets[{i}] must be a JSON object.")
+        records.append(_decode_fields(target, TargetRecord, f"targets[{i}]."))
+    return records
+
+
+def _report_read_error(snapshot: DirectorySnapshot, name: str, err: OSError) -> None:
+    """Report the state file could not be read into the snapshot."""
+    reason = "too_large" if isinstance(err, FileTooLargeError) else "read_error"
+    DECODE_ERRORS.labels(file=name, reason=reason).inc()
+    logger.error(
+        "Cannot read backup file: %s. %s. Using default values.", snapshot.join(name), str(err)
+    )
+
+
+def _report_decode_error(snapshot: DirectorySnapshot, name: str, err: DecodeError) -> None:
+    """Report the state file could not be decoded."""
+    DECODE_ERRORS.labels(file=name, reason=err.reason).inc()
+    logger.error(
+        "Invalid backup file: %s. %s. Using default values.", snapshot.join(name), str(err)
+    )
 
 
 class BackupStats:
-    """A class representing backup statistic file."""
+    """A class representing backup statistic file.
+
+    The extended file also holds a `targets` list, with an entry per backed up
+    controller, model or charm unit. If the entries are not valid, the error is
+    reported and only the overall statistics are used.
+    """
 
-    def __init__(self, config: Config) -> None:
-        """Initialize and set instance properties."""
-        self._duration = DEFAULT_DURATION
+    def __init__(self, snapshot: DirectorySnapshot, missing_level: int = ERROR) -> None:
+        """Initialize and set instance properties.
+
+        Args:
+            snapshot: the snapshot of the backup directory.
+            missing_level: the logging level of a missing stats file.
+        """
+        self._duration = float(DEFAULT_DURATION)
         self._status_ok = DEFAULT_STATUS_OK
         self._result_code = DEFAULT_RESULT_CODE
-        stats_file = Path(config.backup_path, "backup_stats.json")
-        try:
-            if not stats_file.exists():
-                logger.error(
-                    "Backup stats file: %s does not exist, using default values.",
-                    str(stats_file),
-                )
-            else:
-                with open(stats_file, "r", encoding="utf-8") as stats:
-                    backup_stats = json.load(stats)
-                    self._duration = backup_stats["duration"]
-                    self._status_ok = backup_stats["status_ok"]
-                    self._result_code = backup_stats["result_code"]
-        except (KeyError, PermissionError, json.decoder.JSONDecodeError) as err:
-            logger.error(
-                "Invalid backup stats file: %s. %s. Using default values.",
-                str(stats_file),
-                str(err),
+        self._targets: List[TargetRecord] = []
+        self._loaded = False
+        if STATS_FILE in snapshot.errors:
+            _report_read_error(snapshot, STATS_FILE, snapshot.errors[STATS_FILE])
+        elif STATS_FILE not in snapshot.contents:
+            logger.log(
+                missing_level,
+                "Backup stats file: %s does not exist, using default values.",
+                snapshot.join(STATS_FILE),
             )
+        else:
+            try:
+                document = decode_document(snapshot.contents[STATS_FILE])
+                record = _decode_fields(document, StatsRecord)
+                self._duration = record.duration
+                self._status_ok = record.status_ok
+                self._result_code = record.result_code
+                self._loaded = True
+                self._targets = decode_targets(document.get("targets", []))
+            except DecodeError as err:
+                _report_decode_error(snapshot, STATS_FILE, err)
 
     @property
-    def duration(self) -> int:
+    def loaded(self) -> bool:
+        """Return if the values were loaded from the backup stats file."""
+        return self._loaded
+
+    @property
+    def targets(self) -> List[TargetRecord]:
+        """Return the per-target statistics."""
+        return self._targets
+
+    @property
+    def duration(self) -> float:
         """Return backup duration."""
         return self._duration
 
@@ -74,36 +294,57 @@ class BackupStats:
 
 
 class BackupEvent:
-    """A class representing backup event file."""
+    """A class representing backup event file.
 
-    def __init__(self, config: Config) -> None:
-        """Initialize and set instance properties."""
+    The event file holds the events since it was last read, so it is removed
+    once read, unless `remove` is False.
+    """
+
+    def __init__(
+        self, snapshot: DirectorySnapshot, remove: bool = True, missing_level: int = WARNING
+    ) -> None:
+        """Initialize and set instance properties.
+
+        Args:
+            snapshot: the snapshot of the backup directory.
+            remove: remove the event file once read.
+            missing_level: the logging level of a missing event file.
+        """
         self._failed = DEFAULT_FAILED
         self._purged = DEFAULT_PURGED
         self._completed = DEFAULT_COMPLETED
-        event_file = Path(config.backup_path, "backup_state.json")
-        if not event_file.exists():
-            logger.warning(
+        if EVENT_FILE in snapshot.errors:
+            _report_read_error(snapshot, EVENT_FILE, snapshot.errors[EVENT_FILE])
+        elif EVENT_FILE not in snapshot.contents:
+            logger.log(
+                missing_level,
                 "Backup event file: %s does not exist, using default values.",
-                str(event_file),
+                snapshot.join(EVENT_FILE),
             )
             return
+        else:
+            try:
+                record = decode_record(snapshot.contents[EVENT_FILE], EventRecord)
+                self._failed = record.failed
+                self._purged = record.purged
+                self._completed = record.completed
+            except DecodeError as err:
+                _report_decode_error(snapshot, EVENT_FILE, err)
+        if remove:
+            self._remove_event_file(snapshot)
 
+    @staticmethod
+    def _remove_event_file(snapshot: DirectorySnapshot) -> None:
+        """Remove the event file, unless it was replaced since the snapshot was taken."""
+        event_file = snapshot.join(EVENT_FILE)
+        seen = snapshot.entry(EVENT_FILE)
         try:
-            with open(event_file, "r", encoding="utf-8") as event:
-                backup_event = json.load(event)
-                self._failed = backup_event["failed"]
-                self._purged = backup_event["purged"]
-                self._completed = backup_event["completed"]
-        except (KeyError, PermissionError, json.decoder.JSONDecodeError) as err:
-            logger.error(
-                "Invalid backup event file: %s. %s. Using default values.",
-                str(event_file),
-                str(err),
-            )
-        finally:
-            logger.info("Removing event file: %s.", str(event_file))
-            event_file.unlink()
+            if not snapshot.storage.remove(EVENT_FILE, seen.version if seen else None):
+                logger.info("Event file: %s was replaced, keeping it.", event_file)
+                return
+            logger.info("Removed event file: %s.", event_file)
+        except OSError as err:
+            logger.error("Cannot remove event file: %s. %s.", event_file, str(err))
 
     @property
     def completed(self) -> int:
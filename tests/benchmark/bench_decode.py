@@ -0,0 +1,89 @@
+"""Benchmark the JSON decoders on backup stats files.
+
+Run it with `PYTHONPATH=. python tests/benchmark/bench_decode.py`. It decodes
+a plain backup_stats.json and an extended one with per-target entries, using
+every decoder that is installed, then times the full decode of the file as
+done by BackupStats.
+"""
+
+import argparse
+import json
+import timeit
+
+from prometheus_juju_backup_all_exporter import utils
+from prometheus_juju_backup_all_exporter.utils import (
+    StatsRecord,
+    _decode_fields,
+    decode_document,
+    decode_targets,
+)
+
+
+def make_stats(targets: int) -> bytes:
+    """Make a backup stats file with the given number of per-target entries."""
+    stats = {"duration": 123.4, "status_ok": True, "result_code": 0}
+    if targets:
+        stats["targets"] = [
+            {
+                "controller": f"controller-{i % 10}",
+                "model": f"model-{i}",
+                "duration": i / 10,
+                "status_ok": True,
+                "result_code": 0,
+            }
+            for i in range(targets)
+        ]
+    return json.dumps(stats).encode()
+
+
+def decode_stats(data: bytes) -> None:
+    """Decode the backup stats file and its per-target entries, as BackupStats does."""
+    document = decode_document(data)
+    _decode_fields(document, StatsRecord)
+    decode_targets(document.get("targets", []))
+
+
+def get_decoders() -> dict:
+    """Return the installed decoders."""
+    decoders = {"json": json.loads}
+    try:
+        import orjson
+
+        decoders["orjson"] = orjson.loads
+    except ImportError:
+        pass
+    try:
+        import msgspec
+
+        decoders["msgspec"] = msgspec.json.decode
+    except ImportError:
+        pass
+    return decoders
+
+
+def bench(name: str, func, number: int) -> None:
+    """Time the function and print the time per call."""
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"  {name:<24} {best / number * 1e6:>12.2f} us/call")
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--targets", type=int, default=5000, help="Targets in extended file.")
+    parser.add_argument("--number", type=int, default=100, help="Calls per repeat.")
+    args = parser.parse_args()
+
+    for label, data in [("plain", make_stats(0)), ("extended", make_stats(args.targets))]:
+        print(f"{label} backup_stats.json ({len(data)} bytes):")
+        for name, loads in get_decoders().items():
+            bench(name, lambda: loads(data), args.number)
+        bench(
+            f"decode_stats ({utils.json_loads.__module__})",
+            lambda: decode_stats(data),
+            args.number,
+        )
+
+
+if __name__ == "__main__":
+    main()
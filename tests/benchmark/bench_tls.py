@@ -0,0 +1,102 @@
+"""Benchmark the cost of TLS per scrape.
+
+Run it with `PYTHONPATH=. python tests/benchmark/bench_tls.py`. It starts the
+exporter on the loopback with the test certificates, and times the TLS
+handshake alone, full or resuming the previous session, and a whole scrape
+over plain HTTP and over TLS. The client runs in the same process, so the
+times include its share of the work.
+
+The test certificates use P-256 keys, whose signatures are cheap: the full
+handshakes with RSA certificates cost more, and resuming saves more.
+"""
+
+import argparse
+import os
+import socket
+import ssl
+import timeit
+
+from prometheus_juju_backup_all_exporter.core import ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.exporter import Exporter
+from prometheus_juju_backup_all_exporter.tls import ServerTLS
+
+CERTS = os.path.join(os.path.dirname(__file__), "..", "unit", "certs")
+REQUEST = b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n"
+
+
+def start_exporter(tls: ServerTLS = None) -> tuple:
+    """Start an exporter on the loopback and return its address."""
+    exporter = Exporter(0, addr="127.0.0.1", registry=ConcurrentCollectorRegistry(), tls=tls)
+    exporter.run(daemon=True)
+    return exporter.servers[0].server_address
+
+
+class Client:
+    """Scraper connecting once per scrape, optionally resuming its last TLS session."""
+
+    def __init__(self, address: tuple, tls: bool = False, resume: bool = False) -> None:
+        self.address = address
+        self.context = ssl.create_default_context(cafile=os.path.join(CERTS, "ca.pem"))
+        self.tls = tls
+        self.resume = resume
+        self.session = None
+
+    def connect(self) -> socket.socket:
+        sock = socket.create_connection(self.address)
+        if not self.tls:
+            return sock
+        sock = self.context.wrap_socket(
+            sock, server_hostname="localhost", session=self.session if self.resume else None
+        )
+        return sock
+
+    def handshake(self) -> None:
+        with self.connect() as sock:
+            if self.resume:
+                # receives the session ticket of the next handshake
+                sock.sendall(b"\r\n")
+                sock.recv(1)
+                self.session = sock.session
+
+    def scrape(self) -> None:
+        with self.connect() as sock:
+            sock.sendall(REQUEST)
+            while sock.recv(65536):
+                pass
+            if self.tls:
+                # the TLS 1.3 session tickets arrive after the handshake
+                self.session = sock.session
+
+
+def bench(name: str, func, number: int) -> None:
+    """Time the function and print the time per call."""
+    func()
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"  {name:<24} {best / number * 1e6:>12.2f} us/call")
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=200, help="Calls per repeat.")
+    args = parser.parse_args()
+
+    plain = start_exporter()
+    tls = start_exporter(
+        ServerTLS(os.path.join(CERTS, "server.pem"), os.path.join(CERTS, "server.key"))
+    )
+    clients = [
+        ("plain", Client(plain)),
+        ("tls full handshake", Client(tls, tls=True)),
+        ("tls resumed", Client(tls, tls=True, resume=True)),
+    ]
+    print("handshake:")
+    for name, client in clients[1:]:
+        bench(name, client.handshake, args.number)
+    print("scrape:")
+    for name, client in clients:
+        bench(name, client.scrape, args.number)
+
+
+if __name__ == "__main__":
+    main()
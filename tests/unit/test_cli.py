@@ -1,5 +1,14 @@
+import http.client
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from contextlib import closing
 from unittest.mock import Mock, patch
 
+import pytest
+
 from prometheus_juju_backup_all_exporter import __main__
 from prometheus_juju_backup_all_exporter.__main__ import main, parse_command_line
 
@@ -7,12 +16,116 @@ from prometheus_juju_backup_all_exporter.__main__ import main, parse_command_lin
 class TestCli:
     """Cli test class."""
 
+    @pytest.fixture(autouse=True)
+    def mock_signal(self):
+        with patch.object(__main__.signal, "signal") as mock_signal:
+            yield mock_signal
+
     @patch("argparse.ArgumentParser")
     def test_parse_argument(self, mock_argument_parser):
         parse_command_line()
         mock_argument_parser.assert_called_once()
 
+    def test_parse_commands(self):
+        assert parse_command_line([]).command is None
+        args = parse_command_line(["-c", "config.yaml", "render"])
+        assert (args.config, args.command, args.consume_events) == ("config.yaml", "render", False)
+        assert parse_command_line(["render", "--consume-events"]).consume_events
+        args = parse_command_line(["bench", "/backups", "-n", "10"])
+        assert (args.command, args.backup_path, args.cycles) == ("bench", "/backups", 10)
+        args = parse_command_line(["record", "/backups", "timeline.jsonl", "-d", "60"])
+        assert (args.command, args.output, args.duration, args.interval) == (
+            "record",
+            "timeline.jsonl",
+            60.0,
+            1.0,
+        )
+        args = parse_command_line(["replay", "--runs", "5", "--speed", "100"])
+        assert (args.command, args.timeline, args.runs, args.speed) == ("replay", None, 5, 100.0)
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "render")
+    @patch.object(__main__, "serve")
+    @patch.object(__main__, "Config")
+    @patch("logging.getLevelName")
+    def test_cli_render(
+        self, mock_get_level_name, mock_config, mock_serve, mock_render, mock_parse, capsys
+    ):
+        """Test the render command prints the exposition."""
+        mock_get_level_name.return_value = "DEBUG"
+        mock_parse.return_value = parse_command_line(["render"])
+        mock_render.return_value = b"metric 1.0\n"
+        main()
+        mock_render.assert_called_once_with(
+            mock_config.load_config.return_value, remove_events=False
+        )
+        mock_serve.assert_not_called()
+        assert capsys.readouterr().out == "metric 1.0\n"
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "run_bench")
+    @patch.object(__main__, "serve")
+    @patch.object(__main__, "Config")
+    def test_cli_bench(self, mock_config, mock_serve, mock_run_bench, mock_parse, capsys):
+        """Test the bench command prints the timings, without a configuration file."""
+        mock_parse.return_value = parse_command_line(["bench", "/backups", "-n", "5"])
+        mock_run_bench.return_value.report.return_value = "5 cycles"
+        main()
+        mock_config.load_config.assert_not_called()
+        mock_config.assert_called_once_with(backup_path="/backups")
+        mock_run_bench.assert_called_once_with(mock_config.return_value, 5)
+        mock_serve.assert_not_called()
+        assert capsys.readouterr().out == "5 cycles\n"
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "save_timeline")
+    @patch.object(__main__, "record_timeline")
+    @patch.object(__main__, "make_storage")
+    @patch.object(__main__, "Config")
+    def test_cli_record(self, mock_config, mock_make_storage, mock_record, mock_save, mock_parse):
+        """Test the record command saves the recorded timeline."""
+        mock_parse.return_value = parse_command_line(["record", "/backups", "out.jsonl"])
+        main()
+        mock_config.assert_called_once_with(backup_path="/backups")
+        mock_record.assert_called_once_with(mock_make_storage.return_value, 3600.0, 1.0)
+        mock_save.assert_called_once_with(mock_record.return_value, "out.jsonl")
+
+    @pytest.mark.parametrize("ok", [True, False])
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "replay")
+    @patch.object(__main__, "generate_timeline")
+    @patch.object(__main__, "load_timeline")
+    def test_cli_replay(self, mock_load, mock_generate, mock_replay, mock_parse, ok, capsys):
+        """Test the replay command prints the report, and fails if an invariant did not hold."""
+        mock_parse.return_value = parse_command_line(["replay", "--runs", "3", "--targets", "2"])
+        mock_replay.return_value.ok = ok
+        mock_replay.return_value.report.return_value = "invariants"
+        if ok:
+            main()
+        else:
+            with pytest.raises(SystemExit):
+                main()
+        mock_load.assert_not_called()
+        mock_generate.assert_called_once_with(3, targets=2, seed=0)
+        assert mock_replay.call_args.args[0] == mock_generate.return_value
+        assert mock_replay.call_args.kwargs == {"speed": 3600.0, "scrape_interval": 15.0}
+        assert capsys.readouterr().out == "invariants\n"
+
     @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "replay")
+    @patch.object(__main__, "load_timeline")
+    def test_cli_replay_timeline(self, mock_load, mock_replay, mock_parse):
+        """Test the replay command replays a saved timeline."""
+        mock_parse.return_value = parse_command_line(["replay", "timeline.jsonl"])
+        main()
+        mock_load.assert_called_once_with("timeline.jsonl")
+        assert mock_replay.call_args.args[0] == mock_load.return_value
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "ConcurrentCollectorRegistry")
+    @patch.object(__main__, "ServerTLS")
+    @patch.object(__main__, "HistoryStore")
+    @patch.object(__main__, "EventStream")
     @patch.object(__main__, "Exporter")
     @patch.object(__main__, "Config")
     @patch("logging.getLevelName")
@@ -21,12 +134,142 @@ class TestCli:
         mock_get_level_name,
         mock_config,
         mock_exporter,
+        mock_event_stream,
+        mock_history_store,
+        mock_server_tls,
+        mock_registry,
         mock_main_parse_command_line,
+        mock_signal,
     ):
         """Test main function in cli."""
         mock_main_parse_command_line.return_value = Mock()
         mock_get_level_name.return_value = "DEBUG"
+        mock_config.load_config.return_value.backup_path = "/backups"
+        mock_config.load_config.return_value.workers = 0
+        mock_config.load_config.return_value.history_retention_days = 1
         main()
         mock_main_parse_command_line.assert_called_once()
         mock_config.load_config.assert_called_once()
+        mock_registry.assert_called_once()
         mock_exporter.assert_called_once()
+        assert mock_history_store.call_args.kwargs["retention"] == 86400
+        routes = [call.args[0] for call in mock_exporter.return_value.add_route.call_args_list]
+        assert routes == ["/api/history", "/events"]
+        assert mock_exporter.call_args.kwargs["tls"] is mock_server_tls.return_value
+        # the servers are shut down on SIGTERM, then the history is closed
+        mock_exporter.return_value.run.assert_called_once()
+        mock_history_store.return_value.close.assert_called_once()
+        signums = [call.args[0] for call in mock_signal.call_args_list]
+        assert signums == [__main__.signal.SIGTERM, __main__.signal.SIGINT]
+        mock_signal.call_args.args[1](__main__.signal.SIGINT, None)
+        mock_exporter.return_value.shutdown.assert_called_once()
+        # the event stream only polls the backup collectors
+        mock_event_stream.call_args.kwargs["poll"]()
+        [polled] = mock_registry.return_value.poll.call_args.args
+        assert [type(collector) for collector in polled] == [
+            __main__.BackupStatsCollector,
+            __main__.BackupEventCollector,
+        ]
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "ConcurrentCollectorRegistry")
+    @patch.object(__main__, "HistoryStore")
+    @patch.object(__main__, "Exporter")
+    @patch.object(__main__, "Config")
+    @patch("logging.getLevelName")
+    def test_cli_main_without_history(
+        self,
+        mock_get_level_name,
+        mock_config,
+        mock_exporter,
+        mock_history_store,
+        mock_registry,
+        mock_main_parse_command_line,
+    ):
+        """Test main function in cli with the history disabled."""
+        mock_get_level_name.return_value = "DEBUG"
+        mock_config.load_config.return_value.backup_path = "/backups"
+        mock_config.load_config.return_value.workers = 0
+        mock_config.load_config.return_value.history_file = None
+        mock_config.load_config.return_value.tls_cert_file = None
+        main()
+        mock_history_store.assert_not_called()
+        mock_exporter.return_value.add_route.assert_called_once()
+
+    @patch.object(__main__, "parse_command_line")
+    @patch.object(__main__, "ConcurrentCollectorRegistry")
+    @patch.object(__main__, "PreforkExporter")
+    @patch.object(__main__, "HistoryStore")
+    @patch.object(__main__, "Exporter")
+    @patch.object(__main__, "Config")
+    @patch("logging.getLevelName")
+    def test_cli_main_prefork(
+        self,
+        mock_get_level_name,
+        mock_config,
+        mock_exporter,
+        mock_history_store,
+        mock_prefork_exporter,
+        mock_registry,
+        mock_main_parse_command_line,
+    ):
+        """Test main function in cli with worker processes."""
+        mock_get_level_name.return_value = "DEBUG"
+        mock_config.load_config.return_value.backup_path = "/backups"
+        mock_config.load_config.return_value.workers = 4
+        mock_config.load_config.return_value.tls_cert_file = None
+        main()
+        assert mock_prefork_exporter.call_args.kwargs["tls"] is None
+        assert (
+            mock_prefork_exporter.call_args.kwargs["on_exit"]
+            == mock_history_store.return_value.close
+        )
+        mock_exporter.assert_not_called()
+        mock_prefork_exporter.return_value.run.assert_called_once()
+        assert mock_registry.return_value.register.call_count == 3
+
+
+def test_serve_subprocess(tmp_path):
+    """Test the exporter started from the entrypoint serves the metrics."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = tmp_path / "config.yaml"
+    backup_path = tmp_path / "backups"
+    backup_path.mkdir()
+    (backup_path / "backup_stats.json").write_text(
+        '{"duration": 1.5, "status_ok": 1, "result_code": 0}'
+    )
+    history_file = tmp_path / "history.db"
+    config.write_text(
+        f"port: {port}\nlevel: INFO\nbackup_path: {backup_path}\nhistory_file: {history_file}\n"
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "prometheus_juju_backup_all_exporter", "-c", str(config)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                connection.request("GET", "/metrics")
+                break
+            except OSError:
+                assert time.monotonic() < deadline and process.poll() is None
+                time.sleep(0.1)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        assert response.status == 200
+        assert b"juju_backup_all_backup_failed_total" in body
+        assert process.poll() is None
+        process.terminate()
+        assert process.wait(10) == 0
+        # the backup run recorded by the scrape is saved on SIGTERM
+        with closing(sqlite3.connect(str(history_file))) as db:
+            assert db.execute("SELECT kind, duration FROM history").fetchall() == [("run", 1.5)]
+    finally:
+        process.kill()
+        process.wait()
@@ -1,11 +1,25 @@
+import json
+import logging
+import os
+import tempfile
 import unittest
 from unittest.mock import Mock, patch
 
+from prometheus_client import CollectorRegistry
+
 from prometheus_juju_backup_all_exporter import collector
 from prometheus_juju_backup_all_exporter.collector import (
     BackupEventCollector,
     BackupStatsCollector,
 )
+from prometheus_juju_backup_all_exporter.core import ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.snapshot import Entry
+from prometheus_juju_backup_all_exporter.utils import (
+    BackupEventDelta,
+    BackupRun,
+    BackupStats,
+    TargetRecord,
+)
 
 
 class TestCustomCollector(unittest.TestCase):
@@ -13,11 +27,15 @@ class TestCustomCollector(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.mock_config = Mock()
+        cls.mock_config = Mock(backup_path="/backups")
 
+    @patch.object(collector, "get_snapshot")
     @patch.object(collector, "BackupStats")
-    def test_backup_stats_collector(self, mock_backup_stats):
+    def test_backup_stats_collector(self, mock_backup_stats, mock_get_snapshot):
         """Test backup stats collector fetch correct information."""
+        mock_backup_stats.return_value.targets = [
+            TargetRecord(controller="c", duration=1.0, status_ok=1, result_code=0)
+        ]
         backup_stats_collector = BackupStatsCollector(self.mock_config)
         payloads = backup_stats_collector.collect()
 
@@ -26,8 +44,9 @@ class TestCustomCollector(unittest.TestCase):
         for payload in payloads:
             self.assertIn(payload.name, available_metrics)
 
+    @patch.object(collector, "get_snapshot")
     @patch.object(collector, "BackupEvent")
-    def test_backup_event_collector(self, mock_backup_event):
+    def test_backup_event_collector(self, mock_backup_event, mock_get_snapshot):
         """Test backup event collector fetch correct information."""
         backup_event_collector = BackupEventCollector(self.mock_config)
         payloads = backup_event_collector.collect()
@@ -36,3 +55,183 @@ class TestCustomCollector(unittest.TestCase):
         self.assertEqual(len(list(payloads)), len(available_metrics))
         for payload in payloads:
             self.assertIn(payload.name, available_metrics)
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupEvent")
+    def test_backup_event_collector_polled(self, mock_backup_event, mock_get_snapshot):
+        """Test a missing event file is only logged at the DEBUG level while polling."""
+        mock_backup_event.return_value = Mock(failed=0, purged=0, completed=0)
+        backup_event_collector = BackupEventCollector(self.mock_config)
+        registry = ConcurrentCollectorRegistry()
+        registry.register(backup_event_collector)
+        registry.poll([backup_event_collector])
+        self.assertEqual(mock_backup_event.call_args.kwargs["missing_level"], logging.DEBUG)
+        list(registry.collect())
+        self.assertEqual(mock_backup_event.call_args.kwargs["missing_level"], logging.WARNING)
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupStats")
+    def test_backup_stats_collector_polled(self, mock_backup_stats, mock_get_snapshot):
+        """Test a missing stats file is only logged at the DEBUG level while polling."""
+        mock_backup_stats.return_value = Mock(
+            loaded=False, duration=0.0, status_ok=0, result_code=3, targets=[]
+        )
+        backup_stats_collector = BackupStatsCollector(self.mock_config)
+        registry = ConcurrentCollectorRegistry()
+        registry.register(backup_stats_collector)
+        registry.poll([backup_stats_collector])
+        self.assertEqual(mock_backup_stats.call_args.kwargs["missing_level"], logging.DEBUG)
+        list(registry.collect())
+        self.assertEqual(mock_backup_stats.call_args.kwargs["missing_level"], logging.ERROR)
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupStats")
+    def test_backup_stats_collector_notifies_new_runs(self, mock_backup_stats, mock_get_snapshot):
+        """Test a run is notified once per generation of the backup stats file."""
+        mock_get_snapshot.return_value.entry.return_value = Entry(size=10, mtime=1.0, version="1")
+        mock_backup_stats.return_value = Mock(
+            loaded=True, duration=2.0, status_ok=1, result_code=0, targets=[]
+        )
+        listener = Mock()
+        backup_stats_collector = BackupStatsCollector(self.mock_config)
+        backup_stats_collector.add_listener(listener)
+        list(backup_stats_collector.collect())
+        list(backup_stats_collector.collect())
+        listener.assert_called_once_with(
+            BackupRun(time=1.0, duration=2.0, status_ok=1, result_code=0)
+        )
+
+        mock_get_snapshot.return_value.entry.return_value = Entry(size=10, mtime=2.0, version="2")
+        list(backup_stats_collector.collect())
+        self.assertEqual(listener.call_count, 2)
+
+        mock_get_snapshot.return_value.entry.return_value = Entry(size=10, mtime=3.0, version="3")
+        mock_backup_stats.return_value.loaded = False
+        list(backup_stats_collector.collect())
+        self.assertEqual(listener.call_count, 2)
+
+    def test_backup_stats_collector_targets(self):
+        """Test the per-target series, built once per backup stats file generation."""
+        with tempfile.TemporaryDirectory() as backup_path:
+            stats_file = os.path.join(backup_path, "backup_stats.json")
+            stats = {
+                "duration": 10.0,
+                "status_ok": 1,
+                "result_code": 0,
+                "targets": [
+                    {"controller": "c1", "duration": 4.0, "status_ok": 1, "result_code": 0},
+                    {
+                        "controller": "c1",
+                        "model": "m1",
+                        "duration": 3.0,
+                        "status_ok": 1,
+                        "result_code": 0,
+                    },
+                    {
+                        "controller": "c1",
+                        "model": "m1",
+                        "unit": "mysql/0",
+                        "duration": 2.0,
+                        "status_ok": 0,
+                        "result_code": 2,
+                    },
+                    {"controller": "c1", "duration": 5.0, "status_ok": 1, "result_code": 0},
+                ],
+            }
+            with open(stats_file, "w", encoding="utf-8") as file:
+                json.dump(stats, file)
+            backup_stats_collector = BackupStatsCollector(Mock(backup_path=backup_path))
+            with patch.object(collector, "BackupStats", wraps=BackupStats) as mock_backup_stats:
+                metrics = {metric.name: metric for metric in backup_stats_collector.collect()}
+                payloads = backup_stats_collector.fetch()
+                self.assertIs(backup_stats_collector.fetch(), payloads)
+                mock_backup_stats.assert_called_once()
+
+                os.utime(stats_file, ns=(0, 0))
+                self.assertIsNot(backup_stats_collector.fetch(), payloads)
+                self.assertEqual(mock_backup_stats.call_count, 2)
+
+        durations = {
+            tuple(sample.labels.values()): sample.value
+            for sample in metrics["juju_backup_all_target_duration_seconds"].samples
+        }
+        self.assertEqual(
+            durations, {("c1", "", ""): 5.0, ("c1", "m1", ""): 3.0, ("c1", "m1", "mysql/0"): 2.0}
+        )
+        ok = {
+            sample.labels["unit"]: (sample.labels["result_code"], sample.value)
+            for sample in metrics["juju_backup_all_target_ok_info"].samples
+        }
+        self.assertEqual(ok["mysql/0"], ("StatusCritical", 0))
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupEvent")
+    def test_backup_event_collector_notifies_events(self, mock_backup_event, mock_get_snapshot):
+        """Test the events are notified only when some were read."""
+        mock_backup_event.return_value = Mock(failed=0, purged=0, completed=0)
+        listener = Mock()
+        backup_event_collector = BackupEventCollector(self.mock_config)
+        backup_event_collector.add_listener(listener)
+        list(backup_event_collector.collect())
+        listener.assert_not_called()
+
+        mock_backup_event.return_value = Mock(failed=1, purged=0, completed=2)
+        list(backup_event_collector.collect())
+        record = listener.call_args.args[0]
+        self.assertIsInstance(record, BackupEventDelta)
+        self.assertEqual((record.failed, record.purged, record.completed), (1, 0, 2))
+
+    @patch.object(collector, "BackupEvent")
+    def test_register_backup_event_collector(self, mock_backup_event):
+        """Test registering the backup event collector does not read the event file."""
+        registry = CollectorRegistry()
+        registry.register(BackupEventCollector(self.mock_config))
+        mock_backup_event.assert_not_called()
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupStats")
+    def test_backup_stats_collector_guards_labels(self, mock_backup_stats, mock_get_snapshot):
+        """Test the label values out of their allowlist or budget are collapsed."""
+        mock_backup_stats.return_value = Mock(
+            duration=2.0,
+            status_ok=5,
+            result_code=0,
+            targets=[
+                TargetRecord(controller=f"c{i}", duration=1.0, status_ok=1, result_code=0)
+                for i in range(collector.TARGET_LABEL_BUDGETS["controller"] + 2)
+            ],
+        )
+        backup_stats_collector = BackupStatsCollector(self.mock_config)
+        metrics = {metric.name: metric for metric in backup_stats_collector.collect()}
+        [command] = metrics["juju_backup_all_command_duration_seconds"].samples
+        self.assertEqual(command.labels["status_ok"], "__overflow__")
+        controllers = [
+            sample.labels["controller"]
+            for sample in metrics["juju_backup_all_target_duration_seconds"].samples
+        ]
+        self.assertEqual(len(controllers), collector.TARGET_LABEL_BUDGETS["controller"] + 1)
+        self.assertEqual(controllers[-1], "__overflow__")
+
+    @patch.object(collector, "get_snapshot")
+    @patch.object(collector, "BackupStats")
+    def test_backup_stats_collector_replaced_targets(self, mock_backup_stats, mock_get_snapshot):
+        """Test the targets of a new backup stats file do not compete with the old ones."""
+        budget = collector.TARGET_LABEL_BUDGETS["controller"]
+        mock_get_snapshot.return_value.entry.return_value = None
+        backup_stats_collector = BackupStatsCollector(self.mock_config)
+        for first in [0, budget]:
+            mock_backup_stats.return_value = Mock(
+                duration=2.0,
+                status_ok=1,
+                result_code=0,
+                targets=[
+                    TargetRecord(controller=f"c{i}", duration=1.0, status_ok=1, result_code=0)
+                    for i in range(first, first + budget)
+                ],
+            )
+            metrics = {metric.name: metric for metric in backup_stats_collector.collect()}
+            controllers = [
+                sample.labels["controller"]
+                for sample in metrics["juju_backup_all_target_duration_seconds"].samples
+            ]
+            self.assertEqual(controllers, [f"c{i}" for i in range(first, first + budget)])
@@ -26,9 +26,12 @@ class TestConfig(unittest.TestCase):
             "port": 10000,
             "level": "INFO",
             "backup_path": "./",
+            "collect_workers": 2,
+            "workers": 2,
         }
         config = Config.load_config()
         assert config.port == 10000
+        assert config.collect_workers == 2
         assert config.level == "INFO"
         assert config.backup_path == "./"
 
@@ -60,3 +63,80 @@ class TestConfig(unittest.TestCase):
         self.patch_os_path_exists.stop()
         with pytest.raises(ValueError):
             Config.load_config("random")
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_invalid_collect_workers(self, mock_safe_load):
+        """Test invalid collector pool settings."""
+        mock_safe_load.return_value = {
+            "backup_path": "./",
+            "collect_workers": 0,
+        }
+        with pytest.raises(ValueError, match=r".*must be positive.*"):
+            Config.load_config()
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_invalid_workers(self, mock_safe_load):
+        """Test invalid number of worker processes."""
+        mock_safe_load.return_value = {
+            "backup_path": "./",
+            "workers": -1,
+        }
+        with pytest.raises(ValueError, match=r".*Workers.*"):
+            Config.load_config()
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_workers_unix_socket(self, mock_safe_load):
+        """Test the worker processes cannot be set with a Unix socket."""
+        mock_safe_load.return_value = {
+            "backup_path": "./",
+            "workers": 2,
+            "unix_socket": "/run/exporter.sock",
+        }
+        with pytest.raises(ValueError, match=r".*Unix socket.*"):
+            Config.load_config()
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_tls_files(self, mock_safe_load):
+        """Test the TLS certificate and key are set together, and before the CA."""
+        mock_safe_load.return_value = {
+            "backup_path": "./",
+            "tls_cert_file": "cert.pem",
+            "tls_key_file": "key.pem",
+            "tls_ca_file": "ca.pem",
+        }
+        assert Config.load_config().tls_ca_file == "ca.pem"
+        for invalid in (
+            {"tls_cert_file": "cert.pem"},
+            {"tls_key_file": "key.pem"},
+            {"tls_ca_file": "ca.pem"},
+        ):
+            mock_safe_load.return_value = {"backup_path": "./", **invalid}
+            with pytest.raises(ValueError, match=r".*TLS cert and key.*"):
+                Config.load_config()
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_s3_backup_path(self, mock_safe_load):
+        """Test the backup path in an object store and its credentials."""
+        mock_safe_load.return_value = {
+            "backup_path": "s3://backups/site1",
+            "s3_access_key": "AKID",
+            "s3_secret_key": "secret",
+        }
+        assert Config.load_config().backup_path == "s3://backups/site1"
+        mock_safe_load.return_value = {"backup_path": "s3:///site1"}
+        with pytest.raises(ValueError, match=r".*name its bucket.*"):
+            Config.load_config()
+        mock_safe_load.return_value = {"backup_path": "s3://backups", "s3_access_key": "AKID"}
+        with pytest.raises(ValueError, match=r".*S3 access key and secret key.*"):
+            Config.load_config()
+
+    @patch("prometheus_juju_backup_all_exporter.config.safe_load")
+    def test_debug_port(self, mock_safe_load):
+        """Test the debug port is disabled by default, and in range."""
+        mock_safe_load.return_value = {"backup_path": "./"}
+        assert Config.load_config().debug_port is None
+        mock_safe_load.return_value = {"backup_path": "./", "debug_port": 10001}
+        assert Config.load_config().debug_port == 10001
+        mock_safe_load.return_value = {"backup_path": "./", "debug_port": 70000}
+        with pytest.raises(ValueError, match=r".*Port must be.*"):
+            Config.load_config()
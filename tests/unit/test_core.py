@@ -1,9 +1,22 @@
+import threading
+import time
+import tracemalloc
 import unittest
+from concurrent.futures import Future
 from unittest.mock import Mock, patch
 
 import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics_core import CounterMetricFamily, GaugeMetricFamily
 
-from prometheus_juju_backup_all_exporter.core import BlockingCollector, Payload, Specification
+from prometheus_juju_backup_all_exporter import core
+from prometheus_juju_backup_all_exporter.core import (
+    BlockingCollector,
+    ConcurrentCollectorRegistry,
+    LabelGuard,
+    Payload,
+    Specification,
+)
 
 
 class TestBlockingCollector(unittest.TestCase):
@@ -30,3 +43,448 @@ class TestBlockingCollector(unittest.TestCase):
         list(self.test_subclass.collect())  # need list() because it's a generator
         self.test_subclass.fetch.assert_called()
         self.test_subclass.process.assert_called()
+
+    @patch.multiple(BlockingCollector, __abstractmethods__=set())
+    def test_notify_isolates_listener_failures(self):
+        """Test a failing listener does not prevent notifying the others."""
+        BlockingCollector.specifications = self.mock_specifications
+        test_collector = BlockingCollector(Mock())
+        failing = Mock(side_effect=RuntimeError("boom"))
+        listener = Mock()
+        test_collector.add_listener(failing)
+        test_collector.add_listener(listener)
+        test_collector.notify("record")
+        failing.assert_called_once_with("record")
+        listener.assert_called_once_with("record")
+
+
+class GroupingCollector(BlockingCollector):
+    """Collector with several timeseries per metric."""
+
+    @property
+    def specifications(self):
+        return [
+            Specification(
+                name=name, documentation="", labels=["id"], metric_class=GaugeMetricFamily
+            )
+            for name in ("a", "b")
+        ]
+
+    def fetch(self):
+        return [Payload(name=name, labels=[str(i)], value=i) for name in "ab" for i in range(3)]
+
+    def process(self, payloads, datastore):
+        return payloads
+
+
+def test_collect_one_family_per_specification():
+    """Test the timeseries of a specification are yielded in a single metric family."""
+    metrics = list(GroupingCollector(Mock()).collect())
+    assert [metric.name for metric in metrics] == ["a", "b"]
+    assert [sample.labels["id"] for sample in metrics[0].samples] == ["0", "1", "2"]
+
+
+class TestConcurrentCollectorRegistry(unittest.TestCase):
+    """ConcurrentCollectorRegistry test class."""
+
+    coalesced = "juju_backup_all_exporter_coalesced_collections_total"
+
+    def make_collector(self, name, delay=0.0, error=None):
+        """Make a collector yielding a single gauge after an optional delay."""
+
+        def collect():
+            time.sleep(delay)
+            if error:
+                raise error
+            yield GaugeMetricFamily(name, "", value=1.0)
+
+        collector = Mock()
+        collector.describe.return_value = []
+        collector.collect.side_effect = collect
+        return collector
+
+    def test_collect_in_registration_order(self):
+        """Test metrics are yielded in registration order."""
+        registry = ConcurrentCollectorRegistry(max_workers=3)
+        for name, delay in [("a", 0.1), ("b", 0.0), ("c", 0.05)]:
+            registry.register(self.make_collector(name, delay))
+        names = [metric.name for metric in registry.collect()]
+        self.assertEqual(names, ["a", "b", "c"])
+
+    def test_collect_concurrently(self):
+        """Test collectors run at the same time."""
+        registry = ConcurrentCollectorRegistry(max_workers=4)
+        for name in "abcd":
+            registry.register(self.make_collector(name, delay=0.2))
+        start = time.monotonic()
+        self.assertEqual(len(list(registry.collect())), 4)
+        self.assertLess(time.monotonic() - start, 0.6)
+
+    def test_collect_isolates_failures(self):
+        """Test a failed or slow collector does not drop the others."""
+        registry = ConcurrentCollectorRegistry(max_workers=3, timeout=0.2)
+        registry.register(self.make_collector("a", error=ValueError("broken")))
+        registry.register(self.make_collector("b", delay=1.0))
+        registry.register(self.make_collector("c"))
+        start = time.monotonic()
+        names = [metric.name for metric in registry.collect()]
+        self.assertEqual(names, ["c"])
+        self.assertLess(time.monotonic() - start, 0.8)
+
+    def test_collect_after_finished_run(self):
+        """Test a scrape right after a run finished runs the collector again."""
+        registry = ConcurrentCollectorRegistry()
+        values = iter([1.0, 2.0])
+        collector = Mock()
+        collector.describe.return_value = []
+        collector.collect.side_effect = lambda: [GaugeMetricFamily("a", "", value=next(values))]
+        registry.register(collector)
+        done = registry._done
+
+        def late_done(*args):
+            # the done callbacks of a run are called after its waiters wake up
+            time.sleep(0.2)
+            done(*args)
+
+        with patch.object(registry, "_done", side_effect=late_done):
+            first = [metric.samples[0].value for metric in registry.collect()]
+            second = [metric.samples[0].value for metric in registry.collect()]
+        self.assertEqual((first, second), ([1.0], [2.0]))
+        self.assertEqual(collector.collect.call_count, 2)
+
+    def test_collect_does_not_join_finished_runs(self):
+        """Test a finished run whose done callback did not run yet is not shared."""
+        registry = ConcurrentCollectorRegistry()
+        collector = self.make_collector("a")
+        registry.register(collector)
+        finished = Future()
+        finished.set_result([])
+        registry._in_flight[collector] = finished
+        self.assertEqual([metric.name for metric in registry.collect()], ["a"])
+        collector.collect.assert_called_once()
+        # the late done callback of the finished run does not drop the new one
+        registry._done(collector, finished)
+        self.assertEqual(registry._in_flight, {})
+
+    def test_collect_coalesces_concurrent_scrapes(self):
+        """Test concurrent scrapes share a collector run already in flight."""
+        registry = ConcurrentCollectorRegistry()
+        collector = self.make_collector("a", delay=0.3)
+        registry.register(collector)
+        labels = {"collector": "Mock"}
+        before = REGISTRY.get_sample_value(self.coalesced, labels) or 0
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(list(registry.collect())))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(collector.collect.call_count, 1)
+        self.assertEqual([[metric.name for metric in result] for result in results], [["a"]] * 3)
+        self.assertEqual(REGISTRY.get_sample_value(self.coalesced, labels) - before, 2)
+
+        # the next scrape starts a new run
+        list(registry.collect())
+        self.assertEqual(collector.collect.call_count, 2)
+
+    def test_collect_restricted(self):
+        """Test restricted collection only runs the collectors owning the timeseries."""
+        registry = ConcurrentCollectorRegistry(target_info={"host": "abc"})
+        owner = self.make_collector("a")
+        owner.describe.return_value = [GaugeMetricFamily("a", "")]
+        other = self.make_collector("b")
+        other.describe.return_value = [GaugeMetricFamily("b", "")]
+        unnamed = self.make_collector("c")
+        for collector in [owner, other, unnamed]:
+            registry.register(collector)
+
+        restricted = registry.restricted_registry(["a", "c", "target_info", "unknown"])
+        names = [metric.name for metric in restricted.collect()]
+        self.assertEqual(names, ["target", "a", "c"])
+        owner.collect.assert_called_once()
+        other.collect.assert_not_called()
+        unnamed.collect.assert_called_once()
+
+        self.assertEqual(list(registry.restricted_registry(["b_total"]).collect()), [])
+
+    def test_poll(self):
+        """Test a poll only runs the given collectors, in a polling cycle."""
+        registry = ConcurrentCollectorRegistry()
+        polled = self.make_collector("a")
+        cycles = []
+        polled.collect.side_effect = lambda: cycles.append(core.current_cycle()) or []
+        unnamed = self.make_collector("b")
+        for collector in [polled, unnamed]:
+            registry.register(collector)
+        self.assertEqual(registry.poll([polled]), [])
+        unnamed.collect.assert_not_called()
+        self.assertTrue(cycles[0].poll)
+        list(registry.collect())
+        self.assertFalse(cycles[1].poll)
+
+    def test_collect_target_info(self):
+        """Test target info is yielded first."""
+        registry = ConcurrentCollectorRegistry(target_info={"host": "abc"})
+        registry.register(self.make_collector("a"))
+        names = [metric.name for metric in registry.collect()]
+        self.assertEqual(names, ["target", "a"])
+
+
+class ChurningCollector(BlockingCollector):
+    """Collector yielding a new label value on every collection."""
+
+    def __init__(self, config, ttl=None, max_series=None, label_budgets=None):
+        self.ttl = ttl
+        self.max_series = max_series
+        self.label_budgets = label_budgets
+        self.count = 0
+        super().__init__(config)
+
+    @property
+    def specifications(self):
+        return [
+            Specification(
+                name="churn",
+                documentation="",
+                labels=["id"],
+                metric_class=GaugeMetricFamily,
+                ttl=self.ttl,
+                max_series=self.max_series,
+                label_budgets=self.label_budgets,
+            )
+        ]
+
+    def fetch(self):
+        self.count += 1
+        return [Payload(name="churn", labels=[str(self.count)], value=1.0)]
+
+    def process(self, payloads, datastore):
+        return payloads
+
+
+class TestDatastoreEviction(unittest.TestCase):
+    """Datastore eviction test class."""
+
+    def evicted(self):
+        return REGISTRY.get_sample_value(
+            "juju_backup_all_exporter_datastore_evicted_total", {"metric": "churn"}
+        )
+
+    def test_describe(self):
+        """Test describe yields the metrics of the specifications without fetching."""
+        collector = ChurningCollector(Mock())
+        metrics = list(collector.describe())
+        self.assertEqual([(metric.name, metric.samples) for metric in metrics], [("churn", [])])
+        registry = ConcurrentCollectorRegistry()
+        registry.register(collector)
+        self.assertEqual(collector.count, 0)
+
+    def test_unbounded_datastore(self):
+        """Test datastore keeps every timeseries without limits."""
+        collector = ChurningCollector(Mock())
+        for _ in range(5):
+            list(collector.collect())
+        self.assertEqual(len(collector._datastore), 5)
+
+    def test_max_series_eviction(self):
+        """Test datastore keeps only the most recently seen timeseries."""
+        collector = ChurningCollector(Mock(), max_series=3)
+        before = self.evicted() or 0
+        for _ in range(5):
+            list(collector.collect())
+        self.assertEqual(
+            [payload.labels for payload in collector._datastore.values()],
+            [["3"], ["4"], ["5"]],
+        )
+        self.assertEqual(self.evicted() - before, 2)
+
+    @patch.object(core, "time")
+    def test_ttl_eviction(self, mock_time):
+        """Test datastore drops the timeseries not seen within ttl."""
+        collector = ChurningCollector(Mock(), ttl=10)
+        for now in [0, 5, 12, 30]:
+            mock_time.monotonic.return_value = now
+            list(collector.collect())
+        self.assertEqual([payload.labels for payload in collector._datastore.values()], [["4"]])
+
+    def test_memory_stays_flat_under_label_churn(self):
+        """Soak test the datastore memory under label churn."""
+        collector = ChurningCollector(Mock(), ttl=3600, max_series=100)
+        tracemalloc.start()
+        try:
+            # warm up until the datastore is full and its entries are being replaced
+            for _ in range(1000):
+                list(collector.collect())
+            start, _ = tracemalloc.get_traced_memory()
+            for _ in range(20000):
+                list(collector.collect())
+            end, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(collector._datastore), 100)
+        self.assertLess(end - start, 16 * 1024)
+
+
+class StaticCollector(BlockingCollector):
+    """Collector yielding the same payloads on every collection."""
+
+    def __init__(self, config, metric_class, payloads, allowed_values=None, label_budgets=None):
+        self.metric_class = metric_class
+        self.payloads = payloads
+        self.allowed_values = allowed_values
+        self.label_budgets = label_budgets
+        super().__init__(config)
+
+    @property
+    def specifications(self):
+        return [
+            Specification(
+                name="static",
+                documentation="",
+                labels=["kind", "id"],
+                metric_class=self.metric_class,
+                allowed_values=self.allowed_values,
+                label_budgets=self.label_budgets,
+            )
+        ]
+
+    def fetch(self):
+        return self.payloads
+
+    def process(self, payloads, datastore):
+        return payloads
+
+
+class TestLabelGuard(unittest.TestCase):
+    """Label guard test class."""
+
+    def collapsed(self, metric, label):
+        return (
+            REGISTRY.get_sample_value(
+                "juju_backup_all_exporter_collapsed_series_total",
+                {"metric": metric, "label": label},
+            )
+            or 0
+        )
+
+    def samples(self, collector):
+        return [
+            (sample.labels, sample.value)
+            for metric in collector.collect()
+            for sample in metric.samples
+            if not sample.name.endswith("_created")
+        ]
+
+    def test_label_budget(self):
+        """Test the values of a collection over the budget are collapsed."""
+        payloads = [
+            Payload(name="static", labels=["a", "1"], value=1.0),
+            Payload(name="static", labels=["a", "2"], value=2.0),
+            Payload(name="static", labels=["a", "3"], value=3.0),
+        ]
+        before = self.collapsed("static", "id")
+        collector = StaticCollector(Mock(), GaugeMetricFamily, payloads, label_budgets={"id": 2})
+        self.assertEqual(
+            [sample[0]["id"] for sample in self.samples(collector)],
+            ["1", "2", core.OVERFLOW_VALUE],
+        )
+        self.assertEqual(self.collapsed("static", "id") - before, 1)
+
+        # the values admitted before keep their place, the new ones take what is left
+        collector.payloads = [
+            Payload(name="static", labels=["a", "4"], value=4.0),
+            Payload(name="static", labels=["a", "3"], value=3.0),
+            Payload(name="static", labels=["a", "2"], value=2.0),
+        ]
+        self.assertEqual(
+            [sample[0]["id"] for sample in self.samples(collector)],
+            ["4", core.OVERFLOW_VALUE, "2"],
+        )
+
+    def test_label_budget_per_collection(self):
+        """Test the budget only counts the values of the current collection."""
+        collector = ChurningCollector(Mock(), ttl=3600, label_budgets={"id": 2})
+        for _ in range(5):
+            list(collector.collect())
+        # the values no longer collected free the budget, even if still in the datastore
+        self.assertEqual(
+            [payload.labels for payload in collector._datastore.values()],
+            [["1"], ["2"], ["3"], ["4"], ["5"]],
+        )
+        (guard,) = collector._guards["churn"]
+        self.assertEqual(guard.admitted, {"5"})
+
+    def test_label_guard_admit(self):
+        """Test the values not allowed are not admitted, and do not use the budget."""
+        guard = LabelGuard(
+            Specification(
+                "m",
+                ["a"],
+                "",
+                GaugeMetricFamily,
+                allowed_values={"a": frozenset(["x", "y"])},
+                label_budgets={"a": 1},
+            ),
+            "a",
+        )
+        guard.admit(["z", "y", "x", "y"])
+        self.assertEqual(guard.admitted, {"y"})
+        self.assertFalse(guard.check("z"))
+        self.assertFalse(guard.check("x"))
+        self.assertTrue(guard.check("y"))
+        guard.admit(["x"])
+        self.assertTrue(guard.check("x"))
+        self.assertFalse(guard.check("y"))
+
+    def test_allowed_values(self):
+        """Test the values not allowed are collapsed, and the counters summed."""
+        payloads = [
+            Payload(name="static", labels=["a", "1"], value=1.0),
+            Payload(name="static", labels=["b", "2"], value=2.0),
+            Payload(name="static", labels=["c", "3"], value=3.0),
+        ]
+        allowed_values = {"kind": frozenset(["a"])}
+        before = self.collapsed("static", "kind")
+        collector = StaticCollector(Mock(), CounterMetricFamily, payloads, allowed_values)
+        self.assertEqual(
+            self.samples(collector),
+            [
+                ({"kind": "a", "id": "1"}, 1.0),
+                ({"kind": core.OVERFLOW_VALUE, "id": "2"}, 2.0),
+                ({"kind": core.OVERFLOW_VALUE, "id": "3"}, 3.0),
+            ],
+        )
+        self.assertEqual(self.collapsed("static", "kind") - before, 2)
+
+        allowed_values["id"] = frozenset(["1"])
+        collector = StaticCollector(Mock(), CounterMetricFamily, payloads, allowed_values)
+        self.assertEqual(
+            self.samples(collector),
+            [
+                ({"kind": "a", "id": "1"}, 1.0),
+                ({"kind": core.OVERFLOW_VALUE, "id": core.OVERFLOW_VALUE}, 5.0),
+            ],
+        )
+        self.assertEqual([payload.value for payload in payloads], [1.0, 2.0, 3.0])
+
+        collector = StaticCollector(Mock(), GaugeMetricFamily, payloads, allowed_values)
+        self.assertEqual(
+            self.samples(collector)[1],
+            ({"kind": core.OVERFLOW_VALUE, "id": core.OVERFLOW_VALUE}, 3.0),
+        )
+
+    def test_unguarded(self):
+        """Test the payloads of collectors without guards are left as they are."""
+        payloads = [Payload(name="static", labels=["b", "2"], value=2.0)]
+        collector = StaticCollector(Mock(), GaugeMetricFamily, payloads)
+        self.assertIs(collector.guard_labels(payloads), payloads)
+
+    def test_unknown_label(self):
+        """Test a guard on a label the metric does not have is rejected."""
+        with pytest.raises(ValueError, match="has no label"):
+            StaticCollector(Mock(), GaugeMetricFamily, [], {"missing": frozenset()})
@@ -0,0 +1,151 @@
+import threading
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from prometheus_juju_backup_all_exporter import debug
+from prometheus_juju_backup_all_exporter.debug import SamplingProfiler, debug_app
+
+
+def request(path, query=""):
+    """Call the debug app and return the status and the body."""
+    environ = {"PATH_INFO": path, "QUERY_STRING": query}
+    setup_testing_defaults(environ)
+    start_response = Mock()
+    body = b"".join(debug_app(environ, start_response)).decode()
+    return start_response.call_args[0][0], body
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+@pytest.fixture()
+def busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop,), name="busy")
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+def test_healthz():
+    """Test the health check."""
+    assert request("/healthz") == ("200 OK", "ok\n")
+
+
+def test_not_found():
+    """Test the unknown paths."""
+    assert request("/metrics")[0] == "404 Not Found"
+
+
+def test_profile_collapsed(busy_thread):
+    """Test the profile returns the collapsed stacks of the other threads."""
+    status, body = request("/debug/profile", "seconds=0.1")
+    assert status == "200 OK"
+    stacks = [line.rsplit(" ", 1) for line in body.splitlines()]
+    busy = [stack for stack, count in stacks if stack.startswith("busy;")]
+    assert busy
+    assert all("busy_loop (test_debug.py:" in stack for stack in busy)
+    assert not any("profile_app" in stack for stack, _ in stacks)
+    assert all(int(count) > 0 for _, count in stacks)
+
+
+def test_profile_top(busy_thread):
+    """Test the flat profile counts the samples in and under each function."""
+    status, body = request("/debug/profile", "seconds=0.05&format=top")
+    assert status == "200 OK"
+    lines = body.splitlines()
+    assert "samples every 5.0 ms" in lines[0]
+    assert lines[1].split() == ["own", "own%", "cum", "cum%", "function"]
+    assert any(line.endswith(")") and "busy_loop" in line for line in lines[2:])
+
+
+def test_profiler_top():
+    """Test the flat profile of known stacks."""
+    profiler = SamplingProfiler()
+    profiler.samples = 4
+    profiler.stacks.update({("main", "a", "b"): 3, ("main", "a"): 1})
+    assert profiler.top().splitlines()[2:] == [
+        "       3   75.0%        3   75.0%  b",
+        "       1   25.0%        4  100.0%  a",
+    ]
+
+
+@pytest.mark.parametrize(
+    "path, query",
+    [
+        ("/debug/profile", "seconds=0"),
+        ("/debug/profile", "seconds=61"),
+        ("/debug/profile", "format=pstats"),
+        ("/debug/tracemalloc", "seconds=x"),
+        ("/debug/tracemalloc", "key=x"),
+        ("/debug/tracemalloc", "limit=0"),
+    ],
+)
+def test_invalid_query(path, query):
+    """Test the invalid parameters are rejected."""
+    assert request(path, query)[0] == "400 Bad Request"
+
+
+@pytest.mark.parametrize("path", ["/debug/profile", "/debug/tracemalloc"])
+def test_one_session(path):
+    """Test a single profile or allocation trace runs at a time."""
+    with debug._session_lock:
+        assert request(path, "seconds=0.01")[0] == "409 Conflict"
+
+
+def test_threads(busy_thread):
+    """Test the thread dump holds the stacks of all the threads."""
+    status, body = request("/debug/threads")
+    assert status == "200 OK"
+    assert f"Thread busy (ident {busy_thread.ident}, daemon False):" in body
+    assert "in busy_loop" in body
+    assert "in threads_app" in body
+
+
+def test_tracemalloc():
+    """Test the allocations are traced during the request only."""
+    leak = []
+
+    def allocate():
+        time.sleep(0.02)
+        leak.extend(bytearray(1000) for _ in range(100))
+
+    thread = threading.Thread(target=allocate)
+    thread.start()
+    status, body = request("/debug/tracemalloc", "seconds=0.1&limit=3")
+    thread.join()
+    assert status == "200 OK"
+    lines = body.splitlines()
+    assert lines[0].endswith("allocations by lineno:")
+    assert len(lines) <= 4
+    assert "test_debug.py" in lines[1]
+    assert not tracemalloc.is_tracing()
+
+
+def test_tracemalloc_already_tracing():
+    """Test the tracing started before the request is left running."""
+    tracemalloc.start()
+    try:
+        status, body = request("/debug/tracemalloc", "seconds=0.01&key=traceback&limit=1")
+        assert status == "200 OK"
+        assert body.startswith("Top 1 of ")
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+@patch.object(debug.sys, "_current_frames")
+def test_profiler_unknown_thread(mock_current_frames):
+    """Test the threads not started by the threading module are named by their ident."""
+    frame = Mock(f_back=None, f_code=Mock(co_name="f", co_filename="/a/b.py", co_firstlineno=1))
+    mock_current_frames.return_value = {1: frame}
+    profiler = SamplingProfiler()
+    profiler.sample()
+    assert profiler.stacks == {("1", "f (b.py:1)"): 1}
@@ -1,20 +1,296 @@
+import os
+import socket
+import threading
 from unittest.mock import Mock, patch
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics_core import GaugeMetricFamily
 
 from prometheus_juju_backup_all_exporter import exporter
-from prometheus_juju_backup_all_exporter.exporter import Exporter
+from prometheus_juju_backup_all_exporter.core import ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.exporter import (
+    EventStream,
+    Exporter,
+    SlientRequestHandler,
+    ThreadingWSGIServer,
+    UnixWSGIServer,
+    inherited_sockets,
+)
+from prometheus_juju_backup_all_exporter.utils import BackupEventDelta, BackupRun
+
+
+class DummyCollector:
+    """Collector yielding a single gauge."""
+
+    def __init__(self, name="dummy"):
+        self.name = name
+        self.calls = 0
+
+    def describe(self):
+        yield GaugeMetricFamily(self.name, "Dummy metric.")
+
+    def collect(self):
+        self.calls += 1
+        yield GaugeMetricFamily(self.name, "Dummy metric.", value=1.0)
+
+
+def http_get(sock, path="/metrics"):
+    """Send a GET request over the connected socket and return the response."""
+    sock.sendall(f"GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n".encode())
+    response = b""
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return response
+        response += data
+
+
+@pytest.fixture()
+def test_exporter(tmp_path):
+    test_exporter = Exporter(
+        0,
+        addr="127.0.0.1",
+        registry=ConcurrentCollectorRegistry(),
+        unix_socket=str(tmp_path / "exporter.sock"),
+    )
+    test_exporter.register(DummyCollector())
+    yield test_exporter
+    for server in test_exporter.servers:
+        server.shutdown()
+        server.server_close()
 
 
 class TestExporter:
     """Exporter test class."""
 
     @patch.object(exporter, "threading")
-    @patch.object(exporter, "REGISTRY")
+    @patch.object(exporter, "ConcurrentCollectorRegistry")
     @patch.object(exporter, "make_server")
-    def test_exporter(self, mock_make_server, mock_registry, mock_threading):
-        exporter = Exporter(10000)
-        exporter.register(Mock())
-        exporter.run(daemon=True)
+    def test_exporter(self, mock_make_server, mock_registry_class, mock_threading):
+        mock_registry = mock_registry_class.return_value
+        test_exporter = Exporter(10000)
+        mock_registry.register.assert_called_once_with(exporter.REGISTRY)
+        test_exporter.register(Mock())
+        test_exporter.run(daemon=True)
 
         mock_make_server.assert_called_once()
-        mock_registry.register.assert_called_once()
+        assert mock_registry.register.call_count == 2
         mock_threading.Thread.assert_called_once()
+        mock_threading.Thread.return_value.join.assert_not_called()
+
+        # the main thread serves until the servers are shut down
+        test_exporter.run()
+        mock_threading.Thread.return_value.join.assert_called_once()
+        test_exporter.shutdown()
+        mock_make_server.return_value.shutdown.assert_called()
+        mock_make_server.return_value.server_close.assert_called()
+
+    @patch.object(exporter, "make_wsgi_app")
+    def test_exporter_custom_registry(self, mock_make_wsgi_app):
+        mock_registry = Mock()
+        test_exporter = Exporter(10000, registry=mock_registry)
+        assert test_exporter.registry is mock_registry
+        mock_make_wsgi_app.assert_called_once_with(mock_registry)
+
+
+def test_exporter_unix_socket(test_exporter, tmp_path):
+    """Test the exporter serves on both the TCP port and the Unix socket."""
+    # a stale socket file left by a previous run
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(test_exporter.unix_socket)
+    stale.close()
+
+    test_exporter.run(daemon=True)
+    tcp_server, unix_server = test_exporter.servers
+    assert isinstance(unix_server, UnixWSGIServer)
+
+    with socket.create_connection(tcp_server.server_address) as sock:
+        assert b"dummy 1.0" in http_get(sock)
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(test_exporter.unix_socket)
+        response = http_get(sock)
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert b"dummy 1.0" in response
+
+    # the socket file is removed on shutdown
+    test_exporter.shutdown()
+    assert not os.path.exists(test_exporter.unix_socket)
+
+
+def test_unix_server_close_removed(tmp_path):
+    """Test closing a server whose socket file was already removed."""
+    path = str(tmp_path / "exporter.sock")
+    server = UnixWSGIServer(path, SlientRequestHandler)
+    os.unlink(path)
+    server.server_close()
+    assert server.bound_path is None
+
+
+@pytest.mark.parametrize("family", [socket.AF_INET, socket.AF_UNIX])
+def test_exporter_socket_activation(test_exporter, tmp_path, monkeypatch, family):
+    """Test the exporter serves only on the sockets passed by the service manager."""
+    listener = socket.socket(family)
+    listener.bind(("127.0.0.1", 0) if family == socket.AF_INET else str(tmp_path / "sd.sock"))
+    listener.listen()
+    address = listener.getsockname()
+    # the exporter owns the file descriptor from now on
+    fd = listener.detach()
+    monkeypatch.setattr(exporter, "SD_LISTEN_FDS_START", fd)
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid()))
+    monkeypatch.setenv("LISTEN_FDS", "1")
+
+    test_exporter.run(daemon=True)
+    (server,) = test_exporter.servers
+    assert isinstance(server, ThreadingWSGIServer)
+    assert server.socket.fileno() == fd
+    assert "LISTEN_FDS" not in os.environ
+
+    with socket.socket(family) as sock:
+        sock.connect(address)
+        assert b"dummy 1.0" in http_get(sock)
+
+    # the socket file of the service manager is left in place
+    test_exporter.shutdown()
+    if family == socket.AF_UNIX:
+        assert os.path.exists(address)
+
+
+def test_exporter_debug(tmp_path):
+    """Test the debug endpoints are served on the loopback only, and /healthz everywhere."""
+    test_exporter = Exporter(0, addr="127.0.0.1", registry=Mock(), debug_port=0)
+    test_exporter.run(daemon=True)
+    try:
+        server, debug_server = test_exporter.servers
+        assert debug_server.server_address[0] == exporter.DEBUG_ADDRESS
+        with socket.create_connection(debug_server.server_address) as sock:
+            assert b"Thread MainThread" in http_get(sock, "/debug/threads")
+        with socket.create_connection(server.server_address) as sock:
+            response = http_get(sock, "/healthz")
+        assert response.startswith(b"HTTP/1.0 200 OK")
+        assert response.endswith(b"\r\n\r\nok\n")
+        test_exporter.registry.collect.assert_not_called()
+    finally:
+        for server in test_exporter.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_inherited_sockets_other_process(monkeypatch):
+    """Test the sockets passed to another process are ignored."""
+    monkeypatch.setenv("LISTEN_PID", str(os.getpid() + 1))
+    monkeypatch.setenv("LISTEN_FDS", "1")
+    assert inherited_sockets() == []
+
+
+def test_exporter_name_filter(test_exporter):
+    """Test the name[] query parameters only run the collectors owning the metrics."""
+    other = DummyCollector("other")
+    test_exporter.register(other)
+    environ = {"QUERY_STRING": "name[]=dummy"}
+    setup_testing_defaults(environ)
+    output = b"".join(test_exporter.app(environ, Mock()))
+    assert b"dummy 1.0" in output
+    assert b"other" not in output
+    assert other.calls == 0
+
+
+def test_exporter_routes(test_exporter):
+    """Test the requests are dispatched by path, the other paths serve the metrics."""
+    route = Mock(return_value=[b"route"])
+    test_exporter.add_route("/api/test", route)
+    environ = {"PATH_INFO": "/api/test"}
+    setup_testing_defaults(environ)
+    assert test_exporter.app(environ, Mock()) == [b"route"]
+    environ = {"PATH_INFO": "/metrics"}
+    setup_testing_defaults(environ)
+    assert b"dummy 1.0" in b"".join(test_exporter.app(environ, Mock()))
+
+
+def read_until(sock, marker):
+    """Read from the connected socket until the marker is received."""
+    data = b""
+    while marker not in data:
+        data += sock.recv(65536)
+    return data
+
+
+def test_event_stream(test_exporter):
+    """Test the events are pushed to the connected clients as they are published."""
+    stream = EventStream(keepalive=60)
+    test_exporter.add_route("/events", stream.app)
+    test_exporter.run(daemon=True)
+    with socket.create_connection(test_exporter.servers[0].server_address) as sock:
+        sock.sendall(b"GET /events HTTP/1.0\r\nHost: localhost\r\n\r\n")
+        headers = read_until(sock, b": connected")
+        assert b"text/event-stream" in headers
+        stream.publish(BackupRun(time=1.0, duration=2.0, status_ok=1, result_code=0))
+        event = read_until(sock, b"\n\n")
+    assert event == (
+        b'id: 1\nevent: run\ndata: {"time":1.0,"duration":2.0,"status_ok":1,"result_code":0}\n\n'
+    )
+
+
+def test_event_stream_fan_out():
+    """Test every client receives the events, and leaves the stream on close."""
+    stream = EventStream()
+    clients = [stream.app({}, Mock()) for _ in range(3)]
+    for client in clients:
+        assert next(client) == b": connected\n\n"
+    stream.publish(BackupEventDelta(time=1.0, failed=1, purged=0, completed=2))
+    for client in clients:
+        assert b"event: event\n" in next(client)
+        client.close()
+    assert not stream._subscribers
+
+
+def test_event_stream_drops_slow_clients():
+    """Test a client whose queue is full is dropped without affecting the others."""
+    stream = EventStream(queue_size=1)
+    slow, fast = stream.app({}, Mock()), stream.app({}, Mock())
+    next(slow), next(fast)
+    dropped = REGISTRY.get_sample_value(
+        "juju_backup_all_exporter_events_dropped_subscribers_total"
+    )
+    record = BackupEventDelta(time=1.0, failed=1, purged=0, completed=0)
+    stream.publish(record)
+    next(fast)
+    stream.publish(record)
+    assert (
+        REGISTRY.get_sample_value("juju_backup_all_exporter_events_dropped_subscribers_total")
+        == dropped + 1
+    )
+    assert b"id: 2" in next(fast)
+    # the stream ends, the client is expected to reconnect
+    with pytest.raises(StopIteration):
+        next(slow)
+
+
+def test_event_stream_keepalive():
+    """Test a comment is sent when no event was published for a while."""
+    client = EventStream(keepalive=0.01).app({}, Mock())
+    next(client)
+    assert next(client) == b": keepalive\n\n"
+    client.close()
+
+
+def test_event_stream_polls_while_connected():
+    """Test the collectors are polled only while clients are connected."""
+    polled = threading.Event()
+    calls = []
+
+    def poll():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        polled.set()
+
+    stream = EventStream(poll=poll, poll_interval=0.01)
+    client = stream.app({}, Mock())
+    next(client)
+    poller = stream._poller
+    assert polled.wait(5)
+    client.close()
+    poller.join(5)
+    assert stream._poller is None
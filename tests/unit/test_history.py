@@ -0,0 +1,156 @@
+import json
+from unittest.mock import Mock, patch
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from prometheus_juju_backup_all_exporter import history
+from prometheus_juju_backup_all_exporter.history import HistoryStore, make_history_app
+from prometheus_juju_backup_all_exporter.utils import BackupEventDelta, BackupRun
+
+
+@pytest.fixture()
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), retention=3600, batch_size=3)
+    yield store
+    store.close()
+
+
+def run(time, result_code=0):
+    return BackupRun(time=time, duration=1.5, status_ok=1, result_code=result_code)
+
+
+def count(store):
+    return store._connection.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+
+def test_record_in_batches(store):
+    """Test the records are inserted once a batch is complete."""
+    now = history.time.time()
+    store.record(run(now - 2))
+    store.record(run(now - 1))
+    assert count(store) == 0
+    store.record(BackupEventDelta(time=now, failed=1, purged=0, completed=2))
+    assert count(store) == 3
+
+
+def test_record_after_flush_interval(store):
+    """Test a pending record is inserted once the flush interval passed."""
+    now = history.time.time()
+    store.record(run(now - 1))
+    with patch.object(history.time, "monotonic", return_value=history.time.monotonic() + 10):
+        store.record(run(now))
+    assert count(store) == 2
+
+
+def test_record_flushed_by_timer(tmp_path):
+    """Test a pending record is inserted after the flush interval without other records."""
+    store = HistoryStore(str(tmp_path / "history.db"), retention=3600, flush_interval=0.1)
+    store.record(run(history.time.time()))
+    assert store._timer is not None
+    store._timer.join()
+    assert store._timer is None
+    assert count(store) == 1
+    store.record(run(history.time.time() + 1))
+    timer = store._timer
+    store.close()
+    # closing inserts the pending record and cancels the timer
+    assert timer.finished.is_set()
+    assert count(HistoryStore(str(tmp_path / "history.db"), retention=3600)) == 2
+
+
+def test_duplicate_runs_ignored(tmp_path):
+    """Test a run recorded again after a restart is stored once."""
+    path = str(tmp_path / "history.db")
+    now = history.time.time()
+    for _ in range(2):
+        store = HistoryStore(path, retention=3600)
+        store.record(run(now))
+        store.close()
+    store = HistoryStore(path, retention=3600)
+    items, _ = store.query()
+    store.close()
+    assert len(items) == 1
+
+
+def test_retention(store):
+    """Test the records older than the retention are pruned."""
+    now = history.time.time()
+    store.record(run(now - 7200))
+    store.record(run(now - 60))
+    store.flush()
+    items, _ = store.query()
+    assert [item["time"] for item in items] == [now - 60]
+
+
+def test_query_pages(store):
+    """Test the pages are returned most recent first and chained by cursor."""
+    now = history.time.time()
+    for i in range(5):
+        store.record(run(now - 10 + i, result_code=i))
+    store.record(BackupEventDelta(time=now, failed=0, purged=1, completed=0))
+
+    items, cursor = store.query(limit=2, kind="run")
+    assert [item["result_code"] for item in items] == [4, 3]
+    assert "failed" not in items[0]
+    items, cursor = store.query(limit=2, before=cursor, kind="run")
+    assert [item["result_code"] for item in items] == [2, 1]
+    items, cursor = store.query(limit=2, before=cursor, kind="run")
+    assert [item["result_code"] for item in items] == [0]
+    assert cursor is None
+
+    items, cursor = store.query(kind="event")
+    assert items[0]["purged"] == 1
+    assert "duration" not in items[0]
+    assert cursor is None
+
+
+@pytest.mark.parametrize("kind", [None, "run"])
+def test_query_plan(store, kind):
+    """Test the pages are read from an index in id order, without a sort."""
+    statements = []
+    store._connection.set_trace_callback(statements.append)
+    store.query(limit=2, before=10, kind=kind)
+    store._connection.set_trace_callback(None)
+    [select] = [statement for statement in statements if statement.startswith("SELECT")]
+    plan = " ".join(row[-1] for row in store._connection.execute(f"EXPLAIN QUERY PLAN {select}"))
+    assert "TEMP B-TREE" not in plan
+    if kind is not None:
+        assert "history_kind_id" in plan
+
+
+def test_close_without_open(tmp_path):
+    """Test closing a store never used does not create the database."""
+    HistoryStore(str(tmp_path / "history.db"), retention=3600).close()
+    assert not (tmp_path / "history.db").exists()
+
+
+def call_app(app, query):
+    environ = {"QUERY_STRING": query}
+    setup_testing_defaults(environ)
+    start_response = Mock()
+    body = json.loads(b"".join(app(environ, start_response)))
+    return start_response.call_args.args[0], body
+
+
+def test_history_app(store):
+    """Test the app serves the pages as JSON."""
+    now = history.time.time()
+    for i in range(3):
+        store.record(run(now - i))
+    app = make_history_app(store)
+    status, body = call_app(app, "limit=2&kind=run")
+    assert status == "200 OK"
+    assert len(body["items"]) == 2
+    status, body = call_app(app, f"cursor={body['next_cursor']}")
+    assert status == "200 OK"
+    assert len(body["items"]) == 1
+    assert body["next_cursor"] is None
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=abc", "cursor=abc", "kind=other"])
+def test_history_app_invalid_query(store, query):
+    """Test the app rejects invalid query parameters."""
+    status, body = call_app(make_history_app(store), query)
+    assert status == "400 Bad Request"
+    assert "error" in body
@@ -0,0 +1,68 @@
+import json
+import logging
+
+import pytest
+
+from prometheus_juju_backup_all_exporter.config import Config
+from prometheus_juju_backup_all_exporter.oneshot import Timings, render, run_bench
+
+
+@pytest.fixture()
+def config(tmp_path):
+    (tmp_path / "backup_stats.json").write_text(
+        json.dumps({"duration": 12.5, "status_ok": 1, "result_code": 0})
+    )
+    (tmp_path / "backup_state.json").write_text(
+        json.dumps({"failed": 1, "purged": 2, "completed": 3})
+    )
+    return Config(backup_path=str(tmp_path), history_file=None)
+
+
+@pytest.mark.parametrize("remove_events", [True, False])
+def test_render(config, tmp_path, remove_events):
+    """Test the exposition of the backup collectors is rendered once."""
+    output = render(config, remove_events=remove_events).decode()
+    assert (
+        'juju_backup_all_command_duration_seconds{result_code="StatusOK",status_ok="1"} 12.5'
+        in output
+    )
+    assert "juju_backup_all_backup_completed_total 3.0" in output
+    assert "process_cpu_seconds_total" not in output
+    assert (tmp_path / "backup_state.json").exists() is not remove_events
+
+
+def test_render_keeps_events(config, tmp_path):
+    """Test render leaves the backup event file to the running exporter by default."""
+    render(config)
+    assert (tmp_path / "backup_state.json").exists()
+
+
+def test_run_bench(config, tmp_path, caplog):
+    """Test the phases of every cycle are timed, leaving the backup directory untouched."""
+    caplog.set_level(logging.DEBUG)
+    (tmp_path / "backup_stats.json").write_text("{}")
+    timings = run_bench(config, 3)
+    assert timings.cycles == 3
+    for phase in ("fetch", "process", "collect"):
+        assert len(timings.durations[("BackupStatsCollector", phase)]) == 3
+        assert len(timings.durations[("BackupEventCollector", phase)]) == 3
+    for phase in ("collect", "render", "total"):
+        assert len(timings.durations[("cycle", phase)]) == 3
+    assert (tmp_path / "backup_state.json").exists()
+    # the invalid backup stats file is only reported once
+    assert len([r for r in caplog.records if r.levelno >= logging.ERROR]) == 1
+    assert logging.root.manager.disable == logging.NOTSET
+
+
+def test_timings_report():
+    """Test the report has a line per scope and phase, in milliseconds."""
+    timings = Timings()
+    timings.cycles = 2
+    timings.add("cycle", "total", 0.001)
+    timings.add("cycle", "total", 0.003)
+    timed = timings.timed("scope", "phase", lambda value: value)
+    assert timed(42) == 42
+    lines = timings.report().splitlines()
+    assert lines[0] == "2 cycles"
+    assert lines[2].split() == ["cycle", "total", "2.000", "2.000", "3.000", "3.000"]
+    assert lines[3].split()[:2] == ["scope", "phase"]
@@ -0,0 +1,365 @@
+import http.client
+import os
+import signal
+import socket
+import ssl
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, generate_latest
+from prometheus_client.metrics_core import GaugeMetricFamily
+
+from prometheus_juju_backup_all_exporter import prefork
+from prometheus_juju_backup_all_exporter.core import ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.exporter import SlientRequestHandler
+from prometheus_juju_backup_all_exporter.prefork import (
+    PreforkExporter,
+    ReusePortWSGIServer,
+    SharedExposition,
+    WorkerCounters,
+    make_shared_app,
+    restrict_exposition,
+)
+from prometheus_juju_backup_all_exporter.tls import ServerTLS
+
+CERTS = os.path.join(os.path.dirname(__file__), "certs")
+
+
+class DummyCollector:
+    """Collector yielding a single gauge."""
+
+    def describe(self):
+        yield GaugeMetricFamily("dummy", "Dummy metric.")
+
+    def collect(self):
+        yield GaugeMetricFamily("dummy", "Dummy metric.", value=1.0)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestSharedExposition(unittest.TestCase):
+    """SharedExposition test class."""
+
+    def test_write_read(self):
+        """Test the published exposition is read back."""
+        shared = SharedExposition(16)
+        self.assertIsNone(shared.read())
+        shared.write(b"first exposition")
+        self.assertEqual(shared.read(), b"first exposition")
+        shared.write(b"second")
+        self.assertEqual(shared.read(), b"second")
+        self.assertAlmostEqual(shared.rendered_at, time.time(), delta=5)
+
+    def test_write_too_large(self):
+        """Test the exposition larger than the shared memory is rejected."""
+        shared = SharedExposition(4)
+        with pytest.raises(ValueError):
+            shared.write(b"too large")
+
+    def test_read_waits_for_writer(self):
+        """Test a reader retries while the writer is writing."""
+        shared = SharedExposition(16)
+        shared.write(b"old")
+        # simulate a writer in the middle of a write
+        sequence, length, rendered_at = shared.HEADER.unpack_from(shared._mmap)
+        shared.HEADER.pack_into(shared._mmap, 0, sequence + 1, length, rendered_at)
+
+        def finish_write():
+            time.sleep(0.05)
+            shared._mmap[shared.HEADER.size : shared.HEADER.size + 3] = b"new"  # noqa: E203
+            shared.HEADER.pack_into(shared._mmap, 0, sequence + 2, 3, rendered_at)
+
+        thread = threading.Thread(target=finish_write)
+        thread.start()
+        self.assertEqual(shared.read(), b"new")
+        thread.join()
+
+    def test_shared_app(self):
+        """Test the app serves the shared exposition once published."""
+        shared = SharedExposition(16)
+        app = make_shared_app(shared)
+        environ = {}
+        setup_testing_defaults(environ)
+        start_response = Mock()
+        self.assertEqual(app(environ, start_response), [b"No metrics collected yet.\n"])
+        self.assertEqual(start_response.call_args[0][0], "503 Service Unavailable")
+        shared.write(b"metrics")
+        self.assertEqual(app(environ, start_response), [b"metrics"])
+        self.assertEqual(start_response.call_args[0][0], "200 OK")
+
+    def test_shared_app_restricted(self):
+        """Test the app only serves the samples of the name[] parameters."""
+        registry = CollectorRegistry()
+        Counter("first", "First counter.", ["kind"], registry=registry).labels(kind="a").inc()
+        Counter("second", "Second counter.", registry=registry).inc()
+        shared = SharedExposition(4096)
+        shared.write(generate_latest(registry))
+        app = make_shared_app(shared)
+        environ = {"QUERY_STRING": "name[]=first_total&name[]=missing"}
+        setup_testing_defaults(environ)
+        [data] = app(environ, Mock())
+        self.assertEqual(
+            data,
+            b"# HELP first_total First counter.\n"
+            b"# TYPE first_total counter\n"
+            b'first_total{kind="a"} 1.0\n',
+        )
+
+    def test_restrict_exposition(self):
+        """Test a family is kept with its metadata only if one of its samples is."""
+        data = (
+            b"# HELP a_total A.\n# TYPE a_total counter\na_total 1.0\na_created 2.0\n"
+            b'# HELP b B.\n# TYPE b gauge\nb{x="a b"} 3.0\n'
+        )
+        self.assertEqual(
+            restrict_exposition(data, {"a_created", "b"}),
+            b"# HELP a_total A.\n# TYPE a_total counter\na_created 2.0\n"
+            b'# HELP b B.\n# TYPE b gauge\nb{x="a b"} 3.0\n',
+        )
+        self.assertEqual(restrict_exposition(data, {"c"}), b"")
+
+    def test_shared_app_unsupported_routes(self):
+        """Test the routes of the single-process exporter are not found."""
+        shared = SharedExposition(16)
+        shared.write(b"metrics")
+        app = make_shared_app(shared)
+        for path in prefork.UNSUPPORTED_ROUTES:
+            environ = {"PATH_INFO": path}
+            setup_testing_defaults(environ)
+            start_response = Mock()
+            self.assertNotEqual(app(environ, start_response), [b"metrics"])
+            self.assertEqual(start_response.call_args[0][0], "404 Not Found")
+
+    def test_shared_app_healthz(self):
+        """Test the health check is served before any metrics are published."""
+        app = make_shared_app(SharedExposition(16))
+        environ = {"PATH_INFO": "/healthz"}
+        setup_testing_defaults(environ)
+        start_response = Mock()
+        self.assertEqual(app(environ, start_response), [b"ok\n"])
+        self.assertEqual(start_response.call_args[0][0], "200 OK")
+
+
+class TestWorkerCounters(unittest.TestCase):
+    """WorkerCounters test class."""
+
+    def test_aggregate(self):
+        """Test the increments of the workers since they started are added once."""
+
+        def make_counters():
+            registry = CollectorRegistry()
+            labelled = Counter("labelled", "Labelled.", ["kind"], registry=registry)
+            labelled.labels(kind="a").inc(5)
+            plain = Counter("plain", "Plain.", registry=registry)
+            return registry, WorkerCounters([labelled, plain], 2)
+
+        # the copies of the counters in a worker and in the collector process,
+        # both at 5 at fork time, which is not an increment of the worker
+        _, worker = make_counters()
+        registry, collector = make_counters()
+        collector._slots = worker._slots
+        worker.start_worker()
+        labelled, plain = worker.counters
+        labelled.labels(kind="a").inc(2)
+        plain.inc()
+        worker.publish(0)
+        worker.publish(1)
+        collector.aggregate()
+        self.assertEqual(registry.get_sample_value("labelled_total", {"kind": "a"}), 9)
+        self.assertEqual(registry.get_sample_value("plain_total"), 2)
+        collector.aggregate()
+        self.assertEqual(registry.get_sample_value("plain_total"), 2)
+        plain.inc()
+        worker.publish(1)
+        collector.aggregate()
+        self.assertEqual(registry.get_sample_value("plain_total"), 3)
+
+    def test_aggregate_nothing_published(self):
+        """Test the workers that did not publish yet are skipped."""
+        registry = CollectorRegistry()
+        plain = Counter("plain", "Plain.", registry=registry)
+        WorkerCounters([plain], 2).aggregate()
+        self.assertEqual(registry.get_sample_value("plain_total"), 0)
+
+
+class TestPrefork(unittest.TestCase):
+    """Pre-fork exporter test class."""
+
+    def test_reuse_port(self):
+        """Test the workers can bind the same port."""
+        first = ReusePortWSGIServer(("127.0.0.1", 0), SlientRequestHandler)
+        second = ReusePortWSGIServer(first.server_address, SlientRequestHandler)
+        self.assertEqual(first.server_address, second.server_address)
+        first.server_close()
+        second.server_close()
+
+    @patch.object(prefork.os, "getppid", side_effect=[1, 1, 2])
+    def test_run_collector(self, _):
+        """Test the collector process publishes until the parent is gone."""
+        registry = ConcurrentCollectorRegistry()
+        registry.register(DummyCollector())
+        broken = ConcurrentCollectorRegistry()
+        broken.register(DummyCollector())
+        shared = SharedExposition(1024)
+        counters = Mock()
+        prefork._run_collector(registry, shared, 0, 1, counters=counters)
+        self.assertIn(b"dummy 1.0", shared.read())
+        self.assertEqual(counters.aggregate.call_count, 2)
+
+        with patch.object(prefork, "generate_latest", side_effect=ValueError("broken")):
+            with patch.object(prefork.os, "getppid", side_effect=[1, 2]):
+                prefork._run_collector(registry, shared, 0, 1)
+
+    @patch.object(prefork.os, "getppid", return_value=2)
+    def test_run_collector_on_exit(self, _):
+        """Test the collector process calls on_exit, also when terminated."""
+        on_exit = Mock()
+        handler = signal.getsignal(signal.SIGTERM)
+        try:
+            prefork._run_collector(
+                ConcurrentCollectorRegistry(), SharedExposition(16), 0, 1, on_exit=on_exit
+            )
+            self.assertIs(signal.getsignal(signal.SIGTERM), prefork._exit_on_signal)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        on_exit.assert_called_once()
+        with self.assertRaises(SystemExit) as exit:
+            prefork._exit_on_signal(signal.SIGTERM, None)
+        self.assertEqual(exit.exception.code, 128 + signal.SIGTERM)
+
+    @patch.object(prefork.os, "getppid", return_value=2)
+    @patch.object(prefork, "make_debug_server")
+    def test_run_collector_debug(self, mock_make_debug_server, _):
+        """Test the collector process serves the debug endpoints if enabled."""
+        prefork._run_collector(ConcurrentCollectorRegistry(), SharedExposition(16), 0, 1, 9100)
+        mock_make_debug_server.assert_called_once_with(9100)
+
+    @patch.object(prefork, "PARENT_CHECK_INTERVAL", 0)
+    @patch.object(prefork.os, "getppid", side_effect=[1, 1, 2])
+    @patch.object(prefork, "ReusePortWSGIServer")
+    def test_run_worker(self, mock_server, _):
+        """Test the worker serves the shared exposition until the parent is gone."""
+        shared = SharedExposition(16)
+        tls = Mock()
+        counters = Mock()
+        prefork._run_worker("127.0.0.1", 10000, shared, 1, tls, counters, 3)
+        mock_server.assert_called_once_with(("127.0.0.1", 10000), SlientRequestHandler)
+        mock_server.return_value.set_app.assert_called_once()
+        mock_server.return_value.enable_tls.assert_called_once_with(tls)
+        mock_server.return_value.serve_forever.assert_called_once()
+        counters.start_worker.assert_called_once()
+        self.assertEqual(counters.publish.call_args_list, [((3,),), ((3,),)])
+
+    def test_prefork_exporter(self):
+        """Test the workers serve the metrics collected by the collector process."""
+        registry = ConcurrentCollectorRegistry()
+        registry.register(DummyCollector())
+        port = free_port()
+        exporter = PreforkExporter(port, registry, 2, addr="127.0.0.1", interval=0.1)
+        exporter.start()
+        try:
+            self.assertEqual(len(exporter.processes), 3)
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                    connection.request("GET", "/metrics")
+                    response = connection.getresponse()
+                    if response.status == 200:
+                        break
+                except ConnectionRefusedError:
+                    pass
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+            self.assertIn(b"dummy 1.0", response.read())
+        finally:
+            exporter.stop()
+        self.assertTrue(all(not process.is_alive() for process in exporter.processes))
+
+    @patch.object(prefork, "PARENT_CHECK_INTERVAL", 0.05)
+    def test_prefork_exporter_tls_handshakes(self):
+        """Test the TLS handshakes of the workers are counted in the exposition."""
+        registry = ConcurrentCollectorRegistry()
+        registry.register(REGISTRY)
+        port = free_port()
+        tls = ServerTLS(os.path.join(CERTS, "server.pem"), os.path.join(CERTS, "server.key"))
+        context = ssl.create_default_context(cafile=os.path.join(CERTS, "ca.pem"))
+        sample = 'juju_backup_all_exporter_tls_handshakes_total{resumed="false"}'
+        before = REGISTRY.get_sample_value(
+            "juju_backup_all_exporter_tls_handshakes_total", {"resumed": "false"}
+        )
+        exporter = PreforkExporter(port, registry, 2, addr="127.0.0.1", interval=0.1, tls=tls)
+        exporter.start()
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    connection = http.client.HTTPSConnection(
+                        "localhost", port, timeout=5, context=context
+                    )
+                    connection.request("GET", "/metrics")
+                    response = connection.getresponse()
+                    lines = response.read().decode().splitlines()
+                    connection.close()
+                    [line] = [line for line in lines if line.startswith(sample)]
+                    if float(line.split()[-1]) > before:
+                        break
+                except (ConnectionRefusedError, ValueError):
+                    pass
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+        finally:
+            exporter.stop()
+
+    def test_prefork_exporter_sigterm(self):
+        """Test the children are terminated by SIGTERM, not running the parent's handler."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        marker = os.path.join(tmp_dir.name, "exited")
+        exporter = PreforkExporter(
+            free_port(),
+            ConcurrentCollectorRegistry(),
+            1,
+            interval=0.1,
+            on_exit=lambda: open(marker, "w").close(),
+        )
+        handler = signal.signal(signal.SIGTERM, exporter.stop)
+        try:
+            exporter.start()
+            # lets the children install their handlers
+            time.sleep(0.5)
+            exporter.stop()
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        # the collector process exits running on_exit, the worker is terminated
+        self.assertEqual(
+            [process.exitcode for process in exporter.processes],
+            [128 + signal.SIGTERM, -signal.SIGTERM],
+        )
+        self.assertTrue(os.path.exists(marker))
+
+    def test_prefork_exporter_child_exits(self):
+        """Test the exporter stops when a child process exits."""
+        registry = ConcurrentCollectorRegistry()
+        # the workers cannot bind a port used without SO_REUSEPORT, so they exit
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            sock.listen()
+            exporter = PreforkExporter(
+                sock.getsockname()[1], registry, 1, addr="127.0.0.1", interval=0.1
+            )
+            handler = signal.getsignal(signal.SIGTERM)
+            try:
+                exporter.run()
+            finally:
+                signal.signal(signal.SIGTERM, handler)
+        self.assertTrue(all(not process.is_alive() for process in exporter.processes))
@@ -0,0 +1,160 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from prometheus_juju_backup_all_exporter import replay
+from prometheus_juju_backup_all_exporter.replay import (
+    EventBatch,
+    FileWrite,
+    ReplayReport,
+    _Producer,
+    _scrape,
+    generate_timeline,
+    load_timeline,
+    record_timeline,
+    save_timeline,
+)
+from prometheus_juju_backup_all_exporter.snapshot import EVENT_FILE, STATS_FILE
+from prometheus_juju_backup_all_exporter.storage import LocalStorage
+
+STATS = json.dumps({"duration": 42.5, "status_ok": 1, "result_code": 0})
+
+
+def write(path, name, data):
+    with open(os.path.join(path, name), "wb") as file:
+        file.write(data)
+
+
+def test_save_load_timeline(tmp_path):
+    """Test the timeline is saved as JSON lines and loaded sorted by time."""
+    timeline = [
+        EventBatch(2.0, failed=1, purged=2, completed=3),
+        FileWrite(1.0, STATS_FILE, '{"dur\udcff'),
+    ]
+    path = str(tmp_path / "timeline.jsonl")
+    save_timeline(timeline, path)
+    assert json.loads(open(path).readline())["kind"] == "events"
+    assert load_timeline(path) == timeline[::-1]
+
+
+@pytest.mark.parametrize("line", ['{"time": 1.0}', '{"kind": "events", "time": 1.0}', "{"])
+def test_load_timeline_invalid(tmp_path, line):
+    """Test an invalid operation is reported with its line."""
+    path = tmp_path / "timeline.jsonl"
+    path.write_text(
+        f'{{"kind": "events", "time": 0, "failed": 0, "purged": 0, "completed": 0}}\n{line}\n'
+    )
+    with pytest.raises(ValueError, match="line 2"):
+        load_timeline(str(path))
+
+
+def test_generate_timeline():
+    """Test the synthetic timeline is sorted, and reproducible with the seed."""
+    timeline = generate_timeline(30, run_interval=100.0, targets=3, seed=1)
+    assert timeline == generate_timeline(30, run_interval=100.0, targets=3, seed=1)
+    assert timeline != generate_timeline(30, run_interval=100.0, targets=3, seed=2)
+    assert [op.time for op in timeline] == sorted(op.time for op in timeline)
+    writes = [op for op in timeline if isinstance(op, FileWrite)]
+    complete = [json.loads(op.data) for op in writes if op.data.endswith("}")]
+    assert len(complete) == 30
+    assert len(writes) > 30
+    assert all(len(stats["targets"]) == 3 for stats in complete)
+    assert all(isinstance(op, EventBatch) for op in timeline if op not in writes)
+
+
+def test_record_timeline(tmp_path):
+    """Test the new versions of the state files are recorded, and left in place."""
+    steps = [
+        lambda: write(tmp_path, STATS_FILE, b'{"duration"'),
+        lambda: write(tmp_path, EVENT_FILE, b'{"failed": 1, "purged"'),
+        lambda: write(tmp_path, EVENT_FILE, b'{"failed": 1, "purged": 2, "completed": 3}'),
+        lambda: write(tmp_path, STATS_FILE, STATS.encode()),
+    ]
+
+    def step(_):
+        if steps:
+            steps.pop(0)()
+
+    with patch.object(replay.time, "sleep", side_effect=step):
+        timeline = record_timeline(LocalStorage(str(tmp_path)), 0.05, 0.01)
+    assert [op._replace(time=0.0) for op in timeline] == [
+        FileWrite(0.0, STATS_FILE, '{"duration"'),
+        EventBatch(0.0, failed=1, purged=2, completed=3),
+        FileWrite(0.0, STATS_FILE, STATS),
+    ]
+    assert os.path.exists(tmp_path / EVENT_FILE)
+
+
+def test_producer_flush(tmp_path):
+    """Test the pending events are written only when the event file is absent."""
+    producer = _Producer(str(tmp_path))
+    assert producer.flush()
+    producer.apply(EventBatch(0.0, failed=1, purged=0, completed=2))
+    assert not producer.flush()
+    producer.apply(EventBatch(0.0, failed=0, purged=3, completed=1))
+    assert producer.pending == [0, 3, 1]
+    event_file = tmp_path / EVENT_FILE
+    assert json.loads(event_file.read_text()) == {"failed": 1, "purged": 0, "completed": 2}
+    event_file.unlink()
+    assert not producer.flush()
+    assert json.loads(event_file.read_text()) == {"failed": 0, "purged": 3, "completed": 1}
+    event_file.unlink()
+    assert producer.flush()
+    assert os.listdir(tmp_path) == []
+
+
+def test_replay(tmp_path):
+    """Test the replay of a synthetic timeline counts every event exactly once."""
+    timeline = generate_timeline(12, run_interval=10.0, targets=5, seed=3)
+    report = replay.replay(timeline, str(tmp_path), speed=100.0, scrape_interval=1.0)
+    assert report.failures == []
+    assert report.ok
+    assert len(report.latencies) > 1
+    assert report.wall_seconds > 0
+    assert report.report().endswith("invariants: ok")
+
+
+@patch.object(replay, "_scrape", return_value={})
+def test_replay_failures(_, tmp_path):
+    """Test the invariants that did not hold are reported."""
+    timeline = [
+        EventBatch(0.0, failed=1, purged=0, completed=0),
+        FileWrite(0.0, STATS_FILE, STATS),
+    ]
+    report = replay.replay(timeline, str(tmp_path), speed=1000.0, settle_timeout=0.0)
+    assert not report.ok
+    assert report.failures == [
+        "events still pending after the timeline",
+        "failed total is None, expected 1",
+        "purged total is None, expected 0",
+        "completed total is None, expected 0",
+        "command duration is None, expected 42.5",
+    ]
+    assert "FAILED: failed total is None, expected 1" in report.report()
+    assert report.report().endswith("invariants: failed")
+
+
+def test_expected_stats_duration():
+    """Test the duration invariant is skipped without a valid backup stats file."""
+    assert replay._expected_stats_duration([]) is None
+    assert replay._expected_stats_duration([FileWrite(0.0, STATS_FILE, "{")]) is None
+
+
+@patch.object(replay.http.client, "HTTPConnection")
+def test_scrape_error(mock_connection):
+    """Test a scrape with an error status fails."""
+    mock_connection.return_value.getresponse.return_value.status = 500
+    with pytest.raises(OSError, match="HTTP 500"):
+        _scrape(("127.0.0.1", 9000))
+    mock_connection.return_value.close.assert_called_once()
+
+
+def test_report_without_scrapes():
+    """Test the report of a replay without scrapes."""
+    report = ReplayReport(3)
+    assert report.report().splitlines()[:2] == [
+        "0 scrapes, 3 operations",
+        "wall 0.000 s, cpu 0.000 s",
+    ]
@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import Mock
+
+import pytest
+
+from prometheus_juju_backup_all_exporter.core import CollectionCycle, ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.snapshot import DirectorySnapshot, Entry, get_snapshot
+
+
+class TestGetSnapshot(unittest.TestCase):
+    """get_snapshot test class."""
+
+    def setUp(self):
+        self.storage = Mock(location="/backups")
+
+    def test_get_snapshot_outside_cycle(self):
+        """Test a new snapshot is taken on every call outside a collection cycle."""
+        get_snapshot(self.storage)
+        get_snapshot(self.storage)
+        self.assertEqual(self.storage.take_snapshot.call_count, 2)
+
+    def test_get_snapshot_shared_in_cycle(self):
+        """Test collectors running in the same cycle share one snapshot."""
+        snapshots = []
+
+        def collect():
+            snapshots.append(get_snapshot(self.storage))
+            return []
+
+        registry = ConcurrentCollectorRegistry()
+        for _ in range(3):
+            collector = Mock()
+            collector.describe.return_value = []
+            collector.collect.side_effect = collect
+            registry.register(collector)
+
+        list(registry.collect())
+        self.assertEqual(snapshots, [self.storage.take_snapshot.return_value] * 3)
+        self.storage.take_snapshot.assert_called_once_with()
+
+        list(registry.collect())
+        self.assertEqual(self.storage.take_snapshot.call_count, 2)
+
+    def test_snapshot(self):
+        """Test the snapshot is immutable and locates its entries with its storage."""
+        entry = Entry(size=6, mtime=1.0, version="1")
+        result = DirectorySnapshot(self.storage, {"other.tar.gz": entry}, {}, {})
+        self.assertEqual(result.entry("other.tar.gz"), entry)
+        self.assertIsNone(result.entry("missing"))
+        self.assertIs(result.join("other.tar.gz"), self.storage.join.return_value)
+        self.storage.join.assert_called_once_with("other.tar.gz")
+        with pytest.raises(TypeError):
+            result.entries["other.tar.gz"] = entry
+
+
+def test_collection_cycle_error():
+    """Test the factory error is raised to every caller in the cycle."""
+    cycle = CollectionCycle()
+    factory = Mock(side_effect=ValueError("broken"))
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cycle.get_or_create("key", factory)
+    factory.assert_called_once()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import socket
+import ssl
+
+import pytest
+from prometheus_client import REGISTRY
+
+from prometheus_juju_backup_all_exporter.core import ConcurrentCollectorRegistry
+from prometheus_juju_backup_all_exporter.exporter import Exporter
+from prometheus_juju_backup_all_exporter.tls import ServerTLS
+
+CERTS = os.path.join(os.path.dirname(__file__), "certs")
+
+
+def cert(name):
+    return os.path.join(CERTS, name)
+
+
+def sample(name, labels=None):
+    return REGISTRY.get_sample_value(f"juju_backup_all_exporter_{name}_total", labels) or 0
+
+
+def client_context(client_cert=False):
+    context = ssl.create_default_context(cafile=cert("ca.pem"))
+    if client_cert:
+        context.load_cert_chain(cert("client.pem"), cert("client.key"))
+    return context
+
+
+def https_get(address, context, session=None):
+    """Scrape over TLS and return the response, the peer common name and the session."""
+    with socket.create_connection(address) as sock:
+        with context.wrap_socket(sock, server_hostname="localhost", session=session) as ssock:
+            subject = dict(field[0] for field in ssock.getpeercert()["subject"])
+            ssock.sendall(b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n")
+            response = b""
+            while True:
+                data = ssock.recv(65536)
+                if not data:
+                    break
+                response += data
+            return response, subject["commonName"], ssock.session, ssock.session_reused
+
+
+@pytest.fixture()
+def tls_files(tmp_path):
+    for name in ("server.pem", "server.key"):
+        shutil.copy(cert(name), tmp_path / name)
+    return str(tmp_path / "server.pem"), str(tmp_path / "server.key")
+
+
+@pytest.fixture()
+def tls_exporter(tmp_path):
+    exporters = []
+
+    def make(tls):
+        exporter = Exporter(
+            0,
+            addr="127.0.0.1",
+            registry=ConcurrentCollectorRegistry(),
+            unix_socket=str(tmp_path / "exporter.sock"),
+            tls=tls,
+        )
+        exporter.run(daemon=True)
+        exporters.append(exporter)
+        return exporter
+
+    yield make
+    for exporter in exporters:
+        for server in exporter.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_scrape_over_tls(tls_exporter, tls_files):
+    """Test the scrapes are served over TLS and the sessions are resumed."""
+    exporter = tls_exporter(ServerTLS(*tls_files))
+    address = exporter.servers[0].server_address
+    full = sample("tls_handshakes", {"resumed": "false"})
+    resumed = sample("tls_handshakes", {"resumed": "true"})
+
+    context = client_context()
+    response, name, session, reused = https_get(address, context)
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert b"process_cpu_seconds_total" in response
+    assert (name, reused) == ("server", False)
+
+    _, _, _, reused = https_get(address, context, session=session)
+    assert reused
+    assert sample("tls_handshakes", {"resumed": "false"}) == full + 1
+    assert sample("tls_handshakes", {"resumed": "true"}) == resumed + 1
+
+    # the Unix domain socket stays plain
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(exporter.unix_socket)
+        sock.sendall(b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n")
+        assert sock.recv(65536).startswith(b"HTTP/1.0 200 OK")
+
+
+def test_failed_handshake(tls_exporter, tls_files):
+    """Test a failed handshake only drops its connection."""
+    exporter = tls_exporter(ServerTLS(*tls_files))
+    address = exporter.servers[0].server_address
+    errors = sample("tls_handshake_errors")
+    with socket.create_connection(address) as sock:
+        sock.sendall(b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n")
+        assert sock.recv(65536) == b""
+    assert sample("tls_handshake_errors") == errors + 1
+    assert https_get(address, client_context())[0].startswith(b"HTTP/1.0 200 OK")
+
+
+def test_client_cert_required(tls_exporter, tls_files):
+    """Test the clients must present a certificate signed by the CA when it is set."""
+    exporter = tls_exporter(ServerTLS(*tls_files, ca_file=cert("ca.pem")))
+    address = exporter.servers[0].server_address
+    assert https_get(address, client_context(client_cert=True))[0].startswith(b"HTTP/1.0 200")
+    with pytest.raises((ssl.SSLError, ConnectionError)):
+        https_get(address, client_context())
+
+
+def test_reload(tls_exporter, tls_files):
+    """Test the certificates are reloaded when the files change, keeping them on errors."""
+    cert_file, key_file = tls_files
+    exporter = tls_exporter(ServerTLS(cert_file, key_file, check_interval=0))
+    address = exporter.servers[0].server_address
+    assert https_get(address, client_context())[1] == "server"
+    failures = sample("tls_reloads", {"result": "failure"})
+
+    # a certificate not matching the key yet
+    shutil.copy(cert("server2.pem"), cert_file)
+    assert https_get(address, client_context())[1] == "server"
+    assert sample("tls_reloads", {"result": "failure"}) == failures + 1
+
+    shutil.copy(cert("server2.key"), key_file)
+    assert https_get(address, client_context())[1] == "server2"
+
+
+def test_invalid_certificates(tmp_path):
+    """Test the exporter does not start with invalid certificates."""
+    with pytest.raises(OSError):
+        ServerTLS(cert("server.pem"), cert("client.key"))
+    with pytest.raises(OSError):
+        ServerTLS(str(tmp_path / "missing.pem"), cert("server.key"))
@@ -1,12 +1,25 @@
+import json
+import logging
+import os
+import re
+import tempfile
 import unittest
-from unittest.mock import Mock, mock_open, patch
+from unittest.mock import patch
 
 import pytest
+from prometheus_client import REGISTRY
 
-from prometheus_juju_backup_all_exporter import config, utils
+from prometheus_juju_backup_all_exporter import utils
+from prometheus_juju_backup_all_exporter.storage import LocalStorage
 from prometheus_juju_backup_all_exporter.utils import (
     BackupEvent,
     BackupStats,
+    DecodeError,
+    EventRecord,
+    StatsRecord,
+    TargetRecord,
+    decode_record,
+    decode_targets,
     get_result_code_name,
 )
 
@@ -25,115 +38,284 @@ def test_get_result_code_name(test_input, expected):
     assert get_result_code_name(test_input) == expected
 
 
-class TestBackupStats(unittest.TestCase):
-    """BacupStats test class."""
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        (
+            b'{"duration": 1.5, "status_ok": true, "result_code": 0}',
+            StatsRecord(duration=1.5, status_ok=1, result_code=0),
+        ),
+        (
+            b'{"duration": 2, "status_ok": 0.0, "result_code": 2.0, "extra": []}',
+            StatsRecord(duration=2.0, status_ok=0, result_code=2),
+        ),
+    ],
+)
+def test_decode_record(data, expected):
+    record = decode_record(data, StatsRecord)
+    assert record == expected
+    assert isinstance(record.duration, float)
+    assert isinstance(record.status_ok, int)
+
+
+@pytest.mark.parametrize(
+    "data,reason",
+    [
+        (b"{", "invalid_json"),
+        (b"\xff", "invalid_json"),
+        (b"[1, 2]", "not_an_object"),
+        (b'{"failed": 1, "purged": 1}', "missing_field"),
+        (b'{"failed": 1, "purged": "1", "completed": 1}', "invalid_type"),
+        (b'{"failed": 1, "purged": null, "completed": 1}', "invalid_type"),
+        (b'{"failed": 1.5, "purged": 1, "completed": 1}', "invalid_type"),
+    ],
+)
+def test_decode_record_error(data, reason):
+    with pytest.raises(DecodeError) as err:
+        decode_record(data, EventRecord)
+    assert err.value.reason == reason
 
-    @classmethod
-    def setUpClass(cls):
-        cls.patch_open = patch("builtins.open", new_callable=mock_open)
-        cls.patch_open.start()
 
-    @classmethod
-    def tearDownClass(cls):
-        cls.patch_open.stop()
+@pytest.mark.parametrize(
+    "data",
+    [
+        b'{"duration": NaN, "status_ok": 1, "result_code": 0}',
+        b'{"duration": Infinity, "status_ok": 1, "result_code": 0}',
+        b'{"duration": 1e400, "status_ok": 1, "result_code": 0}',
+        b'{"duration": 1' + b"0" * 400 + b', "status_ok": 1, "result_code": 0}',
+        b'{"duration": 1, "status_ok": NaN, "result_code": 0}',
+        b'{"duration": 1, "status_ok": 1, "result_code": 1e400}',
+        b'{"duration": 1, "status_ok": 1, "result_code": 1' + b"0" * 400 + b"}",
+    ],
+)
+def test_decode_record_non_finite(data):
+    """Test the non-finite numbers of the standard library decoder are rejected."""
+    with patch.object(utils, "json_loads", json.loads):
+        with pytest.raises(DecodeError) as err:
+            decode_record(data, StatsRecord)
+    assert err.value.reason == "invalid_type"
+
+
+def test_decode_targets():
+    targets = decode_targets(
+        [
+            {"controller": "c1", "duration": 1, "status_ok": True, "result_code": 0},
+            {
+                "controller": "c1",
+                "model": "m1",
+                "unit": "u/0",
+                "duration": 2.5,
+                "status_ok": 0,
+                "result_code": 2,
+            },
+        ]
+    )
+    assert targets == [
+        TargetRecord(controller="c1", duration=1.0, status_ok=1, result_code=0),
+        TargetRecord(
+            controller="c1", model="m1", unit="u/0", duration=2.5, status_ok=0, result_code=2
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    "targets,reason,field",
+    [
+        ({}, "invalid_type", "targets"),
+        ([1], "not_an_object", "targets[0]"),
+        ([{"duration": 1, "status_ok": 1, "result_code": 0}], "missing_field", "targets[0]"),
+        (
+            [{"controller": 1, "duration": 1, "status_ok": 1, "result_code": 0}],
+            "invalid_type",
+            "targets[0].controller",
+        ),
+    ],
+)
+def test_decode_targets_error(targets, reason, field):
+    with pytest.raises(DecodeError, match=re.escape(f"Field {field}")) as err:
+        decode_targets(targets)
+    assert err.value.reason == reason
 
-    @patch.object(config, "Config")
-    def test_backup_stats_not_exists(self, mock_config):
+
+def decode_errors(file, reason):
+    value = REGISTRY.get_sample_value(
+        "juju_backup_all_exporter_decode_errors_total", {"file": file, "reason": reason}
+    )
+    return value or 0
+
+
+class BackupFileTestCase(unittest.TestCase):
+    """Base test class with a temporary backup directory."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.backup_path = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.backup_path, name), "wb") as file:
+            file.write(data if isinstance(data, bytes) else json.dumps(data).encode())
+
+    def snapshot(self, **kwargs):
+        return LocalStorage(self.backup_path).take_snapshot(**kwargs)
+
+
+class TestBackupStats(BackupFileTestCase):
+    """BacupStats test class."""
+
+    def test_backup_stats_not_exists(self):
         """Test backup stats not exists and set default stats."""
-        mock_config.backup_path = "non-existing-backup-path"
-        backup_stats = BackupStats(mock_config)
+        with self.assertLogs(utils.logger, "ERROR"):
+            backup_stats = BackupStats(self.snapshot())
         self.assertEqual(backup_stats.duration, utils.DEFAULT_DURATION)
         self.assertEqual(backup_stats.status_ok, utils.DEFAULT_STATUS_OK)
         self.assertEqual(backup_stats.result_code, utils.DEFAULT_RESULT_CODE)
+        self.assertFalse(backup_stats.loaded)
+        with self.assertLogs(utils.logger, "DEBUG") as logs:
+            BackupStats(self.snapshot(), missing_level=logging.DEBUG)
+        self.assertEqual([record.levelno for record in logs.records], [logging.DEBUG])
 
-    @patch.object(utils, "Path")
-    @patch.object(utils.json, "load")
-    @patch.object(config, "Config")
-    def test_backup_stats_error(self, mock_config, mock_json_load, mock_pathlib_path):
+    def test_backup_stats_error(self):
         """Test backup stats error and set default stats."""
-        mock_path = Mock()
-        mock_path.exists.return_value = True
-        mock_pathlib_path.return_value = mock_path
-        mock_json_load.return_value = {"random_data": 123}
-        backup_stats = BackupStats(mock_config)
+        self.write("backup_stats.json", {"random_data": 123})
+        before = decode_errors("backup_stats.json", "missing_field")
+        backup_stats = BackupStats(self.snapshot())
         self.assertEqual(backup_stats.duration, utils.DEFAULT_DURATION)
         self.assertEqual(backup_stats.status_ok, utils.DEFAULT_STATUS_OK)
         self.assertEqual(backup_stats.result_code, utils.DEFAULT_RESULT_CODE)
+        self.assertEqual(decode_errors("backup_stats.json", "missing_field") - before, 1)
 
-    @patch.object(utils, "Path")
-    @patch.object(utils.json, "load")
-    @patch.object(config, "Config")
-    def test_backup_stats_success(self, mock_config, mock_json_load, mock_pathlib_path):
+    def test_backup_stats_too_large(self):
+        """Test backup stats too large to be read and set default stats."""
+        self.write("backup_stats.json", {"duration": 1, "status_ok": 1, "result_code": 0})
+        before = decode_errors("backup_stats.json", "too_large")
+        backup_stats = BackupStats(self.snapshot(max_size=10))
+        self.assertEqual(backup_stats.duration, utils.DEFAULT_DURATION)
+        self.assertEqual(decode_errors("backup_stats.json", "too_large") - before, 1)
+
+    def test_backup_stats_success(self):
         """Test backup stats success."""
-        mock_path = Mock()
-        mock_path.exists.return_value = True
-        mock_pathlib_path.return_value = mock_path
         duration = 1.0
         status_ok = 1.0
         result_code = 1.0
-        mock_json_load.return_value = {
-            "duration": duration,
-            "status_ok": status_ok,
-            "result_code": result_code,
-        }
-        backup_stats = BackupStats(mock_config)
+        self.write(
+            "backup_stats.json",
+            {
+                "duration": duration,
+                "status_ok": status_ok,
+                "result_code": result_code,
+            },
+        )
+        backup_stats = BackupStats(self.snapshot())
         self.assertEqual(backup_stats.duration, duration)
         self.assertEqual(backup_stats.status_ok, status_ok)
         self.assertEqual(backup_stats.result_code, result_code)
+        self.assertTrue(backup_stats.loaded)
+        self.assertEqual(backup_stats.targets, [])
 
+    def test_backup_stats_targets(self):
+        """Test the per-target entries of the extended backup stats file."""
+        target = {"controller": "c1", "duration": 2.0, "status_ok": 1, "result_code": 0}
+        stats = {"duration": 5.0, "status_ok": 1, "result_code": 0, "targets": [target]}
+        self.write("backup_stats.json", stats)
+        backup_stats = BackupStats(self.snapshot())
+        self.assertEqual(backup_stats.targets, [TargetRecord(**target)])
 
-class TestBackupEvent(unittest.TestCase):
-    """BackupEvent test class."""
+    def test_backup_stats_invalid_targets(self):
+        """Test invalid per-target entries are reported, keeping the overall stats."""
+        stats = {"duration": 5.0, "status_ok": 1, "result_code": 0, "targets": [{}]}
+        self.write("backup_stats.json", stats)
+        before = decode_errors("backup_stats.json", "missing_field")
+        backup_stats = BackupStats(self.snapshot())
+        self.assertTrue(backup_stats.loaded)
+        self.assertEqual(backup_stats.duration, 5.0)
+        self.assertEqual(backup_stats.targets, [])
+        self.assertEqual(decode_errors("backup_stats.json", "missing_field") - before, 1)
 
-    @classmethod
-    def setUpClass(cls):
-        cls.patch_open = patch("builtins.open", new_callable=mock_open)
-        cls.patch_open.start()
 
-    @classmethod
-    def tearDownClass(cls):
-        cls.patch_open.stop()
+class TestBackupEvent(BackupFileTestCase):
+    """BackupEvent test class."""
+
+    @property
+    def event_file(self):
+        return os.path.join(self.backup_path, "backup_state.json")
 
-    @patch.object(config, "Config")
-    def test_backup_event_not_exists(self, mock_config):
+    def test_backup_event_not_exists(self):
         """Test backup event not exists."""
-        mock_config.backup_path = "random"
-        backup_event = BackupEvent(mock_config)
+        with self.assertLogs(utils.logger, "WARNING"):
+            backup_event = BackupEvent(self.snapshot())
         self.assertEqual(backup_event.failed, utils.DEFAULT_FAILED)
         self.assertEqual(backup_event.purged, utils.DEFAULT_PURGED)
         self.assertEqual(backup_event.completed, utils.DEFAULT_COMPLETED)
+        with self.assertLogs(utils.logger, "DEBUG") as logs:
+            BackupEvent(self.snapshot(), missing_level=logging.DEBUG)
+        self.assertEqual([record.levelno for record in logs.records], [logging.DEBUG])
 
-    @patch.object(utils, "Path")
-    @patch.object(utils.json, "load")
-    @patch.object(config, "Config")
-    def test_backup_event_error(self, mock_config, mock_json_load, mock_pathlib_path):
+    def test_backup_event_error(self):
         """Test backup event error."""
-        mock_path = Mock()
-        mock_path.exists.return_value = True
-        mock_pathlib_path.return_value = mock_path
-        mock_json_load.return_value = {"random_data": 123}
-        backup_event = BackupEvent(mock_config)
+        self.write("backup_state.json", {"random_data": 123})
+        before = decode_errors("backup_state.json", "missing_field")
+        backup_event = BackupEvent(self.snapshot())
         self.assertEqual(backup_event.failed, utils.DEFAULT_FAILED)
         self.assertEqual(backup_event.purged, utils.DEFAULT_PURGED)
         self.assertEqual(backup_event.completed, utils.DEFAULT_COMPLETED)
+        self.assertEqual(decode_errors("backup_state.json", "missing_field") - before, 1)
+        self.assertFalse(os.path.exists(self.event_file))
 
-    @patch.object(utils, "Path")
-    @patch.object(utils.json, "load")
-    @patch.object(config, "Config")
-    def test_backup_event_success(self, mock_config, mock_json_load, mock_pathlib_path):
+    def test_backup_event_non_finite(self):
+        """Test an event file with a non-finite number is reported and removed."""
+        self.write("backup_state.json", b'{"failed": NaN, "purged": 1, "completed": 1}')
+        before = decode_errors("backup_state.json", "invalid_type")
+        with patch.object(utils, "json_loads", json.loads):
+            backup_event = BackupEvent(self.snapshot())
+        self.assertEqual(backup_event.failed, utils.DEFAULT_FAILED)
+        self.assertEqual(decode_errors("backup_state.json", "invalid_type") - before, 1)
+        self.assertFalse(os.path.exists(self.event_file))
+
+    def test_backup_event_read_error(self):
+        """Test backup event read error."""
+        self.write("backup_state.json", b"{}")
+        before = decode_errors("backup_state.json", "read_error")
+        with patch("os.open", side_effect=PermissionError("denied")):
+            snapshot = self.snapshot()
+        backup_event = BackupEvent(snapshot)
+        self.assertEqual(backup_event.failed, utils.DEFAULT_FAILED)
+        self.assertEqual(decode_errors("backup_state.json", "read_error") - before, 1)
+
+    def test_backup_event_success(self):
         """Test backup event success."""
-        mock_path = Mock()
-        mock_path.exists.return_value = True
-        mock_pathlib_path.return_value = mock_path
         completed = 1.0
         failed = 1.0
         purged = 1.0
-        mock_json_load.return_value = {
-            "completed": completed,
-            "failed": failed,
-            "purged": purged,
-        }
-        backup_event = BackupEvent(mock_config)
+        self.write(
+            "backup_state.json",
+            {
+                "completed": completed,
+                "failed": failed,
+                "purged": purged,
+            },
+        )
+        backup_event = BackupEvent(self.snapshot())
         self.assertEqual(backup_event.failed, failed)
         self.assertEqual(backup_event.purged, purged)
         self.assertEqual(backup_event.completed, completed)
+        self.assertFalse(os.path.exists(self.event_file))
+
+    def test_backup_event_replaced(self):
+        """Test backup event file replaced after the snapshot is kept."""
+        self.write("backup_state.json", {"completed": 1, "failed": 0, "purged": 0})
+        snapshot = self.snapshot()
+        self.write("backup_state.json", {"completed": 2, "failed": 0, "purged": 0, "new": 1})
+        backup_event = BackupEvent(snapshot)
+        self.assertEqual(backup_event.completed, 1)
+        self.assertTrue(os.path.exists(self.event_file))
+
+    def test_backup_event_remove_error(self):
+        """Test backup event file that cannot be removed."""
+        self.write("backup_state.json", {"completed": 1, "failed": 0, "purged": 0})
+        snapshot = self.snapshot()
+        os.unlink(self.event_file)
+        backup_event = BackupEvent(snapshot)
+        self.assertEqual(backup_event.completed, 1)